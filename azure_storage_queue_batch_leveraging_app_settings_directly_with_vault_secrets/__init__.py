@@ -0,0 +1,147 @@
+
+# Example Azure function which drains the storage queue
+# in micro-batches on a timer, downloading the files for
+# each batch concurrently and executing their SQL
+# statements on pooled Snowpark sessions, authenticating
+# to Snowflake using a password that is stored as a
+# secret in an Azure key vault.
+#
+# This is an alternative to the queue triggered
+# azure_storage_trigger_leveraging_app_settings_directly_with_vault_secrets
+# function, which should be disabled if both functions
+# would otherwise be reading from the same queue
+
+## Import Azure packages
+import logging
+import azure.functions as func
+
+## Import other packages
+import os
+
+## Import shared packages
+from ..shared.app_settings import retrieve_int_app_setting
+from ..shared.lazy_imports import import_attribute_lazily
+from ..shared.azure_credential_cache import retrieve_default_azure_credential
+from ..shared.queue_batch_processing import process_queue_messages_in_batch
+from ..shared.snowpark_session_builders import build_snowpark_session_using_key_vault_password
+from ..shared.snowflake_execution import retrieve_available_execution_capacity
+from ..shared.dependency_resilience import is_dependency_circuit_open
+from ..shared.invocation_profiling import profile_invocation
+
+## Import heavy packages, deferred until first use
+QueueClient = import_attribute_lazily("azure.storage.queue", "QueueClient")
+BinaryBase64EncodePolicy = import_attribute_lazily("azure.storage.queue", "BinaryBase64EncodePolicy")
+BinaryBase64DecodePolicy = import_attribute_lazily("azure.storage.queue", "BinaryBase64DecodePolicy")
+
+## Define function to create an Azure storage queue client
+def azure_retrieve_queue_client(storage_queue_service_uri=None, queue_name=None):
+  """
+  Retrieve an Azure storage queue client object
+  Keyword arguments:
+  storage_queue_service_uri -- the uri for the queue storage service (default None)
+  queue_name -- the name of the queue (default None)
+
+  eg: azure_retrieve_queue_client(storage_queue_service_uri="https://my-storage-account.queue.core.windows.net", queue_name="my-queue")
+  """
+  logging.info(f'Manual log - Beginning retrieval of queue client')
+  if not all([storage_queue_service_uri, queue_name]):
+    logging.error(f'Manual log - Aborting retrieval of queue client as function input is missing')
+    raise ValueError('Aborting retrieval of queue client as function input is missing')
+
+  ### Messages are base64 encoded by Event Grid,
+  ### matching the encoding expected by queue triggers
+  queue_client = QueueClient(
+      storage_queue_service_uri
+    , queue_name = queue_name
+    , credential = retrieve_default_azure_credential()
+    , message_encode_policy = BinaryBase64EncodePolicy()
+    , message_decode_policy = BinaryBase64DecodePolicy()
+  )
+  logging.info(f'Manual log - Concluded retrieval of queue client')
+  return queue_client
+
+## Define function that settles each message in a batch
+## based on the result of processing it
+def settle_queue_messages(queue_client, poison_queue_client, received_messages: list, message_results: list, max_dequeue_count: int):
+
+  for received_message, message_result in zip(received_messages, message_results):
+
+    ### Remove messages which succeeded, or which were
+    ### repeated deliveries of another message, from the queue
+    if message_result["status"] in ("succeeded", "duplicate") :
+      queue_client.delete_message(received_message)
+
+    ### Move messages which have repeatedly failed to the
+    ### poison queue, matching the queue trigger behaviour
+    elif received_message.dequeue_count >= max_dequeue_count :
+      logging.error(f'Manual log - Moving message {received_message.id} to poison queue after {received_message.dequeue_count} attempts')
+      poison_queue_client.send_message(received_message.content)
+      queue_client.delete_message(received_message)
+
+    ### Leave any other failed message in the queue so that
+    ### it becomes visible again after the visibility timeout
+    else :
+      logging.warning(f'Manual log - Leaving message {received_message.id} in queue for retry')
+
+  return
+
+## Define main function for Azure
+@profile_invocation
+def main(timer: func.TimerRequest):
+  logging.info('Timer trigger beginning to drain queue in batches')
+
+  ### Retrieve batch configuration from app settings
+  storage_queue_service_uri = os.getenv("AZURE_STORAGE_IDENTITY__queueServiceUri")
+  queue_name = os.getenv("AZURE_STORAGE_BATCH_QUEUE_NAME", "automated-function-trigger-demo")
+  batch_size = retrieve_int_app_setting("AZURE_STORAGE_BATCH_SIZE", 32)
+  max_batches = retrieve_int_app_setting("AZURE_STORAGE_BATCH_MAX_BATCHES_PER_INVOCATION", 10)
+  visibility_timeout_seconds = retrieve_int_app_setting("AZURE_STORAGE_BATCH_VISIBILITY_TIMEOUT_SECONDS", 300)
+  max_dequeue_count = retrieve_int_app_setting("AZURE_STORAGE_BATCH_MAX_DEQUEUE_COUNT", 5)
+  max_download_workers = retrieve_int_app_setting("AZURE_STORAGE_BATCH_MAX_DOWNLOAD_WORKERS", 8)
+
+  ### Retrieve the queue and poison queue clients
+  queue_client = azure_retrieve_queue_client(storage_queue_service_uri=storage_queue_service_uri, queue_name=queue_name)
+  poison_queue_client = azure_retrieve_queue_client(storage_queue_service_uri=storage_queue_service_uri, queue_name=f"{queue_name}-poison")
+
+  for batch_number in range(max_batches):
+
+    ### Apply backpressure by leaving messages in the queue
+    ### whilst the warehouse has no free execution slots,
+    ### rather than receiving messages that would only wait
+    if retrieve_available_execution_capacity() == 0 :
+      logging.warning(f'Manual log - Warehouse has no free execution slots, leaving remaining messages in queue')
+      break
+
+    ### Leave messages in the queue whilst Snowflake is down, rather
+    ### than receiving messages that would only fail and be retried
+    if is_dependency_circuit_open("snowflake") :
+      logging.warning(f'Manual log - Circuit for Snowflake is open, leaving remaining messages in queue')
+      break
+
+    ### Receive the next batch of messages, stopping once the queue is empty.
+    ### A single request can receive at most 32 messages
+    received_messages = list(queue_client.receive_messages(
+        max_messages = batch_size
+      , messages_per_page = min(batch_size, 32)
+      , visibility_timeout = visibility_timeout_seconds
+    ))
+    if len(received_messages) == 0 :
+      break
+    logging.info(f'Manual log - Received batch {batch_number + 1} of {len(received_messages)} messages')
+
+    ### Wrap the received messages so that they can be
+    ### parsed in the same way as queue trigger messages
+    queue_messages = [
+        func.QueueMessage(id=received_message.id, body=received_message.content)
+        for received_message in received_messages
+    ]
+
+    ### Process the batch and settle each message individually
+    message_results = process_queue_messages_in_batch(
+        queue_messages = queue_messages
+      , session_builder = build_snowpark_session_using_key_vault_password
+      , max_download_workers = max_download_workers
+    )
+    settle_queue_messages(queue_client, poison_queue_client, received_messages, message_results, max_dequeue_count)
+
+  return
@@ -0,0 +1,40 @@
+
+# Example Azure function which reacts to a file landing in a queue
+# authenticating to Snowflake using a password that is
+# stored as a secret in an Azure key vault, with an
+# asynchronous main function so that the Python worker
+# can progress several messages at once.
+#
+# This is an alternative to the synchronous
+# azure_storage_trigger_leveraging_app_settings_directly_with_vault_secrets
+# function, which should be disabled if both functions
+# would otherwise be reading from the same queue
+
+## Import Azure packages
+import logging
+import azure.functions as func
+
+## Import other packages
+import os
+
+## Import shared packages
+from ..shared.async_storage_trigger_processing import process_storage_queue_message_async
+from ..shared.snowpark_session_builders import build_snowpark_session_using_key_vault_password
+from ..shared.invocation_profiling import profile_invocation
+
+## Define main function for Azure
+@profile_invocation
+async def main(msg: func.QueueMessage):
+  logging.info('Received new message from queue')
+  logging.info(msg)
+
+  ### Download the file referenced by the message whilst the
+  ### password is retrieved from the key vault, then execute
+  ### its SQL statements in Snowflake without blocking the worker
+  await process_storage_queue_message_async(
+      msg
+    , build_snowpark_session_using_key_vault_password
+    , key_vault_secret_names = [os.getenv("SNOWFLAKE_PASSWORD_SECRET_NAME")]
+  )
+
+  return
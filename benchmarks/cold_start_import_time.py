@@ -0,0 +1,197 @@
+
+# Local cold start benchmark for the function app. The
+# Python worker imports every function in the function app
+# when it starts, so the time taken to import each function
+# module is paid on every cold start. This script imports
+# each function in a fresh interpreter with
+# "python -X importtime" and reports the cumulative import
+# time, the wall time and the most expensive top-level
+# imports for each function.
+#
+# Run from the root of the repository, eg:
+#   python benchmarks/cold_start_import_time.py --runs 5 --top 10
+#
+# Packages which are not installed locally are reported as
+# import errors rather than being skipped, so the benchmark
+# should be run in an environment built from requirements.txt
+
+## Import other packages
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+## Name under which the Azure Functions host
+## imports the function app as a package
+FUNCTION_APP_PACKAGE_NAME = "__app__"
+
+## Define function to list the functions in the function app
+def list_function_names(function_app_path: str):
+  """
+  List the functions in the function app, being the subdirectories that contain a function.json file
+  Keyword arguments:
+  function_app_path -- the root directory of the function app
+
+  eg: list_function_names(function_app_path=".")
+  """
+  return sorted(
+      entry_name
+      for entry_name in os.listdir(function_app_path)
+      if os.path.isfile(os.path.join(function_app_path, entry_name, "function.json"))
+  )
+
+## Define function to parse the output of "python -X importtime"
+def parse_import_times(importtime_output: str):
+  """
+  Parse the stderr output of "python -X importtime" into a list of imports
+  Keyword arguments:
+  importtime_output -- the stderr output of the interpreter
+
+  Returns a list of dictionaries containing the module name, its nesting depth
+  and its self and cumulative import times in microseconds
+
+  eg: parse_import_times(importtime_output="import time:       112 |        112 |   _io")
+  """
+  import_times = []
+  for output_line in importtime_output.splitlines():
+    if not output_line.startswith("import time:") :
+      continue
+    import_fields = output_line[len("import time:"):].split("|")
+    if len(import_fields) != 3 or not import_fields[0].strip().isdigit() :
+      continue
+    module_name = import_fields[2].rstrip()
+    import_times.append({
+        "module": module_name.strip()
+      , "depth": (len(module_name) - len(module_name.lstrip())) // 2
+      , "self_us": int(import_fields[0])
+      , "cumulative_us": int(import_fields[1])
+    })
+  return import_times
+
+## Define function to import a single function
+## in a fresh interpreter and measure the cost
+def measure_function_import(function_app_package_path: str, function_name: str):
+  """
+  Import a function module in a fresh interpreter, returning its import times
+  Keyword arguments:
+  function_app_package_path -- the directory containing the function app under the name __app__
+  function_name -- the name of the function to import
+
+  eg: measure_function_import(function_app_package_path="/tmp/benchmark", function_name="connection_leveraging_app_settings_directly")
+  """
+  import_start = time.perf_counter()
+  completed_process = subprocess.run(
+      [sys.executable, "-X", "importtime", "-c", f"import {FUNCTION_APP_PACKAGE_NAME}.{function_name}"]
+    , cwd = function_app_package_path
+    , capture_output = True
+    , text = True
+  )
+  wall_seconds = time.perf_counter() - import_start
+
+  import_times = parse_import_times(completed_process.stderr)
+  function_module_name = f"{FUNCTION_APP_PACKAGE_NAME}.{function_name}"
+  function_import_us = sum(
+      import_time["cumulative_us"]
+      for import_time in import_times
+      if import_time["depth"] == 0 and import_time["module"] in (FUNCTION_APP_PACKAGE_NAME, function_module_name)
+  )
+
+  ### Report the last line of the traceback if the import failed
+  import_error = None
+  if completed_process.returncode != 0 :
+    error_lines = [error_line for error_line in completed_process.stderr.splitlines() if not error_line.startswith("import time:")]
+    import_error = error_lines[-1] if len(error_lines) > 0 else f"Exit code {completed_process.returncode}"
+
+  return {
+      "wall_seconds": wall_seconds
+    , "function_import_us": function_import_us
+    , "import_times": import_times
+    , "import_error": import_error
+  }
+
+## Define function to summarize the most expensive imports
+## beneath the function module across several runs
+def summarize_heaviest_imports(measurements: list, top_n: int):
+  cumulative_us_by_module = {}
+  for measurement in measurements:
+    for import_time in measurement["import_times"]:
+      if import_time["module"].startswith(FUNCTION_APP_PACKAGE_NAME) :
+        continue
+      cumulative_us_by_module.setdefault(import_time["module"], []).append(import_time["cumulative_us"])
+  heaviest_imports = sorted(
+      ((module_name, statistics.median(cumulative_us)) for module_name, cumulative_us in cumulative_us_by_module.items())
+    , key = lambda heaviest_import: heaviest_import[1]
+    , reverse = True
+  )
+  return heaviest_imports[:top_n]
+
+## Define function to run the benchmark
+def run_cold_start_benchmark(function_app_path: str, function_names: list, runs: int = 5, top_n: int = 10):
+  """
+  Measure the cold import cost of each function over several runs
+  Keyword arguments:
+  function_app_path -- the root directory of the function app
+  function_names -- the functions to measure
+  runs -- the number of fresh interpreters to start per function (default 5)
+  top_n -- the number of most expensive imports to report per function (default 10)
+
+  eg: run_cold_start_benchmark(function_app_path=".", function_names=["connection_leveraging_app_settings_directly"])
+  """
+  benchmark_results = {}
+  with tempfile.TemporaryDirectory() as function_app_package_path:
+
+    ### Expose the function app under the package name used by the host
+    os.symlink(os.path.abspath(function_app_path), os.path.join(function_app_package_path, FUNCTION_APP_PACKAGE_NAME))
+
+    for function_name in function_names:
+      measurements = [measure_function_import(function_app_package_path, function_name) for _ in range(runs)]
+      benchmark_results[function_name] = {
+          "function_import_ms_median": statistics.median(measurement["function_import_us"] for measurement in measurements) / 1000
+        , "wall_ms_median": statistics.median(measurement["wall_seconds"] for measurement in measurements) * 1000
+        , "wall_ms_min": min(measurement["wall_seconds"] for measurement in measurements) * 1000
+        , "import_error": measurements[-1]["import_error"]
+        , "heaviest_imports": [
+              {"module": module_name, "cumulative_ms_median": cumulative_us / 1000}
+              for module_name, cumulative_us in summarize_heaviest_imports(measurements, top_n)
+          ]
+      }
+
+  return benchmark_results
+
+## Define function to print the results as a table
+def print_benchmark_results(benchmark_results: dict):
+  for function_name, function_result in benchmark_results.items():
+    print(f"{function_name}")
+    print(f"  import time (median): {function_result['function_import_ms_median']:10.1f} ms")
+    print(f"  wall time (median):   {function_result['wall_ms_median']:10.1f} ms")
+    print(f"  wall time (min):      {function_result['wall_ms_min']:10.1f} ms")
+    if function_result["import_error"] is not None :
+      print(f"  import error:         {function_result['import_error']}")
+    for heaviest_import in function_result["heaviest_imports"]:
+      print(f"    {heaviest_import['cumulative_ms_median']:10.1f} ms  {heaviest_import['module']}")
+    print()
+
+## Define main function
+def main():
+  argument_parser = argparse.ArgumentParser(description="Measure the cold import cost of each function in the function app")
+  argument_parser.add_argument("functions", nargs="*", help="the functions to measure (default every function)")
+  argument_parser.add_argument("--function-app-path", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), help="the root directory of the function app")
+  argument_parser.add_argument("--runs", type=int, default=5, help="the number of fresh interpreters to start per function")
+  argument_parser.add_argument("--top", type=int, default=10, help="the number of most expensive imports to report per function")
+  argument_parser.add_argument("--json", action="store_true", help="print the results as JSON, eg to compare runs before and after a change")
+  arguments = argument_parser.parse_args()
+
+  function_names = arguments.functions or list_function_names(arguments.function_app_path)
+  benchmark_results = run_cold_start_benchmark(arguments.function_app_path, function_names, arguments.runs, arguments.top)
+
+  if arguments.json :
+    print(json.dumps(benchmark_results, indent=2))
+  else :
+    print_benchmark_results(benchmark_results)
+
+if __name__ == "__main__" :
+  main()
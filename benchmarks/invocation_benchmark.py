@@ -0,0 +1,568 @@
+# Local invocation benchmark for the function app. Each
+# function is imported in a fresh interpreter, with Azure
+# storage, key vault and Snowpark replaced by the in-memory
+# stand-ins in local_stand_ins.py, and its main function is
+# invoked repeatedly with synthetic storage queue messages,
+# HTTP requests or timer ticks. The throughput, the latency
+# percentiles and the peak memory are reported for each
+# function and each configuration, so that the effect of a
+# change can be measured without Azure or Snowflake, eg in CI
+#
+# Run from the root of the repository, eg:
+#   python benchmarks/invocation_benchmark.py --invocations 200 --concurrency 4
+#
+# Each configuration pairs a latency profile for the
+# stand-ins with app settings for the function app, as
+# listed in BENCHMARK_CONFIGURATIONS. The azure-functions
+# package must be installed. A function or configuration
+# which needs more than the stand-ins, such as the InterWorks
+# submodule, cryptography for private keys or pandas for
+# spilled results, is skipped with the reason when that
+# requirement is missing, rather than reported as failing
+
+## Import other packages
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import inspect
+import argparse
+import importlib
+import importlib.util
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+## Import benchmark packages
+from cold_start_import_time import FUNCTION_APP_PACKAGE_NAME, list_function_names
+
+## Endpoints and names used by the stand-ins
+BENCHMARK_BLOB_SERVICE_URI = "https://benchmark.blob.core.windows.net"
+BENCHMARK_QUEUE_SERVICE_URI = "https://benchmark.queue.core.windows.net"
+BENCHMARK_TABLE_SERVICE_URI = "https://benchmark.table.core.windows.net"
+BENCHMARK_CONTAINER = "automated-function-trigger-demo"
+BENCHMARK_QUEUE_NAME = "automated-function-trigger-demo"
+BENCHMARK_PASSWORD_SECRET_NAME = "benchmark-snowflake-password"
+BENCHMARK_METADATA_CONTAINER = "benchmark-metadata"
+
+## Containers and tables which already exist before the first invocation,
+## so that the handling of ResourceExistsError is exercised
+BENCHMARK_EXISTING_CONTAINERS = ["snowpark-function-poison", BENCHMARK_METADATA_CONTAINER]
+BENCHMARK_EXISTING_TABLES = ["snowparkfunctionidempotency", "snowparkfunctionexecutions"]
+
+## App settings shared by every configuration
+BENCHMARK_APP_SETTINGS = {
+    "AZURE_KEY_VAULT_NAME": "benchmark-key-vault"
+  , "AZURE_STORAGE_IDENTITY__blobServiceUri": BENCHMARK_BLOB_SERVICE_URI
+  , "AZURE_STORAGE_IDENTITY__queueServiceUri": BENCHMARK_QUEUE_SERVICE_URI
+  , "AZURE_STORAGE_IDENTITY__tableServiceUri": BENCHMARK_TABLE_SERVICE_URI
+  , "AZURE_STORAGE_BATCH_QUEUE_NAME": BENCHMARK_QUEUE_NAME
+  , "SNOWFLAKE_ACCOUNT": "benchmark-account"
+  , "SNOWFLAKE_USER": "BENCHMARK_USER"
+  , "SNOWFLAKE_ROLE": "BENCHMARK_ROLE"
+  , "SNOWFLAKE_WAREHOUSE": "BENCHMARK_WH"
+  , "SNOWFLAKE_PASSWORD": "benchmark-password"
+  , "SNOWFLAKE_PASSWORD_SECRET_NAME": BENCHMARK_PASSWORD_SECRET_NAME
+  , "TELEMETRY_EXPORT_ENABLED": "false"
+}
+
+## Configurations to benchmark, each pairing a latency
+## profile from local_stand_ins.py with app settings,
+## optionally making every nth control file invalid JSON
+## or every nth HTTP request one which invalidates a cache
+BENCHMARK_CONFIGURATIONS = {
+    "no_latency": {
+        "latency_profile": "no_latency"
+      , "app_settings": {}
+    }
+  , "regional": {
+        "latency_profile": "regional"
+      , "app_settings": {}
+    }
+  , "regional_without_session_pool": {
+        "latency_profile": "regional"
+      , "app_settings": {"SNOWPARK_SESSION_POOL_MAX_IDLE_SESSIONS": "0"}
+    }
+  , "regional_sampled_results": {
+        "latency_profile": "regional"
+      , "app_settings": {"SNOWFLAKE_RESULT_HANDLING_MODE": "sample"}
+    }
+  , "regional_spilled_results": {
+        "latency_profile": "regional"
+      , "app_settings": {"SNOWFLAKE_RESULT_HANDLING_MODE": "spill"}
+      , "requirements": ["pandas", "pyarrow"]
+    }
+  , "regional_profiled": {
+        "latency_profile": "regional"
+      , "app_settings": {"INVOCATION_PROFILING_ENABLED": "true"}
+    }
+  , "regional_bulk_ingestion": {
+        "latency_profile": "regional"
+      , "app_settings": {
+            "BULK_INGESTION_ROUTES": json.dumps([{
+                "container": BENCHMARK_CONTAINER
+              , "path_prefix": "benchmark/"
+              , "target_table": "BENCHMARK_DB.PUBLIC.BENCHMARK_TABLE"
+              , "internal_stage": "@BENCHMARK_DB.PUBLIC.BENCHMARK_STAGE"
+              , "file_format": "TYPE = JSON"
+            }])
+        }
+    }
+  , "regional_workload_routed": {
+        "latency_profile": "regional"
+      , "app_settings": {
+            "SNOWFLAKE_WORKLOAD_ROUTES": json.dumps([{
+                "container": BENCHMARK_CONTAINER
+              , "path_prefix": "benchmark/"
+              , "warehouse": "BENCHMARK_ROUTED_WH"
+              , "role": "BENCHMARK_ROUTED_ROLE"
+            }])
+        }
+    }
+  , "regional_message_routed": {
+        "latency_profile": "regional"
+      , "app_settings": {
+            "STORAGE_MESSAGE_ROUTES": json.dumps([
+                {"connection": "AZURE_STORAGE_IDENTITY", "containers": [BENCHMARK_CONTAINER], "handler": "control_file"}
+              , {"connection": "AZURE_STORAGE_IDENTITY", "containers": ["results"], "handler": "ignore"}
+            ])
+        }
+    }
+  , "regional_durable_execution": {
+        "latency_profile": "regional"
+      , "app_settings": {
+            "DURABLE_EXECUTION_STORE": "sqlite"
+          , "DURABLE_EXECUTION_SQLITE_PATH": os.path.join(tempfile.gettempdir(), "benchmark_durable_execution.sqlite")
+        }
+    }
+  , "regional_table_stores": {
+        "latency_profile": "regional"
+      , "app_settings": {
+            "IDEMPOTENCY_STORE": "table"
+          , "DURABLE_EXECUTION_STORE": "table"
+        }
+    }
+  , "regional_poison_quarantine": {
+        "latency_profile": "regional"
+      , "app_settings": {}
+      , "invalid_control_file_every": 4
+    }
+  , "regional_metadata_invalidated": {
+        "latency_profile": "regional"
+      , "app_settings": {
+            "METADATA_CACHE_INVALIDATION_BLOB": f"{BENCHMARK_METADATA_CONTAINER}/invalidation-marker"
+          , "METADATA_CACHE_INVALIDATION_CHECK_SECONDS": "0"
+        }
+      , "invalidating_request_every": 4
+    }
+}
+
+## Modules needed by functions beyond the stand-ins, keyed on a
+## part of the function name, with a module name beginning with
+## a dot being relative to the function app package
+BENCHMARK_FUNCTION_REQUIREMENTS = {
+    "interworks_submodule": [".submodules.interworks_snowpark.interworks_snowpark_python.snowpark_session_builder"]
+  , "private_key": ["cryptography"]
+}
+
+## Define function to find the first requirement of a function
+## and configuration which cannot be imported, if any
+def retrieve_missing_requirement(function_name: str, configuration_name: str):
+  """
+  Retrieve a description of the first module needed by a function and configuration which cannot be imported, or None if every module is available
+  Keyword arguments:
+  function_name -- the name of the function to benchmark
+  configuration_name -- the name of the configuration in BENCHMARK_CONFIGURATIONS
+
+  eg: retrieve_missing_requirement(function_name="connection_leveraging_app_settings_directly_with_private_key", configuration_name="regional")
+  """
+  required_module_names = [
+      required_module_name
+      for function_name_part, required_module_names_for_part in BENCHMARK_FUNCTION_REQUIREMENTS.items() if function_name_part in function_name
+      for required_module_name in required_module_names_for_part
+  ]
+  required_module_names.extend(BENCHMARK_CONFIGURATIONS[configuration_name].get("requirements", []))
+  for required_module_name in required_module_names:
+    try:
+      module_spec = importlib.util.find_spec(required_module_name, package=FUNCTION_APP_PACKAGE_NAME)
+    except ModuleNotFoundError:
+      module_spec = None
+    if module_spec is None :
+      if required_module_name.startswith(".submodules.") :
+        return f"requires the {required_module_name.split('.')[2]} submodule, which is not checked out"
+      return f"requires the {required_module_name} package, which is not installed"
+  return None
+
+## Define function to generate an unencrypted private key
+## for the functions which authenticate with a private key
+def _generate_benchmark_private_key():
+  from cryptography.hazmat.primitives import serialization
+  from cryptography.hazmat.primitives.asymmetric import rsa
+  private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+  return private_key.private_bytes(
+      encoding = serialization.Encoding.PEM
+    , format = serialization.PrivateFormat.PKCS8
+    , encryption_algorithm = serialization.NoEncryption()
+  ).decode()
+
+## Define function to retrieve the peak resident
+## memory of the current process in megabytes
+def retrieve_peak_rss_mb():
+  try:
+    import resource
+  except ImportError:
+    return None
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+  ### ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+  return peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+## Define function to calculate a percentile
+## of a sorted list using the nearest rank
+def calculate_percentile(sorted_values: list, percentile: float):
+  """
+  Calculate a percentile of a sorted list of values using the nearest rank method
+  Keyword arguments:
+  sorted_values -- the values, sorted in ascending order
+  percentile -- the percentile to calculate, between 0 and 100
+
+  eg: calculate_percentile(sorted_values=[1, 2, 3, 4], percentile=95)
+  """
+  if len(sorted_values) == 0 :
+    return None
+  nearest_rank = max(1, -(-len(sorted_values) * percentile // 100))
+  return sorted_values[int(nearest_rank) - 1]
+
+## Define function to retrieve the trigger type of a function
+def retrieve_trigger_type(function_app_path: str, function_name: str):
+  with open(os.path.join(function_app_path, function_name, "function.json")) as function_json_file:
+    function_bindings = json.load(function_json_file)["bindings"]
+  return next(binding["type"] for binding in function_bindings if binding.get("direction") == "in")
+
+## Define function to upload a synthetic JSON control file
+## and build the Event Grid message which references it
+def build_synthetic_queue_message_body(local_stand_ins, invalid_control_file: bool = False):
+  blob_name = f"benchmark/{uuid.uuid4().hex}.json"
+  blob_data = json.dumps({"sql_statements_to_execute": ["SHOW DATABASES", "SELECT CURRENT_TIMESTAMP()"]}).encode()
+  if invalid_control_file :
+    blob_data = blob_data[:len(blob_data) // 2]
+  local_stand_ins.upload_blob_data(BENCHMARK_BLOB_SERVICE_URI, BENCHMARK_CONTAINER, blob_name, blob_data)
+  return json.dumps({
+      "id": str(uuid.uuid4())
+    , "eventType": "Microsoft.Storage.BlobCreated"
+    , "data": {
+          "url": f"{BENCHMARK_BLOB_SERVICE_URI}/{BENCHMARK_CONTAINER}/{blob_name}"
+        , "eTag": f"0x{uuid.uuid4().hex[:16].upper()}"
+        , "contentType": "application/json"
+        , "contentLength": len(blob_data)
+      }
+  }).encode()
+
+## Tick of a timer triggered function, which queues
+## its batch of messages just before it is invoked
+class TimerTick:
+  def __init__(self, local_stand_ins, message_bodies: list):
+    self._local_stand_ins = local_stand_ins
+    self._message_bodies = message_bodies
+
+  def enqueue_messages(self):
+    for message_body in self._message_bodies:
+      self._local_stand_ins.enqueue_message(BENCHMARK_QUEUE_SERVICE_URI, BENCHMARK_QUEUE_NAME, message_body)
+
+## Define function to determine whether the nth input
+## of a configuration is one of every so many inputs
+def _is_every_nth_input(configuration: dict, configuration_key: str, input_index: int):
+  input_interval = configuration.get(configuration_key, 0)
+  return input_interval > 0 and input_index % input_interval == input_interval - 1
+
+## Define function to build the argument for
+## a single invocation of a function
+def build_invocation_input(trigger_type: str, local_stand_ins, batch_messages: int, configuration: dict = {}, input_index: int = 0):
+  import azure.functions as func
+  if trigger_type == "queueTrigger" :
+    invalid_control_file = _is_every_nth_input(configuration, "invalid_control_file_every", input_index)
+    return func.QueueMessage(id=uuid.uuid4().hex, body=build_synthetic_queue_message_body(local_stand_ins, invalid_control_file))
+  if trigger_type == "httpTrigger" :
+    http_method = "POST" if _is_every_nth_input(configuration, "invalidating_request_every", input_index) else "GET"
+    return func.HttpRequest(method=http_method, url="/api/benchmark", params={}, body=b"")
+
+  ### Timer triggered functions drain the queue,
+  ### so a batch of messages is queued for each tick
+  return TimerTick(local_stand_ins, [
+      build_synthetic_queue_message_body(local_stand_ins, _is_every_nth_input(configuration, "invalid_control_file_every", input_index * batch_messages + message_index))
+      for message_index in range(batch_messages)
+  ])
+
+## Define function to prepare the argument for an
+## invocation just before the invocation is timed
+def _prepare_invocation_input(invocation_input):
+  if isinstance(invocation_input, TimerTick) :
+    invocation_input.enqueue_messages()
+    return None
+  return invocation_input
+
+## Define function to describe the error in the
+## response of an invocation, or None if there is none
+def describe_error_response(invocation_response):
+  if invocation_response is None or not hasattr(invocation_response, "get_body") :
+    return None
+  if invocation_response.status_code >= 400 or invocation_response.get_body().startswith(b"Error encountered") :
+    return f"HTTP {invocation_response.status_code}: {invocation_response.get_body()[:80].decode(errors='replace')}"
+  return None
+
+## Define function to describe an exception raised by an invocation
+def _describe_invocation_error(error: Exception):
+  return f"{type(error).__name__}: {error}".splitlines()[0][:120]
+
+## Define function to invoke a synchronous main function
+## and return its duration and its error, if any
+def _invoke_function(function_main, invocation_input):
+  invocation_input = _prepare_invocation_input(invocation_input)
+  invocation_start = time.perf_counter()
+  try:
+    invocation_error = describe_error_response(function_main(invocation_input))
+  except Exception as e:
+    invocation_error = _describe_invocation_error(e)
+  return time.perf_counter() - invocation_start, invocation_error
+
+## Define function to invoke an asynchronous main function
+## and return its duration and its error, if any
+async def _invoke_function_async(function_main, invocation_input):
+  invocation_input = _prepare_invocation_input(invocation_input)
+  invocation_start = time.perf_counter()
+  try:
+    invocation_error = describe_error_response(await function_main(invocation_input))
+  except Exception as e:
+    invocation_error = _describe_invocation_error(e)
+  return time.perf_counter() - invocation_start, invocation_error
+
+## Define function to run the invocations of an
+## asynchronous main function on a single event loop
+async def _run_async_invocations(function_main, invocation_inputs: list, concurrency: int):
+  concurrency_semaphore = asyncio.Semaphore(concurrency)
+  async def invoke_with_semaphore(invocation_input):
+    async with concurrency_semaphore:
+      return await _invoke_function_async(function_main, invocation_input)
+  cold_invocation = await _invoke_function_async(function_main, invocation_inputs[0])
+  warm_invocations_start = time.perf_counter()
+  warm_invocations = await asyncio.gather(*[invoke_with_semaphore(invocation_input) for invocation_input in invocation_inputs[1:]])
+  return cold_invocation, list(warm_invocations), time.perf_counter() - warm_invocations_start
+
+## Define function to run the invocations
+## of a synchronous main function on a thread pool
+def _run_sync_invocations(function_main, invocation_inputs: list, concurrency: int):
+  cold_invocation = _invoke_function(function_main, invocation_inputs[0])
+  warm_invocations_start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as invocation_executor:
+    warm_invocations = list(invocation_executor.map(lambda invocation_input: _invoke_function(function_main, invocation_input), invocation_inputs[1:]))
+  return cold_invocation, warm_invocations, time.perf_counter() - warm_invocations_start
+
+## Define function to benchmark a single function under a single
+## configuration, which runs in the worker interpreter
+def run_benchmark_worker(function_app_path: str, function_name: str, configuration_name: str, invocations: int, concurrency: int, batch_messages: int):
+  """
+  Install the stand-ins, import a function and invoke its main function repeatedly, returning the measurements
+  Keyword arguments:
+  function_app_path -- the root directory of the function app
+  function_name -- the name of the function to benchmark
+  configuration_name -- the name of the configuration in BENCHMARK_CONFIGURATIONS
+  invocations -- the number of invocations, including the first cold invocation
+  concurrency -- the maximum number of concurrent invocations
+  batch_messages -- the number of messages queued for each invocation of a timer triggered function
+
+  eg: run_benchmark_worker(function_app_path=".", function_name="connection_leveraging_app_settings_directly", configuration_name="regional", invocations=100, concurrency=4, batch_messages=8)
+  """
+  import local_stand_ins
+  configuration = BENCHMARK_CONFIGURATIONS[configuration_name]
+  trigger_type = retrieve_trigger_type(function_app_path, function_name)
+
+  ### Skip the function rather than counting every
+  ### invocation as an error if a requirement is missing
+  missing_requirement = retrieve_missing_requirement(function_name, configuration_name)
+  if missing_requirement is not None :
+    return {"benchmark_skipped": missing_requirement, "benchmark_error": None}
+
+  ### Timer triggered functions share one queue,
+  ### so their invocations cannot overlap
+  if trigger_type == "timerTrigger" :
+    concurrency = 1
+
+  ### Configure the function app before it is imported
+  os.environ.pop("APPLICATIONINSIGHTS_CONNECTION_STRING", None)
+  os.environ.update(BENCHMARK_APP_SETTINGS)
+  os.environ["IDEMPOTENCY_SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "benchmark_idempotency.sqlite")
+  os.environ.update(configuration["app_settings"])
+  if "private_key" in function_name :
+    os.environ["SNOWFLAKE_PRIVATE_KEY_PLAIN_TEXT"] = _generate_benchmark_private_key()
+  local_stand_ins.store_secret(BENCHMARK_PASSWORD_SECRET_NAME, os.environ["SNOWFLAKE_PASSWORD"])
+  for existing_container in BENCHMARK_EXISTING_CONTAINERS:
+    local_stand_ins.create_container(BENCHMARK_BLOB_SERVICE_URI, existing_container)
+  for existing_table in BENCHMARK_EXISTING_TABLES:
+    local_stand_ins.create_table(BENCHMARK_TABLE_SERVICE_URI, existing_table)
+
+  import_start = time.perf_counter()
+  function_module = importlib.import_module(f"{FUNCTION_APP_PACKAGE_NAME}.{function_name}")
+  import_seconds = time.perf_counter() - import_start
+  local_stand_ins.install_stand_ins(FUNCTION_APP_PACKAGE_NAME, latency=local_stand_ins.LATENCY_PROFILES[configuration["latency_profile"]])
+
+  ### Build every input before timing the invocations
+  invocation_inputs = [build_invocation_input(trigger_type, local_stand_ins, batch_messages, configuration, input_index) for input_index in range(max(1, invocations))]
+  if inspect.iscoroutinefunction(function_module.main) :
+    cold_invocation, warm_invocations, warm_seconds = asyncio.run(_run_async_invocations(function_module.main, invocation_inputs, concurrency))
+  else :
+    cold_invocation, warm_invocations, warm_seconds = _run_sync_invocations(function_module.main, invocation_inputs, concurrency)
+
+  warm_durations = sorted(duration_seconds for duration_seconds, _ in warm_invocations)
+  invocation_errors = [invocation_error for _, invocation_error in [cold_invocation, *warm_invocations] if invocation_error is not None]
+  return {
+      "trigger_type": trigger_type
+    , "invocations": len(invocation_inputs)
+    , "concurrency": concurrency
+    , "errors": len(invocation_errors)
+    , "first_error": invocation_errors[0] if len(invocation_errors) > 0 else None
+    , "import_ms": import_seconds * 1000
+    , "cold_invocation_ms": cold_invocation[0] * 1000
+    , "throughput_per_second": len(warm_durations) / warm_seconds if len(warm_durations) > 0 and warm_seconds > 0 else None
+    , "p50_ms": _to_milliseconds(calculate_percentile(warm_durations, 50))
+    , "p95_ms": _to_milliseconds(calculate_percentile(warm_durations, 95))
+    , "p99_ms": _to_milliseconds(calculate_percentile(warm_durations, 99))
+    , "peak_rss_mb": retrieve_peak_rss_mb()
+    , "benchmark_skipped": None
+    , "benchmark_error": None
+  }
+
+## Define function to convert seconds to milliseconds
+def _to_milliseconds(duration_seconds: float):
+  return duration_seconds * 1000 if duration_seconds is not None else None
+
+## Define function to benchmark a single function under a
+## single configuration in a fresh interpreter
+def measure_function_invocations(function_app_package_path: str, function_name: str, configuration_name: str, invocations: int, concurrency: int, batch_messages: int, log_level: str):
+  """
+  Benchmark a function under a configuration in a fresh interpreter, returning its measurements
+  Keyword arguments:
+  function_app_package_path -- the directory containing the function app under the name __app__
+  function_name -- the name of the function to benchmark
+  configuration_name -- the name of the configuration in BENCHMARK_CONFIGURATIONS
+  invocations -- the number of invocations, including the first cold invocation
+  concurrency -- the maximum number of concurrent invocations
+  batch_messages -- the number of messages queued for each invocation of a timer triggered function
+  log_level -- the logging level of the function app, such as "WARNING"
+
+  eg: measure_function_invocations(function_app_package_path="/tmp/benchmark", function_name="connection_leveraging_app_settings_directly", configuration_name="regional", invocations=100, concurrency=4, batch_messages=8, log_level="WARNING")
+  """
+  completed_process = subprocess.run(
+      [
+          sys.executable, os.path.abspath(__file__), "--worker", function_name
+        , "--configurations", configuration_name
+        , "--invocations", str(invocations)
+        , "--concurrency", str(concurrency)
+        , "--batch-messages", str(batch_messages)
+        , "--log-level", log_level
+      ]
+    , cwd = function_app_package_path
+    , env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [function_app_package_path, os.getenv("PYTHONPATH")]))}
+    , capture_output = True
+    , text = True
+  )
+
+  ### Report the last line of the traceback if the worker failed
+  if completed_process.returncode != 0 :
+    error_lines = completed_process.stderr.strip().splitlines()
+    return {"benchmark_skipped": None, "benchmark_error": error_lines[-1] if len(error_lines) > 0 else f"Exit code {completed_process.returncode}"}
+  return json.loads(completed_process.stdout.strip().splitlines()[-1])
+
+## Define function to run the benchmark
+def run_invocation_benchmark(function_app_path: str, function_names: list, configuration_names: list, invocations: int = 100, concurrency: int = 4, batch_messages: int = 8, log_level: str = "WARNING"):
+  """
+  Benchmark the invocations of each function under each configuration
+  Keyword arguments:
+  function_app_path -- the root directory of the function app
+  function_names -- the functions to benchmark
+  configuration_names -- the names of the configurations in BENCHMARK_CONFIGURATIONS
+  invocations -- the number of invocations per function and configuration, including the first cold invocation (default 100)
+  concurrency -- the maximum number of concurrent invocations (default 4)
+  batch_messages -- the number of messages queued for each invocation of a timer triggered function (default 8)
+  log_level -- the logging level of the function app (default "WARNING")
+
+  eg: run_invocation_benchmark(function_app_path=".", function_names=["connection_leveraging_app_settings_directly"], configuration_names=["no_latency", "regional"])
+  """
+  benchmark_results = {}
+  with tempfile.TemporaryDirectory() as function_app_package_path:
+
+    ### Expose the function app under the package name used by the host
+    os.symlink(os.path.abspath(function_app_path), os.path.join(function_app_package_path, FUNCTION_APP_PACKAGE_NAME))
+
+    for function_name in function_names:
+      benchmark_results[function_name] = {
+          configuration_name: measure_function_invocations(function_app_package_path, function_name, configuration_name, invocations, concurrency, batch_messages, log_level)
+          for configuration_name in configuration_names
+      }
+
+  return benchmark_results
+
+## Define function to format an optional measurement
+def _format_measurement(measurement, format_spec: str = "10.1f"):
+  return f"{measurement:{format_spec}}" if measurement is not None else f"{'-':>10}"
+
+## Define function to print the results as a table
+def print_benchmark_results(benchmark_results: dict):
+  for function_name, configuration_results in benchmark_results.items():
+    print(f"{function_name}")
+    print(f"  {'configuration':<32}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'cold ms':>10}{'rss MB':>10}{'errors':>8}")
+    for configuration_name, configuration_result in configuration_results.items():
+      if configuration_result["benchmark_error"] is not None :
+        print(f"  {configuration_name:<32}benchmark error: {configuration_result['benchmark_error']}")
+        continue
+      if configuration_result["benchmark_skipped"] is not None :
+        print(f"  {configuration_name:<32}skipped: {configuration_result['benchmark_skipped']}")
+        continue
+      print(
+          f"  {configuration_name:<32}"
+        + _format_measurement(configuration_result["throughput_per_second"])
+        + _format_measurement(configuration_result["p50_ms"])
+        + _format_measurement(configuration_result["p95_ms"])
+        + _format_measurement(configuration_result["p99_ms"])
+        + _format_measurement(configuration_result["cold_invocation_ms"])
+        + _format_measurement(configuration_result["peak_rss_mb"])
+        + f"{configuration_result['errors']:>8}"
+      )
+      if configuration_result["first_error"] is not None :
+        print(f"  {'':<32}first error: {configuration_result['first_error']}")
+    print()
+
+## Define main function
+def main():
+  argument_parser = argparse.ArgumentParser(description="Benchmark the invocations of each function in the function app against local stand-ins for Azure and Snowflake")
+  argument_parser.add_argument("functions", nargs="*", help="the functions to benchmark (default every function)")
+  argument_parser.add_argument("--function-app-path", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), help="the root directory of the function app")
+  argument_parser.add_argument("--configurations", nargs="+", default=list(BENCHMARK_CONFIGURATIONS), choices=list(BENCHMARK_CONFIGURATIONS), help="the configurations to benchmark (default every configuration)")
+  argument_parser.add_argument("--invocations", type=int, default=100, help="the number of invocations per function and configuration, including the first cold invocation")
+  argument_parser.add_argument("--concurrency", type=int, default=4, help="the maximum number of concurrent invocations")
+  argument_parser.add_argument("--batch-messages", type=int, default=8, help="the number of messages queued for each invocation of a timer triggered function")
+  argument_parser.add_argument("--log-level", default="WARNING", help="the logging level of the function app")
+  argument_parser.add_argument("--json", action="store_true", help="print the results as JSON, eg to compare runs before and after a change")
+  argument_parser.add_argument("--worker", help=argparse.SUPPRESS)
+  arguments = argument_parser.parse_args()
+
+  ### Benchmark a single function and configuration when
+  ### run as a worker, printing the measurements as JSON
+  if arguments.worker is not None :
+    import logging
+    logging.basicConfig(level=arguments.log_level.upper())
+    worker_result = run_benchmark_worker(os.path.join(os.getcwd(), FUNCTION_APP_PACKAGE_NAME), arguments.worker, arguments.configurations[0], arguments.invocations, arguments.concurrency, arguments.batch_messages)
+    print(json.dumps(worker_result))
+    return
+
+  function_names = arguments.functions or list_function_names(arguments.function_app_path)
+  benchmark_results = run_invocation_benchmark(arguments.function_app_path, function_names, arguments.configurations, arguments.invocations, arguments.concurrency, arguments.batch_messages, arguments.log_level)
+
+  if arguments.json :
+    print(json.dumps(benchmark_results, indent=2))
+  else :
+    print_benchmark_results(benchmark_results)
+
+if __name__ == "__main__" :
+  main()
@@ -0,0 +1,92 @@
+# Summary of the invocation profiles written by the
+# function app when the INVOCATION_PROFILING_ENABLED app
+# setting is true. The profiles are downloaded from the
+# profiling container, eg with:
+#   az storage blob download-batch --account-name my-storage-account --source function-invocation-profiles --destination ./profiles --auth-mode login
+#
+# and this script aggregates them for each function and
+# start type, being cold or warm, reporting the hottest
+# functions and optionally writing the merged folded stacks
+# so that a flame graph can be drawn for each, eg with
+# speedscope or flamegraph.pl
+#
+# Run from the root of the repository, eg:
+#   python benchmarks/invocation_profile_summary.py ./profiles --top 15 --merged-output ./flame_graphs
+
+## Import other packages
+import os
+import sys
+import json
+import argparse
+from collections import Counter
+
+## Import shared packages from the function app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.invocation_profiling import summarize_folded_stacks
+
+## Define function to read the profiles in a directory
+def read_invocation_profiles(profiles_path: str):
+  """
+  Read the folded stack profiles beneath a directory, aggregated for each function and start type
+  Keyword arguments:
+  profiles_path -- the directory containing the profiles, laid out as <function>/<start type>/<profile>.folded
+
+  eg: read_invocation_profiles(profiles_path="./profiles")
+  """
+  aggregated_profiles = {}
+  for directory_path, _, file_names in os.walk(profiles_path):
+    for file_name in sorted(file_names):
+      if not file_name.endswith(".folded") :
+        continue
+      profile_key = os.path.relpath(directory_path, profiles_path).replace(os.sep, "/")
+      aggregated_profile = aggregated_profiles.setdefault(profile_key, {"profiles": 0, "folded_stacks": Counter()})
+      aggregated_profile["profiles"] += 1
+      with open(os.path.join(directory_path, file_name)) as profile_file:
+        for folded_line in profile_file:
+          folded_stack, _, sample_count = folded_line.rstrip("\n").rpartition(" ")
+          if folded_stack and sample_count.isdigit() :
+            aggregated_profile["folded_stacks"][folded_stack] += int(sample_count)
+  return dict(sorted(aggregated_profiles.items()))
+
+## Define function to write the merged folded stacks
+def write_merged_profiles(aggregated_profiles: dict, merged_output_path: str):
+  os.makedirs(merged_output_path, exist_ok=True)
+  for profile_key, aggregated_profile in aggregated_profiles.items():
+    with open(os.path.join(merged_output_path, f"{profile_key.replace('/', '__')}.folded"), "w") as merged_file:
+      for folded_stack, sample_count in aggregated_profile["folded_stacks"].most_common():
+        merged_file.write(f"{folded_stack} {sample_count}\n")
+
+## Define function to print the summaries as a table
+def print_profile_summaries(profile_summaries: dict):
+  for profile_key, profile_summary in profile_summaries.items():
+    print(f"{profile_key} ({profile_summary['profiles']} profiles, {profile_summary['samples']} samples)")
+    for ranking_name in ("self", "inclusive"):
+      print(f"  {ranking_name}:")
+      for hot_function in profile_summary[ranking_name]:
+        print(f"    {hot_function['percent']:6.1f}%  {hot_function['function']}")
+    print()
+
+## Define main function
+def main():
+  argument_parser = argparse.ArgumentParser(description="Summarize the hottest functions in the invocation profiles written by the function app")
+  argument_parser.add_argument("profiles_path", help="the directory containing the downloaded profiles")
+  argument_parser.add_argument("--top", type=int, default=10, help="the number of hottest functions to report for each function and start type")
+  argument_parser.add_argument("--merged-output", help="a directory in which to write the merged folded stacks for each function and start type")
+  argument_parser.add_argument("--json", action="store_true", help="print the summaries as JSON")
+  arguments = argument_parser.parse_args()
+
+  aggregated_profiles = read_invocation_profiles(arguments.profiles_path)
+  profile_summaries = {
+      profile_key: {"profiles": aggregated_profile["profiles"], **summarize_folded_stacks(aggregated_profile["folded_stacks"], arguments.top)}
+      for profile_key, aggregated_profile in aggregated_profiles.items()
+  }
+  if arguments.merged_output is not None :
+    write_merged_profiles(aggregated_profiles, arguments.merged_output)
+
+  if arguments.json :
+    print(json.dumps(profile_summaries, indent=2))
+  else :
+    print_profile_summaries(profile_summaries)
+
+if __name__ == "__main__" :
+  main()
@@ -0,0 +1,676 @@
+
+# Local stand-ins for the services that the functions
+# depend on, so that the functions can be benchmarked
+# without Azure or Snowflake. Blob storage and storage
+# queues and tables are held in memory, in the manner of
+# Azurite, key vault secrets are served from a dictionary and
+# Snowpark sessions execute nothing. Missing blobs and table
+# entities, and existing containers, tables and entities,
+# raise the same azure.core exceptions as the Azure SDKs, so
+# that the paths which handle them are exercised. Each stand-in sleeps for a
+# configurable latency so that the benchmark reflects the
+# round trips made by each function
+#
+# install_stand_ins() replaces the classes that the shared
+# modules import lazily, so the functions themselves run
+# unchanged. It is only intended for use by the benchmarks
+
+## Import other packages
+import os
+import re
+import time
+import uuid
+import asyncio
+import importlib
+import itertools
+import threading
+from collections import namedtuple
+from types import SimpleNamespace
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+## Latency profiles, in seconds, for each kind of round trip
+LATENCY_PROFILES = {
+    "no_latency": {
+        "token_seconds": 0.0
+      , "secret_seconds": 0.0
+      , "blob_first_byte_seconds": 0.0
+      , "blob_chunk_seconds": 0.0
+      , "queue_seconds": 0.0
+      , "table_seconds": 0.0
+      , "login_seconds": 0.0
+      , "query_seconds": 0.0
+      , "session_close_seconds": 0.0
+    }
+  , "regional": {
+        "token_seconds": 0.050
+      , "secret_seconds": 0.020
+      , "blob_first_byte_seconds": 0.015
+      , "blob_chunk_seconds": 0.002
+      , "queue_seconds": 0.010
+      , "table_seconds": 0.010
+      , "login_seconds": 0.300
+      , "query_seconds": 0.050
+      , "session_close_seconds": 0.020
+    }
+}
+
+## Module-level state shared by every stand-in
+_latency = dict(LATENCY_PROFILES["no_latency"])
+_result_rows = 10
+_blobs = {}
+_containers = set()
+_queues = {}
+_tables = {}
+_secrets = {}
+_stand_in_lock = threading.Lock()
+_query_ids = itertools.count(1)
+
+## Access token returned by the credential stand-ins
+AccessToken = namedtuple("AccessToken", ["token", "expires_on"])
+
+## Define function to sleep for a configured latency
+def _sleep_for(latency_name: str):
+  latency_seconds = _latency.get(latency_name, 0.0)
+  if latency_seconds > 0 :
+    time.sleep(latency_seconds)
+
+## Define function to sleep for a configured latency on the event loop
+async def _sleep_for_async(latency_name: str):
+  latency_seconds = _latency.get(latency_name, 0.0)
+  if latency_seconds > 0 :
+    await asyncio.sleep(latency_seconds)
+
+## Define an object which accepts any construction
+## arguments and ignores any method called on it
+class _IgnoredObject:
+  def __init__(self, *args, **kwargs):
+    pass
+
+  def __getattr__(self, attribute_name: str):
+    return lambda *args, **kwargs: None
+
+## Credential stand-ins
+class StandInTokenCredential(_IgnoredObject):
+  def get_token(self, *scopes, **kwargs):
+    _sleep_for("token_seconds")
+    return AccessToken("stand-in-token", int(time.time()) + 3600)
+
+class AsyncStandInTokenCredential(_IgnoredObject):
+  async def get_token(self, *scopes, **kwargs):
+    await _sleep_for_async("token_seconds")
+    return AccessToken("stand-in-token", int(time.time()) + 3600)
+
+  async def close(self):
+    pass
+
+## Key vault secrets client stand-ins
+class StandInSecretClient:
+  def __init__(self, vault_url: str, credential=None, **kwargs):
+    self.vault_url = vault_url
+    self._credential = credential
+
+  def get_secret(self, secret_name: str):
+    self._credential.get_token("https://vault.azure.net/.default")
+    _sleep_for("secret_seconds")
+    with _stand_in_lock:
+      return SimpleNamespace(name=secret_name, value=_secrets[secret_name])
+
+  def set_secret(self, secret_name: str, secret_value: str, **kwargs):
+    self._credential.get_token("https://vault.azure.net/.default")
+    _sleep_for("secret_seconds")
+    with _stand_in_lock:
+      _secrets[secret_name] = secret_value
+    return SimpleNamespace(name=secret_name, value=secret_value)
+
+class AsyncStandInSecretClient(StandInSecretClient):
+  async def get_secret(self, secret_name: str):
+    await self._credential.get_token("https://vault.azure.net/.default")
+    await _sleep_for_async("secret_seconds")
+    with _stand_in_lock:
+      return SimpleNamespace(name=secret_name, value=_secrets[secret_name])
+
+## Blob storage stand-ins, holding blobs in memory
+class StandInBlobDownloader:
+  def __init__(self, blob_data: bytes, chunk_size_bytes: int):
+    self.size = len(blob_data)
+    self._blob_data = blob_data
+    self._chunk_size_bytes = chunk_size_bytes
+
+  def chunks(self):
+    for chunk_number, chunk_start in enumerate(range(0, max(1, self.size), self._chunk_size_bytes)):
+      if chunk_number > 0 :
+        _sleep_for("blob_chunk_seconds")
+      yield self._blob_data[chunk_start:chunk_start + self._chunk_size_bytes]
+
+  def readall(self):
+    return b"".join(self.chunks())
+
+  def readinto(self, stream):
+    for chunk in self.chunks():
+      stream.write(chunk)
+    return self.size
+
+class AsyncStandInBlobDownloader(StandInBlobDownloader):
+  async def chunks(self):
+    for chunk_number, chunk_start in enumerate(range(0, max(1, self.size), self._chunk_size_bytes)):
+      if chunk_number > 0 :
+        await _sleep_for_async("blob_chunk_seconds")
+      yield self._blob_data[chunk_start:chunk_start + self._chunk_size_bytes]
+
+class StandInBlobClient:
+  def __init__(self, service_client, container_name: str, blob_name: str):
+    self._service_client = service_client
+    self.container_name = container_name
+    self.blob_name = blob_name
+    self.url = f"{service_client.url}/{container_name}/{blob_name}"
+    self._staged_blocks = {}
+
+  def _read_blob(self):
+    with _stand_in_lock:
+      blob_data = _blobs.get((self._service_client.url, self.container_name, self.blob_name))
+    if blob_data is None :
+      raise ResourceNotFoundError(f"The specified blob does not exist: {self.url}")
+    return blob_data
+
+  def download_blob(self, **kwargs):
+    self._service_client.credential.get_token("https://storage.azure.com/.default")
+    _sleep_for("blob_first_byte_seconds")
+    return StandInBlobDownloader(self._read_blob(), self._service_client.chunk_size_bytes)
+
+  def get_blob_properties(self, **kwargs):
+    _sleep_for("blob_first_byte_seconds")
+    blob_data = self._read_blob()
+    return SimpleNamespace(
+        name = self.blob_name
+      , container = self.container_name
+      , size = len(blob_data)
+      , etag = f'"{hash(blob_data)}"'
+      , content_settings = SimpleNamespace(content_type="application/json")
+    )
+
+  def upload_blob(self, data, overwrite: bool = False, **kwargs):
+    _sleep_for("blob_first_byte_seconds")
+    upload_blob_data(self._service_client.url, self.container_name, self.blob_name, data if isinstance(data, bytes) else bytes(data))
+
+  def stage_block(self, block_id: str, data, **kwargs):
+    _sleep_for("blob_chunk_seconds")
+    self._staged_blocks[block_id] = bytes(data)
+
+  def commit_block_list(self, block_ids: list, **kwargs):
+    _sleep_for("blob_first_byte_seconds")
+    upload_blob_data(self._service_client.url, self.container_name, self.blob_name, b"".join(self._staged_blocks.pop(block_id) for block_id in block_ids))
+
+class AsyncStandInBlobClient(StandInBlobClient):
+  async def download_blob(self, **kwargs):
+    await self._service_client.credential.get_token("https://storage.azure.com/.default")
+    await _sleep_for_async("blob_first_byte_seconds")
+    return AsyncStandInBlobDownloader(self._read_blob(), self._service_client.chunk_size_bytes)
+
+class StandInContainerClient:
+  def __init__(self, service_client, container_name: str):
+    self._service_client = service_client
+    self.container_name = container_name
+
+  def get_blob_client(self, blob: str):
+    return self._service_client.get_blob_client(container=self.container_name, blob=blob)
+
+  def create_container(self, **kwargs):
+    _sleep_for("blob_first_byte_seconds")
+    create_container(self._service_client.url, self.container_name)
+
+class StandInBlobServiceClient:
+  blob_client_class = StandInBlobClient
+
+  def __init__(self, account_url: str, credential=None, max_chunk_get_size: int = 4 * 1024 * 1024, **kwargs):
+    self.url = account_url.rstrip("/")
+    self.credential = credential
+    self.chunk_size_bytes = max_chunk_get_size
+
+  def get_container_client(self, container: str):
+    return StandInContainerClient(self, container)
+
+  def get_blob_client(self, container: str, blob: str):
+    return self.blob_client_class(self, container, blob)
+
+class AsyncStandInBlobServiceClient(StandInBlobServiceClient):
+  blob_client_class = AsyncStandInBlobClient
+
+## Storage queue stand-ins, holding messages in memory
+class StandInQueueMessage:
+  def __init__(self, content):
+    self.id = uuid.uuid4().hex
+    self.content = content
+    self.dequeue_count = 0
+
+class StandInQueueClient:
+  def __init__(self, account_url: str, queue_name: str, **kwargs):
+    self._queue_key = (account_url.rstrip("/"), queue_name)
+
+  def receive_messages(self, max_messages: int = 1, **kwargs):
+    _sleep_for("queue_seconds")
+    with _stand_in_lock:
+      queued_messages = _queues.setdefault(self._queue_key, [])
+      received_messages, _queues[self._queue_key] = queued_messages[:max_messages], queued_messages[max_messages:]
+    for received_message in received_messages:
+      received_message.dequeue_count += 1
+    return iter(received_messages)
+
+  def delete_message(self, message, **kwargs):
+    _sleep_for("queue_seconds")
+
+  def send_message(self, content, **kwargs):
+    _sleep_for("queue_seconds")
+    enqueue_message(self._queue_key[0], self._queue_key[1], content)
+
+## Table storage stand-ins, holding entities in memory
+class StandInTableEntity(dict):
+  def __init__(self, entity: dict, etag: str):
+    super().__init__(entity)
+    self.metadata = {"etag": etag}
+
+class StandInTableClient:
+  def __init__(self, endpoint: str, table_name: str, credential=None, **kwargs):
+    self._table_key = ((endpoint or "").rstrip("/"), table_name)
+
+  def _retrieve_entities(self):
+    entities = _tables.get(self._table_key)
+    if entities is None :
+      raise ResourceNotFoundError(f"The table specified does not exist: {self._table_key[1]}")
+    return entities
+
+  def create_table(self, **kwargs):
+    _sleep_for("table_seconds")
+    create_table(self._table_key[0], self._table_key[1])
+
+  def create_entity(self, entity: dict, **kwargs):
+    _sleep_for("table_seconds")
+    entity_key = (entity["PartitionKey"], entity["RowKey"])
+    with _stand_in_lock:
+      entities = self._retrieve_entities()
+      if entity_key in entities :
+        raise ResourceExistsError("The specified entity already exists")
+      entities[entity_key] = StandInTableEntity(entity, uuid.uuid4().hex)
+
+  def get_entity(self, partition_key: str, row_key: str, **kwargs):
+    _sleep_for("table_seconds")
+    with _stand_in_lock:
+      entity = self._retrieve_entities().get((partition_key, row_key))
+      if entity is None :
+        raise ResourceNotFoundError("The specified resource does not exist")
+      return StandInTableEntity(entity, entity.metadata["etag"])
+
+  def update_entity(self, entity: dict, mode=None, etag: str = None, match_condition=None, **kwargs):
+    _sleep_for("table_seconds")
+    entity_key = (entity["PartitionKey"], entity["RowKey"])
+    with _stand_in_lock:
+      entities = self._retrieve_entities()
+      if entity_key not in entities :
+        raise ResourceNotFoundError("The specified resource does not exist")
+      if etag is not None and entities[entity_key].metadata["etag"] != etag :
+        raise ResourceModifiedError("The update condition specified in the request was not satisfied")
+      entities[entity_key] = StandInTableEntity(entity, uuid.uuid4().hex)
+
+  def upsert_entity(self, entity: dict, mode=None, **kwargs):
+    _sleep_for("table_seconds")
+    with _stand_in_lock:
+      self._retrieve_entities()[(entity["PartitionKey"], entity["RowKey"])] = StandInTableEntity(entity, uuid.uuid4().hex)
+
+  def delete_entity(self, partition_key: str, row_key: str, **kwargs):
+    _sleep_for("table_seconds")
+    with _stand_in_lock:
+      self._retrieve_entities().pop((partition_key, row_key), None)
+
+  ### Only the filter used to evict expired entities is supported
+  def query_entities(self, query_filter: str, parameters: dict = None, **kwargs):
+    _sleep_for("table_seconds")
+    with _stand_in_lock:
+      return [
+          StandInTableEntity(entity, entity.metadata["etag"])
+          for entity in self._retrieve_entities().values()
+          if entity["PartitionKey"] == parameters["partition_key"] and entity["ExpiresAt"] <= parameters["now"]
+      ]
+
+## Update modes accepted by the table stand-in
+StandInUpdateMode = SimpleNamespace(REPLACE="replace", MERGE="merge")
+
+## Snowpark stand-ins, which execute nothing
+USE_STATEMENT_PATTERN = re.compile(r"^\s*USE\s+(ROLE|WAREHOUSE|DATABASE|SCHEMA)\s+(\S+)", re.IGNORECASE)
+QueryRecord = namedtuple("QueryRecord", ["query_id", "sql_text"])
+class StandInRow(namedtuple("StandInRow", ["name", "value"])):
+  def as_dict(self):
+    return self._asdict()
+
+## Define function to build the rows returned by every query
+def _build_result_rows():
+  return [StandInRow(f"DATABASE_{row_number}", row_number) for row_number in range(_result_rows)]
+
+class StandInQueryHistory:
+  def __init__(self, session):
+    self._session = session
+    self.queries = []
+
+  def __enter__(self):
+    self._session._query_histories.append(self)
+    return self
+
+  def __exit__(self, *exc_info):
+    self._session._query_histories.remove(self)
+
+## Define function to build the result of every query as
+## pandas dataframes, which needs pandas as Snowpark does
+def _build_result_pandas_batches():
+  pandas = importlib.import_module("pandas")
+  return iter([pandas.DataFrame([result_row.as_dict() for result_row in _build_result_rows()])])
+
+## Error raised by the connector when a result is not
+## available in the requested format, such as Arrow
+class StandInNotSupportedError(Exception):
+  def __init__(self, msg: str):
+    super().__init__(msg)
+    self.msg = msg
+    self.errno = None
+
+class StandInAsyncJob:
+  def __init__(self, query_id: str):
+    self.query_id = query_id
+
+  def result(self, result_type: str = "row"):
+    _sleep_for("query_seconds")
+    if result_type == "row_iterator" :
+      return iter(_build_result_rows())
+    if result_type == "pandas_batches" :
+      return _build_result_pandas_batches()
+    return _build_result_rows()
+
+class StandInDataFrame:
+  def __init__(self, session, sql_text: str):
+    self._session = session
+    self._sql_text = sql_text
+
+  def collect(self, statement_params: dict = None):
+    self._session._record_query(self._sql_text)
+    _sleep_for("query_seconds")
+    return _build_result_rows()
+
+  def to_local_iterator(self, statement_params: dict = None):
+    return iter(self.collect(statement_params))
+
+  def to_pandas_batches(self, statement_params: dict = None):
+    self._session._record_query(self._sql_text)
+    _sleep_for("query_seconds")
+    return _build_result_pandas_batches()
+
+  def collect_nowait(self, statement_params: dict = None):
+    return StandInAsyncJob(self._session._record_query(self._sql_text))
+
+class StandInCursor:
+  def __init__(self, session):
+    self._session = session
+    self._result_rows = []
+    self.sfqid = None
+    self.description = [SimpleNamespace(name="name"), SimpleNamespace(name="value")]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    pass
+
+  def execute(self, sql_text: str, **kwargs):
+    self.sfqid = self._session._record_query(sql_text)
+    _sleep_for("query_seconds")
+    self._result_rows = [tuple(result_row) for result_row in _build_result_rows()]
+    return self
+
+  def fetch_arrow_batches(self):
+    raise StandInNotSupportedError("Unsupported query result format: json")
+
+  def fetchmany(self, size: int):
+    fetched_rows, self._result_rows = self._result_rows[:size], self._result_rows[size:]
+    return fetched_rows
+
+  def fetchall(self):
+    return self.fetchmany(len(self._result_rows))
+
+class StandInFileOperation:
+  def __init__(self, session):
+    self._session = session
+
+  def put_stream(self, input_stream, stage_location: str, **kwargs):
+    self._session._record_query(f"PUT file://{stage_location.rsplit('/', 1)[-1]} {stage_location}")
+    _sleep_for("query_seconds")
+    input_stream.read()
+
+class StandInConnection:
+  def __init__(self, session):
+    self._session = session
+
+  def is_closed(self):
+    return self._session._closed
+
+  @property
+  def role(self):
+    return self._session._connection_parameters.get("role")
+
+  @property
+  def warehouse(self):
+    return self._session._connection_parameters.get("warehouse")
+
+  @property
+  def database(self):
+    return self._session._connection_parameters.get("database")
+
+  @property
+  def schema(self):
+    return self._session._connection_parameters.get("schema")
+
+  def cursor(self):
+    return StandInCursor(self._session)
+
+class StandInSession:
+  def __init__(self, connection_parameters: dict):
+    self._connection_parameters = dict(connection_parameters)
+    self._query_histories = []
+    self._closed = False
+    self.connection = StandInConnection(self)
+    self.file = StandInFileOperation(self)
+
+  def _record_query(self, sql_text: str):
+    query_id = f"stand-in-{next(_query_ids):012d}"
+
+    ### Track the context of the session from USE statements,
+    ### in the manner of the Snowflake connector
+    use_statement_match = USE_STATEMENT_PATTERN.match(sql_text)
+    if use_statement_match is not None :
+      object_name = use_statement_match.group(2)
+      self._connection_parameters[use_statement_match.group(1).lower()] = object_name[1:-1].replace('""', '"') if object_name.startswith('"') else object_name.upper()
+    for query_history in self._query_histories:
+      query_history.queries.append(QueryRecord(query_id, sql_text))
+    return query_id
+
+  def sql(self, sql_text: str):
+    return StandInDataFrame(self, sql_text)
+
+  def query_history(self):
+    return StandInQueryHistory(self)
+
+  def create_async_job(self, query_id: str):
+    return StandInAsyncJob(query_id)
+
+  def use_role(self, role: str):
+    self.sql(f"USE ROLE {role}").collect()
+
+  def use_warehouse(self, warehouse: str):
+    self.sql(f"USE WAREHOUSE {warehouse}").collect()
+
+  def get_current_account(self):
+    return self._connection_parameters.get("account")
+
+  def get_current_role(self):
+    return self._connection_parameters.get("role")
+
+  def get_current_warehouse(self):
+    return self._connection_parameters.get("warehouse")
+
+  def get_current_database(self):
+    return self._connection_parameters.get("database")
+
+  def get_current_schema(self):
+    return self._connection_parameters.get("schema")
+
+  def close(self):
+    _sleep_for("session_close_seconds")
+    self._closed = True
+
+class StandInSessionBuilder:
+  def __init__(self):
+    self._connection_parameters = {}
+
+  def configs(self, connection_parameters: dict):
+    session_builder = StandInSessionBuilder()
+    session_builder._connection_parameters = dict(connection_parameters)
+    return session_builder
+
+  def create(self):
+    _sleep_for("login_seconds")
+    return StandInSession(self._connection_parameters)
+
+StandInSession.builder = StandInSessionBuilder()
+
+## Define function to store a blob in the stand-in storage
+def upload_blob_data(storage_blob_service_uri: str, container: str, blob: str, blob_data: bytes):
+  """
+  Store the contents of a blob in the in-memory blob storage
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service
+  container -- the container name
+  blob -- the path of the blob within the container
+  blob_data -- the contents of the blob
+
+  eg: upload_blob_data(storage_blob_service_uri="https://benchmark.blob.core.windows.net", container="my-container", blob="file.json", blob_data=b"{}")
+  """
+  with _stand_in_lock:
+    _containers.add((storage_blob_service_uri.rstrip("/"), container))
+    _blobs[(storage_blob_service_uri.rstrip("/"), container, blob)] = blob_data
+
+## Define function to create a container in the stand-in storage
+def create_container(storage_blob_service_uri: str, container: str):
+  """
+  Create an empty container in the in-memory blob storage, raising ResourceExistsError if it already exists
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service
+  container -- the container name
+
+  eg: create_container(storage_blob_service_uri="https://benchmark.blob.core.windows.net", container="my-container")
+  """
+  container_key = (storage_blob_service_uri.rstrip("/"), container)
+  with _stand_in_lock:
+    if container_key in _containers :
+      raise ResourceExistsError(f"The specified container already exists: {container}")
+    _containers.add(container_key)
+
+## Define function to create a table in the stand-in storage
+def create_table(storage_table_service_uri: str, table_name: str):
+  """
+  Create an empty table in the in-memory table storage, raising ResourceExistsError if it already exists
+  Keyword arguments:
+  storage_table_service_uri -- the uri for the table storage service
+  table_name -- the name of the table
+
+  eg: create_table(storage_table_service_uri="https://benchmark.table.core.windows.net", table_name="mytable")
+  """
+  table_key = (storage_table_service_uri.rstrip("/"), table_name)
+  with _stand_in_lock:
+    if table_key in _tables :
+      raise ResourceExistsError(f"The table specified already exists: {table_name}")
+    _tables[table_key] = {}
+
+## Define function to add a message to a stand-in queue
+def enqueue_message(storage_queue_service_uri: str, queue_name: str, content):
+  """
+  Add a message to the in-memory storage queue
+  Keyword arguments:
+  storage_queue_service_uri -- the uri for the queue storage service
+  queue_name -- the name of the queue
+  content -- the content of the message
+
+  eg: enqueue_message(storage_queue_service_uri="https://benchmark.queue.core.windows.net", queue_name="my-queue", content=b"{}")
+  """
+  with _stand_in_lock:
+    _queues.setdefault((storage_queue_service_uri.rstrip("/"), queue_name), []).append(StandInQueueMessage(content))
+
+## Define function to store a secret in the stand-in key vault
+def store_secret(secret_name: str, secret_value: str):
+  """
+  Store a secret in the in-memory key vault
+  Keyword arguments:
+  secret_name -- the name of the secret
+  secret_value -- the value of the secret
+
+  eg: store_secret(secret_name="my-secret-name", secret_value="my-password")
+  """
+  with _stand_in_lock:
+    _secrets[secret_name] = secret_value
+
+## Replacements for the classes that each module imports lazily
+STAND_IN_REPLACEMENTS = {
+    "shared.snowpark_session_builders": {"Session": StandInSession}
+  , "shared.azure_credential_cache": {
+        "DefaultAzureCredential": StandInTokenCredential
+      , "ManagedIdentityCredential": StandInTokenCredential
+      , "SecretClient": StandInSecretClient
+    }
+  , "shared.blob_client_registry": {
+        "BlobServiceClient": StandInBlobServiceClient
+      , "RequestsTransport": _IgnoredObject
+      , "HTTPAdapter": _IgnoredObject
+      , "RequestsSession": _IgnoredObject
+    }
+  , "shared.async_azure_clients": {
+        "AsyncDefaultAzureCredential": AsyncStandInTokenCredential
+      , "AsyncManagedIdentityCredential": AsyncStandInTokenCredential
+      , "AsyncSecretClient": AsyncStandInSecretClient
+      , "AsyncBlobServiceClient": AsyncStandInBlobServiceClient
+    }
+  , "shared.idempotency_store": {
+        "TableClient": StandInTableClient
+      , "UpdateMode": StandInUpdateMode
+    }
+  , "shared.durable_execution": {
+        "TableClient": StandInTableClient
+      , "UpdateMode": StandInUpdateMode
+    }
+  , "shared.queue_deferral": {
+        "QueueClient": StandInQueueClient
+      , "BinaryBase64EncodePolicy": _IgnoredObject
+      , "BinaryBase64DecodePolicy": _IgnoredObject
+    }
+  , "azure_storage_queue_batch_leveraging_app_settings_directly_with_vault_secrets": {
+        "QueueClient": StandInQueueClient
+      , "BinaryBase64EncodePolicy": _IgnoredObject
+      , "BinaryBase64DecodePolicy": _IgnoredObject
+    }
+}
+
+## Define function to replace the lazily imported
+## classes of the function app with the stand-ins
+def install_stand_ins(function_app_package_name: str, latency: dict = None, result_rows: int = 10):
+  """
+  Replace the Azure and Snowpark classes used by the function app with local stand-ins
+  Keyword arguments:
+  function_app_package_name -- the name under which the function app is imported, such as "__app__"
+  latency -- the latency of each kind of round trip, as in LATENCY_PROFILES (default no latency)
+  result_rows -- the number of rows returned by every query (default 10)
+
+  eg: install_stand_ins(function_app_package_name="__app__", latency=LATENCY_PROFILES["regional"])
+  """
+  global _result_rows
+  _latency.update(latency or {})
+  _result_rows = result_rows
+  for module_name, replacements in STAND_IN_REPLACEMENTS.items():
+    try:
+      stand_in_module = importlib.import_module(f"{function_app_package_name}.{module_name}")
+    except ImportError:
+      continue
+    for attribute_name, replacement in replacements.items():
+      setattr(stand_in_module, attribute_name, replacement)
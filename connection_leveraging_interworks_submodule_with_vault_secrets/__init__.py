@@ -8,42 +8,18 @@
 import logging
 import azure.functions as func
 
-## Import other packages
-import pandas
-import json
-
 ## Import shared packages
-from ..submodules.interworks_snowpark.interworks_snowpark_python.snowpark_session_builder import build_snowpark_session_using_stored_private_key_in_azure_secrets_vault as build_snowpark_session
+from ..shared.lazy_imports import import_attribute_lazily
+from ..shared.http_trigger_processing import respond_with_database_names
+from ..shared.invocation_profiling import profile_invocation
+
+## Import heavy packages, deferred until first use
+build_snowpark_session = import_attribute_lazily("..submodules.interworks_snowpark.interworks_snowpark_python.snowpark_session_builder", "build_snowpark_session_using_stored_private_key_in_azure_secrets_vault", package=__name__)
 
 ## Define main function for Azure
+@profile_invocation
 def main(req: func.HttpRequest) -> func.HttpResponse:
   logging.info("HTTP trigger received a new request")
-  
-  try:
-
-    ### Create Snowflake Snowpark session 
-    snowpark_session = build_snowpark_session()
-
-    ### Execute a SQL command to view the databases in Snowflake
-    ### and convert the results in a pandas dataframe
-    sf_df_databases = snowpark_session.sql("SHOW DATABASES")
-    df_databases = pandas.DataFrame(data=sf_df_databases.collect())
-
-    ### Close the Snowflake Snowpark Session
-    snowpark_session.close()
-    
-    logging.info('df_databases:')
-    logging.info(df_databases)
-    
-    ### Retrieve list of database names
-    list_database_names = df_databases["name"].to_list()
-    logging.info('list_database_names:')
-    logging.info(list_database_names)
-
-    return func.HttpResponse(json.dumps(list_database_names))
 
-  except Exception as e:
-    
-    logging.info(f"Manual log - Error encountered")
-    logging.info(e)
-    return  func.HttpResponse(f"Error encountered")
\ No newline at end of file
+  ### List the databases in Snowflake in the requested format
+  return respond_with_database_names(req, build_snowpark_session)
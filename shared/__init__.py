@@ -0,0 +1,6 @@
+
+# Shared modules which are leveraged by multiple
+# Azure functions within this function app.
+# Module-level state within these modules lives
+# for the lifetime of the Python worker and is
+# therefore reused across function invocations
@@ -0,0 +1,24 @@
+
+# Retrieval of app settings shared by the functions
+# and the shared modules. App settings are read when
+# they are used rather than at import, so that a
+# changed app setting applies from the next invocation
+
+## Import other packages
+import os
+
+## Define function to retrieve an integer app setting
+## with a default if the app setting is not populated
+def retrieve_int_app_setting(app_setting_name: str, default: int):
+  """
+  Retrieve an app setting as an integer, returning the default if the app setting is not populated
+  Keyword arguments:
+  app_setting_name -- the name of the app setting
+  default -- the value to return if the app setting is missing or empty
+
+  eg: retrieve_int_app_setting(app_setting_name="SNOWFLAKE_MAX_IN_FLIGHT_PER_WAREHOUSE", default=4)
+  """
+  app_setting_value = os.getenv(app_setting_name)
+  if app_setting_value is None or len(app_setting_value) == 0 :
+    return default
+  return int(app_setting_value)
@@ -0,0 +1,138 @@
+
+# Worker-scoped asyncio clients for Azure, built on the
+# azure.identity.aio, azure.keyvault.secrets.aio and
+# azure.storage.blob.aio packages. The aio clients hold
+# connections which belong to the event loop that created
+# them, so a set of clients is kept for each event loop.
+# Secrets fetched here share the cache of the synchronous
+# clients, so a secret fetched asynchronously is served
+# from the cache when a session builder asks for it
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import asyncio
+import threading
+import weakref
+
+## Import shared packages
+from .lazy_imports import import_attribute_lazily
+from .azure_credential_cache import retrieve_key_vault_uri, retrieve_fresh_cached_key_vault_secret, store_key_vault_secret_in_cache
+from .blob_json_streaming import retrieve_blob_download_chunk_settings
+from .telemetry import timed_stage, AsyncTimedTokenCredential
+from .dependency_resilience import call_with_retries_async
+from .message_routing import retrieve_storage_account_client_id
+
+## Import heavy packages, deferred until first use
+AsyncDefaultAzureCredential = import_attribute_lazily("azure.identity.aio", "DefaultAzureCredential")
+AsyncManagedIdentityCredential = import_attribute_lazily("azure.identity.aio", "ManagedIdentityCredential")
+AsyncSecretClient = import_attribute_lazily("azure.keyvault.secrets.aio", "SecretClient")
+AsyncBlobServiceClient = import_attribute_lazily("azure.storage.blob.aio", "BlobServiceClient")
+
+## Module-level state which lives for the lifetime of the
+## worker, holding the clients for each event loop
+_async_clients_by_event_loop = weakref.WeakKeyDictionary()
+_async_clients_lock = threading.Lock()
+
+## Define function to retrieve the clients
+## belonging to the running event loop
+def _retrieve_event_loop_clients():
+  event_loop = asyncio.get_running_loop()
+  with _async_clients_lock:
+    event_loop_clients = _async_clients_by_event_loop.get(event_loop)
+    if event_loop_clients is None :
+      event_loop_clients = {"credential": None, "managed_identity_credentials": {}, "secret_clients": {}, "blob_service_clients": {}}
+      _async_clients_by_event_loop[event_loop] = event_loop_clients
+  return event_loop_clients
+
+## Define function to retrieve the aio
+## DefaultAzureCredential for the running event loop
+def retrieve_async_default_azure_credential():
+  """
+  Retrieve the aio DefaultAzureCredential for the running event loop, creating it on first use
+  """
+  event_loop_clients = _retrieve_event_loop_clients()
+  if event_loop_clients["credential"] is None :
+    logging.info(f'Manual log - Creating aio DefaultAzureCredential for event loop')
+    event_loop_clients["credential"] = AsyncTimedTokenCredential(AsyncDefaultAzureCredential())
+  return event_loop_clients["credential"]
+
+## Define function to retrieve the aio credential for a
+## user-assigned managed identity for the running event loop
+def retrieve_async_managed_identity_credential(client_id: str = None):
+  """
+  Retrieve the aio ManagedIdentityCredential for a user-assigned managed identity on the running event loop, or the aio DefaultAzureCredential if no client ID is given
+  Keyword arguments:
+  client_id -- the client ID of the user-assigned managed identity (default None)
+
+  eg: retrieve_async_managed_identity_credential(client_id=os.getenv("AZURE_STORAGE_IDENTITY__clientId"))
+  """
+  if client_id is None :
+    return retrieve_async_default_azure_credential()
+  managed_identity_credentials = _retrieve_event_loop_clients()["managed_identity_credentials"]
+  if client_id not in managed_identity_credentials :
+    logging.info(f'Manual log - Creating aio ManagedIdentityCredential for client {client_id} for event loop')
+    managed_identity_credentials[client_id] = AsyncTimedTokenCredential(AsyncManagedIdentityCredential(client_id=client_id))
+  return managed_identity_credentials[client_id]
+
+## Define function to retrieve the aio secrets
+## client for a key vault on the running event loop
+def retrieve_async_secret_client(key_vault_uri: str = None):
+  """
+  Retrieve the aio key vault secrets client for a key vault on the running event loop
+  Keyword arguments:
+  key_vault_uri -- the uri of the key vault (default the uri for the AZURE_KEY_VAULT_NAME app setting)
+
+  eg: retrieve_async_secret_client(key_vault_uri="https://my-key-vault.vault.azure.net")
+  """
+  if key_vault_uri is None :
+    key_vault_uri = retrieve_key_vault_uri()
+  secret_clients = _retrieve_event_loop_clients()["secret_clients"]
+  if key_vault_uri not in secret_clients :
+    secret_clients[key_vault_uri] = AsyncSecretClient(vault_url=key_vault_uri, credential=retrieve_async_default_azure_credential())
+  return secret_clients[key_vault_uri]
+
+## Define function to retrieve the aio blob service
+## client for a storage account on the running event loop
+def retrieve_async_blob_service_client(storage_blob_service_uri: str):
+  """
+  Retrieve the aio BlobServiceClient for a storage account on the running event loop, authenticating with the managed identity routed to the storage account, which keeps its connections between invocations
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service
+
+  eg: retrieve_async_blob_service_client(storage_blob_service_uri="https://my-storage-account.blob.core.windows.net")
+  """
+  storage_blob_service_uri = storage_blob_service_uri.rstrip("/")
+  blob_service_clients = _retrieve_event_loop_clients()["blob_service_clients"]
+  if storage_blob_service_uri not in blob_service_clients :
+    with timed_stage("blob_client_creation", storage_blob_service_uri=storage_blob_service_uri):
+      blob_service_clients[storage_blob_service_uri] = AsyncBlobServiceClient(
+          storage_blob_service_uri
+        , credential = retrieve_async_managed_identity_credential(retrieve_storage_account_client_id(storage_blob_service_uri))
+        , **retrieve_blob_download_chunk_settings()
+      )
+  return blob_service_clients[storage_blob_service_uri]
+
+## Define function to retrieve a secret from the key
+## vault asynchronously, leveraging the shared cache
+async def retrieve_key_vault_secret_async(secret_name: str, key_vault_uri: str = None):
+  """
+  Retrieve the value of a key vault secret with the aio secrets client, serving it from the shared secret cache where possible
+  Keyword arguments:
+  secret_name -- the name of the secret in the key vault
+  key_vault_uri -- the uri of the key vault (default the uri for the AZURE_KEY_VAULT_NAME app setting)
+
+  eg: await retrieve_key_vault_secret_async(secret_name="my-secret-name")
+  """
+  if key_vault_uri is None :
+    key_vault_uri = retrieve_key_vault_uri()
+  secret_value = retrieve_fresh_cached_key_vault_secret(secret_name, key_vault_uri)
+  if secret_value is not None :
+    return secret_value
+
+  secret_client = retrieve_async_secret_client(key_vault_uri)
+  with timed_stage("secret_fetch", secret_name=secret_name):
+    secret = await call_with_retries_async("key_vault", secret_client.get_secret, secret_name)
+  store_key_vault_secret_in_cache(secret_name, secret.value, key_vault_uri)
+  return secret.value
@@ -0,0 +1,212 @@
+
+# Asynchronous processing for the storage queue triggered
+# functions whose main function is a coroutine. The blob
+# download and any key vault secrets that the session builder
+# will need are fetched concurrently on the event loop, and
+# the Snowflake statements, which are executed through the
+# synchronous Snowpark API, are offloaded to a bounded thread
+# pool so that one worker can progress several messages at once
+
+## Import Azure packages
+import logging
+import azure.functions as func
+
+## Import other packages
+import asyncio
+
+## Import shared packages
+from .message_routing import route_queue_message
+from .async_azure_clients import retrieve_async_blob_service_client, retrieve_key_vault_secret_async
+from .blob_json_streaming import stream_json_values_from_blob_async
+from .sql_statement_pipeline import CONTROL_FILE_KEYS, retrieve_sql_statement_groups_to_execute
+from .result_handling import build_result_handler
+from .storage_trigger_processing import execute_sql_in_snowflake, ingest_data_files_in_snowflake
+from .snowflake_execution import submit_snowflake_execution
+from .idempotency_store import build_blob_event_idempotency_key, claim_idempotency_key, complete_idempotency_key, release_idempotency_key
+from .telemetry import timed_stage
+from .bulk_ingestion import retrieve_bulk_ingestion_route
+from .dependency_resilience import DependencyCircuitOpenError, raise_if_dependency_circuit_open
+from .queue_deferral import defer_queue_message
+from .poison_quarantine import validate_control_file_blob, is_poison_blob_error, quarantine_blob_event
+from .workload_routing import WORKLOAD_HINT_KEY, retrieve_workload_route, retrieve_workload_warehouse, build_query_tag_attributes
+
+## Define function to download a JSON file from blob asynchronously
+async def azure_download_json_file_async(storage_blob_service_uri=None, container=None, relative_file_path=None, keys_to_extract=CONTROL_FILE_KEYS):
+  """
+  Download JSON file from Azure Blob Storage with the aio blob client, extracting only the given top-level keys
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service (default None)
+  container -- the container name (default None)
+  relative_file_path -- the filepath to download from in the blob (default None)
+  keys_to_extract -- the top-level keys to extract from the JSON file (default CONTROL_FILE_KEYS)
+
+  eg: await azure_download_json_file_async(storage_blob_service_uri="https://my-storage-account.blob.core.windows.net", container="my-container", relative_file_path="my/target/file/path.json")
+  """
+  logging.info(f'Manual log - Beginning asynchronous download of JSON file')
+  try:
+    if all([storage_blob_service_uri, container, relative_file_path]):
+      blob_client = retrieve_async_blob_service_client(storage_blob_service_uri).get_blob_client(container=container, blob=relative_file_path)
+
+      ### Stream the file in chunks, only materializing
+      ### the keys that are required from the JSON
+      json_input = await stream_json_values_from_blob_async(blob_client=blob_client, keys_to_extract=keys_to_extract)
+      logging.info(f'Manual log - Concluding asynchronous download of JSON file')
+      return json_input
+    else:
+      logging.error(f'Manual log - Aborting download of JSON file as function input is missing')
+      raise ValueError('Aborting download of JSON file as function input is missing')
+
+  except Exception as e:
+    logging.error(f'Manual log - Error downloading JSON file')
+    logging.error(e)
+    raise ValueError(f"Error downloading JSON file:\n{e}\n")
+
+## Define function to stop waiting on a future whose
+## result is no longer needed, without leaving its
+## error unretrieved
+def _discard_future(future):
+  future.cancel()
+  if future.done() and not future.cancelled() :
+    future.exception()
+
+## Define function which processes a single message
+## from the storage queue on the event loop
+async def process_storage_queue_message_async(msg: func.QueueMessage, session_builder, key_vault_secret_names: list = None):
+  """
+  Download the JSON file referenced by a storage queue message and execute its SQL statements in Snowflake, without blocking the event loop
+  Keyword arguments:
+  msg -- the storage queue message containing a blob created event
+  session_builder -- a function without arguments that creates a new Snowpark session, leveraged through the session pool
+  key_vault_secret_names -- the names of key vault secrets that the session builder will need, which are fetched whilst the file downloads (default None)
+
+  eg: await process_storage_queue_message_async(msg=msg, session_builder=build_snowpark_session_using_key_vault_password, key_vault_secret_names=[os.getenv("SNOWFLAKE_PASSWORD_SECRET_NAME")])
+  """
+
+  ### Time the whole invocation, as the parent of every stage
+  with timed_stage("invocation", message_id=msg.id):
+    await _process_storage_queue_message_async(msg, session_builder, key_vault_secret_names)
+
+  return
+
+## Define function which processes a single message
+## within the span for the invocation
+async def _process_storage_queue_message_async(msg: func.QueueMessage, session_builder, key_vault_secret_names: list = None):
+
+  ### Parse the message once and route each of its events, rejecting
+  ### events for unknown storage accounts and containers
+  with timed_stage("message_parse"):
+    routed_blob_events = route_queue_message(msg)
+
+  ### Process the events in order, so that a failed event
+  ### stops the message and is retried with it, whilst
+  ### the events before it are skipped as duplicates.
+  ### Whilst Snowflake is down, the message is deferred
+  ### rather than consuming one of its dequeue attempts
+  try:
+    for routed_blob_event in routed_blob_events:
+      await _process_routed_blob_event_async(msg, routed_blob_event, session_builder, key_vault_secret_names)
+  except DependencyCircuitOpenError:
+    if not await asyncio.to_thread(defer_queue_message, msg) :
+      raise
+
+  return
+
+## Define function which processes a single routed blob event
+async def _process_routed_blob_event_async(msg: func.QueueMessage, routed_blob_event: dict, session_builder, key_vault_secret_names: list = None):
+  storage_blob_service_uri = routed_blob_event["storage_blob_service_uri"]
+  container = routed_blob_event["container"]
+  relative_file_path = routed_blob_event["relative_file_path"]
+
+  ### Skip repeated deliveries of the same blob event before any
+  ### download or Snowflake login, keeping store calls off the event
+  ### loop, and fail the message for retry whilst an earlier delivery
+  ### of the event is still in progress
+  idempotency_key = build_blob_event_idempotency_key(routed_blob_event["event_id"], routed_blob_event["etag"])
+  if not await asyncio.to_thread(claim_idempotency_key, idempotency_key) :
+    logging.info(f'Manual log - Skipping duplicate delivery of event {routed_blob_event["event_id"]} in message {msg.id}')
+    return
+
+  try:
+
+    ### Only blobs routed to the auto handler may be data files
+    bulk_ingestion_route = retrieve_bulk_ingestion_route(container, relative_file_path) if routed_blob_event["handler"] == "auto" else None
+
+    ### Fail before downloading anything or fetching secrets
+    ### whilst Snowflake is down, so that the message is deferred
+    raise_if_dependency_circuit_open("snowflake")
+
+    ### Load data files with COPY INTO on the worker-scoped thread
+    ### pool, rather than downloading them as control files
+    if bulk_ingestion_route is not None :
+      workload_route = retrieve_workload_route(container, relative_file_path)
+      await asyncio.wrap_future(submit_snowflake_execution(
+          ingest_data_files_in_snowflake
+        , session_builder
+        , bulk_ingestion_route
+        , storage_blob_service_uri
+        , container
+        , [relative_file_path]
+        , workload_route
+        , build_query_tag_attributes(msg.id, container, relative_file_path, workload_route)
+        , warehouse = retrieve_workload_warehouse(workload_route)
+      ))
+
+    else :
+
+      ### Fetch the secrets into the shared cache whilst the control
+      ### file is checked and downloaded, so that the session
+      ### builder does not need to wait on the key vault
+      secrets_future = asyncio.gather(*[retrieve_key_vault_secret_async(secret_name) for secret_name in key_vault_secret_names or []])
+
+      ### Check the control file before downloading it, keeping any
+      ### request for its properties off the event loop, then retrieve
+      ### JSON input from Azure storage and the ordered groups of SQL
+      ### statements, acknowledging a control file which can never
+      ### be processed once it has been quarantined
+      try:
+        poison_stage = "validate"
+        await asyncio.to_thread(validate_control_file_blob, routed_blob_event)
+        poison_stage = "download"
+        json_input = await azure_download_json_file_async(storage_blob_service_uri=storage_blob_service_uri, container=container, relative_file_path=relative_file_path)
+        poison_stage = "interpret"
+        sql_statement_groups_to_execute = retrieve_sql_statement_groups_to_execute(json_input)
+      except Exception as e:
+        _discard_future(secrets_future)
+        if not is_poison_blob_error(e, poison_stage) :
+          raise
+        await asyncio.to_thread(quarantine_blob_event, msg.id, routed_blob_event, poison_stage, e)
+        await asyncio.to_thread(complete_idempotency_key, idempotency_key)
+        return
+      await secrets_future
+
+      ### Build the handler for the statement results, which
+      ### may spill large results to blob storage
+      result_handler = build_result_handler(storage_blob_service_uri=storage_blob_service_uri, result_path_prefix=f"{container}/{relative_file_path}")
+
+      ### Route the statements to the warehouse and role for
+      ### their workload, tagging each with where it came from
+      workload_route = retrieve_workload_route(container, relative_file_path, json_input.get(WORKLOAD_HINT_KEY))
+
+      ### Execute the SQL in Snowflake on the worker-scoped thread pool,
+      ### within the in-flight limit for the warehouse, leaving the
+      ### event loop free for other messages
+      await asyncio.wrap_future(submit_snowflake_execution(
+          execute_sql_in_snowflake
+        , session_builder
+        , sql_statement_groups_to_execute
+        , result_handler
+        , workload_route
+        , build_query_tag_attributes(msg.id, container, relative_file_path, workload_route)
+        , idempotency_key
+        , warehouse = retrieve_workload_warehouse(workload_route)
+      ))
+
+  except Exception:
+
+    ### Release the key so that a retry of the message is processed
+    await asyncio.to_thread(release_idempotency_key, idempotency_key)
+    raise
+
+  await asyncio.to_thread(complete_idempotency_key, idempotency_key)
+
+  return
@@ -0,0 +1,213 @@
+
+# Worker-scoped cache of Azure credentials, key vault
+# clients and key vault secrets. A single credential is
+# created per worker, and secrets are memoized with a
+# configurable time-to-live and refreshed in the
+# background shortly before they expire
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import os
+import time
+import threading
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .lazy_imports import import_attribute_lazily
+from .telemetry import timed_stage, TimedTokenCredential
+from .dependency_resilience import call_with_retries
+
+## Import heavy packages, deferred until first use
+SecretClient = import_attribute_lazily("azure.keyvault.secrets", "SecretClient")
+DefaultAzureCredential = import_attribute_lazily("azure.identity", "DefaultAzureCredential")
+ManagedIdentityCredential = import_attribute_lazily("azure.identity", "ManagedIdentityCredential")
+
+## Module-level state which lives for the lifetime of the worker
+_default_azure_credential = None
+_managed_identity_credentials = {}
+_secret_clients = {}
+_cached_secrets = {}
+_refreshing_secrets = set()
+_credential_cache_lock = threading.Lock()
+
+## Define function to retrieve the single
+## DefaultAzureCredential for this worker
+def retrieve_default_azure_credential():
+  """
+  Retrieve the worker-scoped DefaultAzureCredential, creating it on first use
+  """
+  global _default_azure_credential
+  if _default_azure_credential is None :
+    with _credential_cache_lock:
+      if _default_azure_credential is None :
+        logging.info(f'Manual log - Creating worker-scoped DefaultAzureCredential')
+        _default_azure_credential = TimedTokenCredential(DefaultAzureCredential())
+  return _default_azure_credential
+
+## Define function to retrieve the credential for
+## a user-assigned managed identity for this worker
+def retrieve_managed_identity_credential(client_id: str = None):
+  """
+  Retrieve the worker-scoped ManagedIdentityCredential for a user-assigned managed identity, or the DefaultAzureCredential if no client ID is given
+  Keyword arguments:
+  client_id -- the client ID of the user-assigned managed identity (default None)
+
+  eg: retrieve_managed_identity_credential(client_id=os.getenv("AZURE_STORAGE_IDENTITY__clientId"))
+  """
+  if client_id is None :
+    return retrieve_default_azure_credential()
+  with _credential_cache_lock:
+    if client_id not in _managed_identity_credentials :
+      logging.info(f'Manual log - Creating worker-scoped ManagedIdentityCredential for client {client_id}')
+      _managed_identity_credentials[client_id] = TimedTokenCredential(ManagedIdentityCredential(client_id=client_id))
+    return _managed_identity_credentials[client_id]
+
+## Define function to convert a key vault name into a URI,
+## defaulting to the AZURE_KEY_VAULT_NAME app setting
+def retrieve_key_vault_uri(key_vault_name: str = None):
+  if key_vault_name is None :
+    key_vault_name = os.getenv("AZURE_KEY_VAULT_NAME")
+  return f"https://{key_vault_name}.vault.azure.net"
+
+## Define function to retrieve a cached
+## secrets client for the given key vault
+def retrieve_secret_client(key_vault_uri: str = None):
+  """
+  Retrieve the worker-scoped key vault secrets client for a given key vault
+  Keyword arguments:
+  key_vault_uri -- the uri of the key vault (default the uri for the AZURE_KEY_VAULT_NAME app setting)
+
+  eg: retrieve_secret_client(key_vault_uri="https://my-key-vault.vault.azure.net")
+  """
+  if key_vault_uri is None :
+    key_vault_uri = retrieve_key_vault_uri()
+  secret_client = _secret_clients.get(key_vault_uri)
+  if secret_client is None :
+    default_azure_credential = retrieve_default_azure_credential()
+    with _credential_cache_lock:
+      secret_client = _secret_clients.get(key_vault_uri)
+      if secret_client is None :
+        secret_client = SecretClient(vault_url=key_vault_uri, credential=default_azure_credential)
+        _secret_clients[key_vault_uri] = secret_client
+  return secret_client
+
+## Define function to store a secret
+## in the cache with a fresh expiry
+def store_key_vault_secret_in_cache(secret_name: str, secret_value: str, key_vault_uri: str = None):
+  """
+  Store the value of a key vault secret in the cache, for example after fetching it with an aio secret client
+  Keyword arguments:
+  secret_name -- the name of the secret in the key vault
+  secret_value -- the value of the secret
+  key_vault_uri -- the uri of the key vault (default the uri for the AZURE_KEY_VAULT_NAME app setting)
+
+  eg: store_key_vault_secret_in_cache(secret_name="my-secret-name", secret_value=secret.value)
+  """
+  if key_vault_uri is None :
+    key_vault_uri = retrieve_key_vault_uri()
+  ttl_seconds = retrieve_int_app_setting("AZURE_KEY_VAULT_SECRET_CACHE_TTL_SECONDS", 300)
+  with _credential_cache_lock:
+    _cached_secrets[(key_vault_uri, secret_name)] = {
+        "value": secret_value
+      , "expires_at": time.monotonic() + ttl_seconds
+    }
+
+## Define function to retrieve a secret from the cache
+## without fetching it, if it does not expire soon
+def retrieve_fresh_cached_key_vault_secret(secret_name: str, key_vault_uri: str = None):
+  """
+  Retrieve the cached value of a key vault secret, or None if it is missing or due to be refreshed
+  Keyword arguments:
+  secret_name -- the name of the secret in the key vault
+  key_vault_uri -- the uri of the key vault (default the uri for the AZURE_KEY_VAULT_NAME app setting)
+
+  eg: retrieve_fresh_cached_key_vault_secret(secret_name="my-secret-name")
+  """
+  if key_vault_uri is None :
+    key_vault_uri = retrieve_key_vault_uri()
+  refresh_before_seconds = retrieve_int_app_setting("AZURE_KEY_VAULT_SECRET_CACHE_REFRESH_BEFORE_SECONDS", 60)
+  with _credential_cache_lock:
+    cached_secret = _cached_secrets.get((key_vault_uri, secret_name))
+  if cached_secret is None or cached_secret["expires_at"] - time.monotonic() <= refresh_before_seconds :
+    return None
+  return cached_secret["value"]
+
+## Define function to fetch a secret from the key vault
+## and store it in the cache with a fresh expiry
+def _fetch_and_cache_key_vault_secret(key_vault_uri: str, secret_name: str):
+  secret_client = retrieve_secret_client(key_vault_uri)
+  with timed_stage("secret_fetch", secret_name=secret_name):
+    secret_value = call_with_retries("key_vault", secret_client.get_secret, secret_name).value
+  store_key_vault_secret_in_cache(secret_name, secret_value, key_vault_uri)
+  return secret_value
+
+## Define function which refreshes a secret
+## on a background thread
+def _refresh_key_vault_secret_in_background(key_vault_uri: str, secret_name: str):
+  cache_key = (key_vault_uri, secret_name)
+  try:
+    _fetch_and_cache_key_vault_secret(key_vault_uri, secret_name)
+    logging.info(f'Manual log - Refreshed cached key vault secret {secret_name} in the background')
+  except Exception as e:
+    logging.warning(f'Manual log - Error refreshing cached key vault secret {secret_name} in the background: {e}')
+  finally:
+    with _credential_cache_lock:
+      _refreshing_secrets.discard(cache_key)
+
+## Define function to retrieve a secret from the
+## key vault, leveraging the cache where possible
+def retrieve_key_vault_secret(secret_name: str, key_vault_uri: str = None):
+  """
+  Retrieve the value of a key vault secret, memoized with a time-to-live and refreshed in the background shortly before expiry
+  Keyword arguments:
+  secret_name -- the name of the secret in the key vault
+  key_vault_uri -- the uri of the key vault (default the uri for the AZURE_KEY_VAULT_NAME app setting)
+
+  eg: retrieve_key_vault_secret(secret_name="my-secret-name")
+  """
+  if key_vault_uri is None :
+    key_vault_uri = retrieve_key_vault_uri()
+  cache_key = (key_vault_uri, secret_name)
+  now = time.monotonic()
+
+  with _credential_cache_lock:
+    cached_secret = _cached_secrets.get(cache_key)
+
+  ### Fetch synchronously if the secret is missing or expired
+  if cached_secret is None or now >= cached_secret["expires_at"] :
+    return _fetch_and_cache_key_vault_secret(key_vault_uri, secret_name)
+
+  ### Start a background refresh if the secret expires soon,
+  ### while still serving the current value
+  refresh_before_seconds = retrieve_int_app_setting("AZURE_KEY_VAULT_SECRET_CACHE_REFRESH_BEFORE_SECONDS", 60)
+  if cached_secret["expires_at"] - now <= refresh_before_seconds :
+    with _credential_cache_lock:
+      start_refresh = cache_key not in _refreshing_secrets
+      _refreshing_secrets.add(cache_key)
+    if start_refresh :
+      threading.Thread(
+          target = _refresh_key_vault_secret_in_background
+        , args = (key_vault_uri, secret_name)
+        , daemon = True
+      ).start()
+
+  return cached_secret["value"]
+
+## Define function to remove a secret from the cache,
+## for example when Snowflake rejects a login using it
+def invalidate_key_vault_secret(secret_name: str, key_vault_uri: str = None):
+  """
+  Remove a secret from the cache so that it is fetched from the key vault on next use
+  Keyword arguments:
+  secret_name -- the name of the secret in the key vault
+  key_vault_uri -- the uri of the key vault (default the uri for the AZURE_KEY_VAULT_NAME app setting)
+
+  eg: invalidate_key_vault_secret(secret_name="my-secret-name")
+  """
+  if key_vault_uri is None :
+    key_vault_uri = retrieve_key_vault_uri()
+  with _credential_cache_lock:
+    _cached_secrets.pop((key_vault_uri, secret_name), None)
+  logging.info(f'Manual log - Invalidated cached key vault secret {secret_name}')
@@ -0,0 +1,183 @@
+
+# Worker-scoped registry of Azure blob storage clients.
+# Creating a BlobServiceClient for every message also
+# creates a new HTTP transport, so every download pays for
+# a fresh TLS handshake with the storage account. Instead,
+# a single BlobServiceClient is kept for each storage
+# account, backed by a shared connection pool whose
+# connections are kept alive between invocations, and a
+# ContainerClient is kept for each container
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import threading
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .lazy_imports import import_attribute_lazily
+from .azure_credential_cache import retrieve_managed_identity_credential
+from .message_routing import retrieve_storage_account_client_id
+from .blob_json_streaming import retrieve_blob_download_chunk_settings
+from .telemetry import timed_stage, register_metrics_snapshot
+
+## Import heavy packages, deferred until first use
+BlobServiceClient = import_attribute_lazily("azure.storage.blob", "BlobServiceClient")
+RequestsTransport = import_attribute_lazily("azure.core.pipeline.transport", "RequestsTransport")
+HTTPAdapter = import_attribute_lazily("requests.adapters", "HTTPAdapter")
+RequestsSession = import_attribute_lazily("requests", "Session")
+
+## Module-level state which lives for the lifetime of the worker
+_blob_service_clients = {}
+_container_clients = {}
+_http_adapters = {}
+_blob_client_registry_lock = threading.Lock()
+_blob_client_registry_metrics = {
+    "service_client_hits": 0
+  , "service_client_creates": 0
+  , "container_client_hits": 0
+  , "container_client_creates": 0
+}
+
+## Define function to build the HTTP transport for a storage
+## account, with a connection pool that outlives the invocation
+def _build_pooled_transport(storage_blob_service_uri: str):
+  connection_pool_size = retrieve_int_app_setting("AZURE_STORAGE_CONNECTION_POOL_SIZE", 16)
+
+  ### Keep up to connection_pool_size connections to the
+  ### storage account alive between requests
+  http_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connection_pool_size)
+  requests_session = RequestsSession()
+  requests_session.mount("https://", http_adapter)
+  requests_session.mount("http://", http_adapter)
+  _http_adapters[storage_blob_service_uri] = http_adapter
+
+  return RequestsTransport(
+      session = requests_session
+    , session_owner = False
+    , connection_timeout = retrieve_int_app_setting("AZURE_STORAGE_CONNECTION_TIMEOUT_SECONDS", 20)
+    , read_timeout = retrieve_int_app_setting("AZURE_STORAGE_READ_TIMEOUT_SECONDS", 60)
+  )
+
+## Define function to retrieve the shared
+## client for a storage account
+def retrieve_blob_service_client(storage_blob_service_uri: str):
+  """
+  Retrieve the worker-scoped BlobServiceClient for a storage account, creating it with a pooled transport and the managed identity routed to the storage account on first use
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service
+
+  eg: retrieve_blob_service_client(storage_blob_service_uri="https://my-storage-account.blob.core.windows.net")
+  """
+  storage_blob_service_uri = storage_blob_service_uri.rstrip("/")
+  with _blob_client_registry_lock:
+    blob_service_client = _blob_service_clients.get(storage_blob_service_uri)
+    if blob_service_client is not None :
+      _blob_client_registry_metrics["service_client_hits"] += 1
+      return blob_service_client
+
+    logging.info(f'Manual log - Creating worker-scoped blob service client for {storage_blob_service_uri}')
+    with timed_stage("blob_client_creation", storage_blob_service_uri=storage_blob_service_uri):
+      blob_service_client = BlobServiceClient(
+          storage_blob_service_uri
+        , credential = retrieve_managed_identity_credential(retrieve_storage_account_client_id(storage_blob_service_uri))
+        , transport = _build_pooled_transport(storage_blob_service_uri)
+        , **retrieve_blob_download_chunk_settings()
+      )
+    _blob_service_clients[storage_blob_service_uri] = blob_service_client
+    _blob_client_registry_metrics["service_client_creates"] += 1
+    return blob_service_client
+
+## Define function to retrieve the shared
+## client for a container
+def retrieve_container_client(storage_blob_service_uri: str, container: str):
+  """
+  Retrieve the worker-scoped ContainerClient for a container, which shares the pooled transport of its storage account
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service
+  container -- the container name
+
+  eg: retrieve_container_client(storage_blob_service_uri="https://my-storage-account.blob.core.windows.net", container="my-container")
+  """
+  container_key = (storage_blob_service_uri.rstrip("/"), container)
+  with _blob_client_registry_lock:
+    container_client = _container_clients.get(container_key)
+    if container_client is not None :
+      _blob_client_registry_metrics["container_client_hits"] += 1
+      return container_client
+
+  blob_service_client = retrieve_blob_service_client(storage_blob_service_uri)
+  with _blob_client_registry_lock:
+    container_client = _container_clients.get(container_key)
+    if container_client is None :
+      container_client = blob_service_client.get_container_client(container)
+      _container_clients[container_key] = container_client
+      _blob_client_registry_metrics["container_client_creates"] += 1
+  return container_client
+
+## Define function to retrieve a client for a single
+## blob, which shares the pooled transport
+def retrieve_blob_client(storage_blob_service_uri: str, container: str, blob: str):
+  """
+  Retrieve a BlobClient which shares the pooled transport of its storage account
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service
+  container -- the container name
+  blob -- the path of the blob within the container
+
+  eg: retrieve_blob_client(storage_blob_service_uri="https://my-storage-account.blob.core.windows.net", container="my-container", blob="my/target/file/path.json")
+  """
+  return retrieve_container_client(storage_blob_service_uri, container).get_blob_client(blob)
+
+## Define function to summarize the utilization
+## of the connection pool for a storage account
+def _summarize_connection_pool(http_adapter):
+  connection_pool_metrics = {
+      "connections_created": 0
+    , "requests": 0
+    , "connections_idle": 0
+    , "connections_in_use": 0
+    , "max_connections": 0
+  }
+  pool_manager = http_adapter.poolmanager
+  for pool_key in list(pool_manager.pools.keys()):
+    connection_pool = pool_manager.pools.get(pool_key)
+    if connection_pool is None or connection_pool.pool is None :
+      continue
+
+    ### The queue holds idle connections and empty slots, so
+    ### any slot missing from the queue is checked out
+    queued_connections = list(connection_pool.pool.queue)
+    connection_pool_metrics["connections_created"] += connection_pool.num_connections
+    connection_pool_metrics["requests"] += connection_pool.num_requests
+    connection_pool_metrics["connections_idle"] += sum(1 for queued_connection in queued_connections if queued_connection is not None)
+    connection_pool_metrics["connections_in_use"] += connection_pool.pool.maxsize - len(queued_connections)
+    connection_pool_metrics["max_connections"] += connection_pool.pool.maxsize
+  return connection_pool_metrics
+
+## Define function to retrieve a snapshot of the
+## registry and connection pool metrics
+def retrieve_blob_client_registry_metrics():
+  """
+  Retrieve a snapshot of the client registry counters and the connection pool utilization for each storage account
+
+  The number of requests which reused an existing connection is the number of
+  requests minus the number of connections created, per storage account.
+  """
+  with _blob_client_registry_lock:
+    blob_client_registry_metrics = dict(_blob_client_registry_metrics)
+    http_adapters = dict(_http_adapters)
+  blob_client_registry_metrics["connection_pools"] = {
+      storage_blob_service_uri: _summarize_connection_pool(http_adapter)
+      for storage_blob_service_uri, http_adapter in http_adapters.items()
+  }
+  return blob_client_registry_metrics
+
+## Export the registry counters and, for each storage
+## account, the utilization of its connection pool
+def _retrieve_connection_pool_metrics():
+  return retrieve_blob_client_registry_metrics()["connection_pools"]
+
+register_metrics_snapshot("blob_client_registry", retrieve_blob_client_registry_metrics, "Blob storage client registry hit and creation counters")
+register_metrics_snapshot("blob_connection_pools", _retrieve_connection_pool_metrics, "Connection pool utilization for each storage account", ("storage_account",))
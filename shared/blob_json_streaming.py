@@ -0,0 +1,267 @@
+
+# Streaming extraction of values from JSON files in
+# Azure blob storage. The blob is downloaded in chunks
+# which feed an incremental JSON parser, and only the
+# requested top-level keys are materialized, so memory
+# use stays bounded regardless of the size of the file.
+# The download stops as soon as every requested key
+# has been found. Since downloading and parsing are
+# interleaved, the time spent waiting for chunks is
+# recorded as the download stage and the remainder
+# as the json_parse stage. A download which fails
+# transiently is retried from the start of the blob
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import time
+import ijson
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .telemetry import timed_stage, record_stage_duration
+from .dependency_resilience import call_with_retries, call_with_retries_async
+
+## Define an error for a JSON file which is not an object
+class JSONNotObjectError(ValueError):
+  """
+  Raised when a JSON file is valid JSON but its top-level value is not an object
+  """
+
+## Define a read-only file-like object
+## over an iterator of downloaded chunks
+class BlobChunkStream:
+  """
+  File-like wrapper which serves reads from an iterator of bytes chunks, such as download_blob().chunks()
+  """
+  def __init__(self, chunk_iterator):
+    self._chunk_iterator = iter(chunk_iterator)
+    self._current_chunk = b""
+    self._offset = 0
+    self.download_seconds = 0.0
+
+  def _next_chunk(self):
+    download_start = time.perf_counter()
+    try:
+      return next(self._chunk_iterator, None)
+    finally:
+      self.download_seconds += time.perf_counter() - download_start
+
+  def read(self, size: int = -1):
+
+    ### Read everything which remains if no size is given
+    if size is None or size < 0 :
+      remaining_chunks = [self._current_chunk[self._offset:]]
+      for next_chunk in iter(self._next_chunk, None):
+        remaining_chunks.append(next_chunk)
+      self._current_chunk, self._offset = b"", 0
+      return b"".join(remaining_chunks)
+
+    ### Move on to the next chunk once the current one is
+    ### exhausted, returning no data at the end of the blob
+    while self._offset >= len(self._current_chunk) :
+      next_chunk = self._next_chunk()
+      if next_chunk is None :
+        return b""
+      self._current_chunk, self._offset = next_chunk, 0
+
+    ### Serve the read from the current chunk only, which
+    ### avoids copying chunks into a growing buffer
+    data = self._current_chunk[self._offset:self._offset + size]
+    self._offset += len(data)
+    return data
+
+## Define an asynchronous read-only file-like object
+## over an asynchronous iterator of downloaded chunks
+class AsyncBlobChunkStream:
+  """
+  Asynchronous file-like wrapper which serves reads from an asynchronous iterator of bytes chunks, such as the chunks() of an aio download_blob()
+  """
+  def __init__(self, chunk_iterator):
+    self._chunk_iterator = chunk_iterator.__aiter__()
+    self._current_chunk = b""
+    self._offset = 0
+    self.download_seconds = 0.0
+
+  async def _next_chunk(self):
+    download_start = time.perf_counter()
+    try:
+      return await self._chunk_iterator.__anext__()
+    except StopAsyncIteration:
+      return None
+    finally:
+      self.download_seconds += time.perf_counter() - download_start
+
+  async def read(self, size: int = -1):
+
+    ### Read everything which remains if no size is given
+    if size is None or size < 0 :
+      remaining_chunks = [self._current_chunk[self._offset:]]
+      next_chunk = await self._next_chunk()
+      while next_chunk is not None :
+        remaining_chunks.append(next_chunk)
+        next_chunk = await self._next_chunk()
+      self._current_chunk, self._offset = b"", 0
+      return b"".join(remaining_chunks)
+
+    ### Move on to the next chunk once the current one is
+    ### exhausted, returning no data at the end of the blob
+    while self._offset >= len(self._current_chunk) :
+      next_chunk = await self._next_chunk()
+      if next_chunk is None :
+        return b""
+      self._current_chunk, self._offset = next_chunk, 0
+
+    ### Serve the read from the current chunk only
+    data = self._current_chunk[self._offset:self._offset + size]
+    self._offset += len(data)
+    return data
+
+## Define function to retrieve the keyword arguments which
+## bound the size of each request made by a blob download
+def retrieve_blob_download_chunk_settings():
+  """
+  Retrieve keyword arguments for BlobServiceClient which bound the size of each downloaded chunk
+  """
+  download_chunk_size_bytes = retrieve_int_app_setting("AZURE_STORAGE_DOWNLOAD_CHUNK_SIZE_BYTES", 1024 * 1024)
+  return {
+      "max_single_get_size": download_chunk_size_bytes
+    , "max_chunk_get_size": download_chunk_size_bytes
+  }
+
+## Define a consumer of JSON parser events which
+## builds only the requested top-level values
+class _TopLevelJsonValueExtractor:
+  def __init__(self, keys_to_extract):
+    self.remaining_keys = set(keys_to_extract)
+    self.extracted_values = {}
+    self._current_key = None
+    self._value_builder = None
+    self._value_depth = 0
+
+  ### Consume a single parser event, returning True
+  ### once every requested key has been extracted
+  def consume(self, prefix: str, event: str, value):
+
+    #### Error if the document is not a JSON object
+    if prefix == "" and event not in ("start_map", "map_key", "end_map") :
+      raise JSONNotObjectError("JSON file is not an object")
+
+    #### Begin building a value when a requested key is found
+    if self._value_builder is None :
+      if prefix == "" and event == "map_key" and value in self.remaining_keys :
+        self._current_key = value
+        self._value_builder = ijson.ObjectBuilder()
+        self._value_depth = 0
+      return False
+
+    #### Feed the events for the requested value into the builder
+    self._value_builder.event(event, value)
+    if event in ("start_map", "start_array") :
+      self._value_depth += 1
+    elif event in ("end_map", "end_array") :
+      self._value_depth -= 1
+
+    #### Store the value once it is complete
+    if self._value_depth == 0 :
+      self.extracted_values[self._current_key] = self._value_builder.value
+      self.remaining_keys.discard(self._current_key)
+      self._value_builder = None
+    return len(self.remaining_keys) == 0
+
+## Define function to extract top-level values
+## from a stream of JSON without parsing the rest
+def extract_top_level_json_values(json_stream, keys_to_extract):
+  """
+  Extract the values of the given top-level keys from a JSON object in a stream, only materializing those values
+  Keyword arguments:
+  json_stream -- a file-like object containing a JSON object
+  keys_to_extract -- the top-level keys whose values should be extracted
+
+  Returns a dictionary containing only the requested keys which were present in the JSON object
+
+  eg: extract_top_level_json_values(json_stream=BlobChunkStream(blob_client.download_blob().chunks()), keys_to_extract=["sql_statement_to_execute"])
+  """
+  value_extractor = _TopLevelJsonValueExtractor(keys_to_extract)
+  for prefix, event, value in ijson.parse(json_stream):
+    if value_extractor.consume(prefix, event, value) :
+      break
+  return value_extractor.extracted_values
+
+## Define function to extract top-level values from
+## an asynchronous stream of JSON without parsing the rest
+async def extract_top_level_json_values_async(json_stream, keys_to_extract):
+  """
+  Extract the values of the given top-level keys from a JSON object in an asynchronous stream, only materializing those values
+  Keyword arguments:
+  json_stream -- an asynchronous file-like object containing a JSON object, whose read method is a coroutine
+  keys_to_extract -- the top-level keys whose values should be extracted
+
+  eg: await extract_top_level_json_values_async(json_stream=AsyncBlobChunkStream(blob_downloader.chunks()), keys_to_extract=["sql_statement_to_execute"])
+  """
+  value_extractor = _TopLevelJsonValueExtractor(keys_to_extract)
+  async for prefix, event, value in ijson.parse_async(json_stream):
+    if value_extractor.consume(prefix, event, value) :
+      break
+  return value_extractor.extracted_values
+
+## Define function to record the time spent waiting for
+## chunks as the download and the remainder as the parse
+def _record_download_and_parse_durations(stage_attributes: dict, json_stream, stream_seconds: float, blob_size: int):
+  json_parse_seconds = max(0.0, stream_seconds - json_stream.download_seconds)
+  record_stage_duration("download", json_stream.download_seconds)
+  record_stage_duration("json_parse", json_parse_seconds)
+  stage_attributes["blob_size_bytes"] = blob_size
+  stage_attributes["download_seconds"] = json_stream.download_seconds
+  stage_attributes["json_parse_seconds"] = json_parse_seconds
+
+## Define function to stream a JSON file from a blob
+## and extract the requested top-level values
+def stream_json_values_from_blob(blob_client, keys_to_extract):
+  """
+  Download a JSON file from Azure Blob Storage in chunks and extract the values of the given top-level keys
+  Keyword arguments:
+  blob_client -- the blob client for the JSON file
+  keys_to_extract -- the top-level keys whose values should be extracted
+
+  eg: stream_json_values_from_blob(blob_client=blob_client, keys_to_extract=["sql_statement_to_execute"])
+  """
+  def stream_json_values(stage_attributes: dict):
+    stream_start = time.perf_counter()
+    blob_downloader = blob_client.download_blob()
+    json_stream = BlobChunkStream(blob_downloader.chunks())
+    json_stream.download_seconds = time.perf_counter() - stream_start
+    extracted_values = extract_top_level_json_values(json_stream, keys_to_extract)
+    _record_download_and_parse_durations(stage_attributes, json_stream, time.perf_counter() - stream_start, blob_downloader.size)
+    return blob_downloader, extracted_values
+
+  with timed_stage("blob_json_stream", blob_name=blob_client.blob_name) as stage_attributes:
+    blob_downloader, extracted_values = call_with_retries("blob_storage", stream_json_values, stage_attributes)
+  logging.info(f'Manual log - Extracted {len(extracted_values)} of {len(keys_to_extract)} requested keys from JSON file of {blob_downloader.size} bytes')
+  return extracted_values
+
+## Define function to stream a JSON file from a blob
+## asynchronously and extract the requested top-level values
+async def stream_json_values_from_blob_async(blob_client, keys_to_extract):
+  """
+  Download a JSON file from Azure Blob Storage in chunks with an aio blob client and extract the values of the given top-level keys
+  Keyword arguments:
+  blob_client -- the azure.storage.blob.aio blob client for the JSON file
+  keys_to_extract -- the top-level keys whose values should be extracted
+
+  eg: await stream_json_values_from_blob_async(blob_client=blob_client, keys_to_extract=["sql_statement_to_execute"])
+  """
+  async def stream_json_values(stage_attributes: dict):
+    stream_start = time.perf_counter()
+    blob_downloader = await blob_client.download_blob()
+    json_stream = AsyncBlobChunkStream(blob_downloader.chunks())
+    json_stream.download_seconds = time.perf_counter() - stream_start
+    extracted_values = await extract_top_level_json_values_async(json_stream, keys_to_extract)
+    _record_download_and_parse_durations(stage_attributes, json_stream, time.perf_counter() - stream_start, blob_downloader.size)
+    return blob_downloader, extracted_values
+
+  with timed_stage("blob_json_stream", blob_name=blob_client.blob_name) as stage_attributes:
+    blob_downloader, extracted_values = await call_with_retries_async("blob_storage", stream_json_values, stage_attributes)
+  logging.info(f'Manual log - Extracted {len(extracted_values)} of {len(keys_to_extract)} requested keys from JSON file of {blob_downloader.size} bytes')
+  return extracted_values
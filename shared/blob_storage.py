@@ -0,0 +1,96 @@
+
+# Blob storage access shared by the storage triggered
+# functions: parsing the blob referenced by a storage
+# queue message, retrieving blob clients and downloading
+# the JSON control files
+
+## Import Azure packages
+import logging
+import azure.functions as func
+
+## Import shared packages
+from .blob_client_registry import retrieve_blob_client
+from .blob_json_streaming import stream_json_values_from_blob
+from .sql_statement_pipeline import CONTROL_FILE_KEYS
+from .message_routing import route_queue_message
+
+## Define function to retrieve the desired
+## information from the input message
+def parse_input_message(msg: func.QueueMessage):
+  """
+  Retrieve the storage blob service uri, container and relative file path of the blob referenced by a storage queue message
+  Keyword arguments:
+  msg -- the storage queue message containing a blob created event
+
+  Messages are routed by shared/message_routing.py, which also supports batched
+  events and several storage accounts. This returns the first routed event, and
+  raises a ValueError if no event is for a known storage account and container
+
+  eg: storage_blob_service_uri, container, relative_file_path = parse_input_message(msg=msg)
+  """
+  routed_blob_events = route_queue_message(msg)
+  if len(routed_blob_events) == 0 :
+    logging.error(f'Function abort - Path URL does not match a known storage account and container')
+    raise ValueError("Function abort - Path URL does not match a known storage account and container")
+  routed_blob_event = routed_blob_events[0]
+  return routed_blob_event["storage_blob_service_uri"], routed_blob_event["container"], routed_blob_event["relative_file_path"]
+
+## Define generic function to create an Azure blob storage client
+def azure_retrieve_blob_client(storage_blob_service_uri=None, container=None, target_file_path=None):
+  """
+  Retrieve an Azure blob client object
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service (default None)
+  container -- the container name (default None)
+  target_file_path -- the filepath to that will be leveraged by the blob client (default None)
+
+  eg: azure_retrieve_blob_client(storage_blob_service_uri="https://my-storage-account.blob.core.windows.net", container="my-container", target_file_path="my/target/file/path.json")
+  """
+  logging.info(f'Manual log - Beginning retrieval of blob client')
+  try:
+    if all([storage_blob_service_uri, container, target_file_path]):
+
+      ### Leverage the worker-scoped client for the storage account,
+      ### which reuses connections from previous invocations
+      blob_client = retrieve_blob_client(storage_blob_service_uri, container, target_file_path)
+      logging.info(f'Manual log - Concluded retrieval of blob client')
+      return blob_client
+    else:
+      logging.error(f'Manual log - Aborting retrieval of blob client as function input is missing')
+      raise ValueError('Aborting retrieval of blob client as function input is missing')
+
+  except Exception as e:
+    logging.error(f'Manual log - Error retrieving blob client')
+    logging.error(e)
+    raise ValueError(f"Error retrieving blob client:\n{e}\n")
+
+## Define function to download full JSON file from blob
+def azure_download_json_file(storage_blob_service_uri=None, container=None, relative_file_path=None, keys_to_extract=CONTROL_FILE_KEYS):
+  """
+  Download JSON file from Azure Blob Storage for given container, extracting only the given top-level keys
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service (default None)
+  container -- the container name (default None)
+  relative_file_path -- the filepath to download from in the blob (default None)
+  keys_to_extract -- the top-level keys to extract from the JSON file (default CONTROL_FILE_KEYS)
+
+  eg: azure_download_json_file(storage_blob_service_uri="https://my-storage-account.blob.core.windows.net", container="my-container", relative_file_path="my/target/file/path.json")
+  """
+  logging.info(f'Manual log - Beginning download of JSON file')
+  try:
+    if all([storage_blob_service_uri, container, relative_file_path]):
+      blob_client = azure_retrieve_blob_client(storage_blob_service_uri=storage_blob_service_uri, container=container, target_file_path=relative_file_path)
+
+      ### Stream the file in chunks, only materializing
+      ### the keys that are required from the JSON
+      json_input = stream_json_values_from_blob(blob_client=blob_client, keys_to_extract=keys_to_extract)
+      logging.info(f'Manual log - Concluding download of JSON file')
+      return json_input
+    else:
+      logging.error(f'Manual log - Aborting download of JSON file as function input is missing')
+      raise ValueError('Aborting download of JSON file as function input is missing')
+
+  except Exception as e:
+    logging.error(f'Manual log - Error downloading JSON file')
+    logging.error(e)
+    raise ValueError(f"Error downloading JSON file:\n{e}\n")
@@ -0,0 +1,250 @@
+
+# Bulk ingestion of data files landed in blob storage.
+# Blobs which match a route in the BULK_INGESTION_ROUTES
+# app setting are treated as data files rather than JSON
+# control files: each is either uploaded to an internal
+# stage with a PUT, or referenced through an external stage
+# over its container, and is loaded into the target table
+# of its route with COPY INTO. Files for the same route are
+# loaded by a single COPY, so that the batch function can
+# load many small files in one statement
+#
+# Expected format of the BULK_INGESTION_ROUTES app setting:
+#   [
+#     {
+#         "container": "landing"
+#       , "path_prefix": "sales/"
+#       , "file_extensions": [".csv", ".csv.gz"]
+#       , "target_table": "RAW.SALES.ORDERS"
+#       , "internal_stage": "@RAW.SALES.LANDING_STAGE"
+#       , "file_format": "TYPE = CSV SKIP_HEADER = 1"
+#       , "copy_options": "ON_ERROR = ABORT_STATEMENT"
+#     }
+#   ]
+#
+# where a route may give "external_stage" in place of
+# "internal_stage" for an external stage whose URL is the
+# root of the container, and "path_prefix",
+# "file_extensions", "file_format" and "copy_options" are
+# optional. The first route which matches a blob is used
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import os
+import json
+import tempfile
+import threading
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .blob_client_registry import retrieve_blob_client
+from .telemetry import timed_stage
+from .workload_routing import build_statement_params
+from .dependency_resilience import call_with_retries
+
+## Snowflake limits a single COPY to 1,000 named files
+MAX_FILES_PER_COPY = 1000
+
+## File formats used when a route does not give
+## one, based on the extension of the data file
+DEFAULT_FILE_FORMATS = {
+    ".csv": "TYPE = CSV"
+  , ".csv.gz": "TYPE = CSV"
+  , ".tsv": "TYPE = CSV FIELD_DELIMITER = '\\t'"
+  , ".parquet": "TYPE = PARQUET"
+  , ".json": "TYPE = JSON"
+  , ".json.gz": "TYPE = JSON"
+  , ".jsonl": "TYPE = JSON"
+  , ".ndjson": "TYPE = JSON"
+}
+
+## Statuses reported by COPY for files which were not fully loaded
+FAILED_COPY_STATUSES = ("LOAD_FAILED", "PARTIALLY_LOADED")
+
+## Module-level state which lives for the lifetime of the worker
+_parsed_routes = {"app_setting_value": None, "routes": []}
+_bulk_ingestion_lock = threading.Lock()
+
+## Define function to validate a single route
+def _validate_bulk_ingestion_route(route_number: int, bulk_ingestion_route: dict):
+  for required_key in ("container", "target_table"):
+    if not isinstance(bulk_ingestion_route.get(required_key), str) or len(bulk_ingestion_route[required_key]) == 0 :
+      raise ValueError(f"Bulk ingestion route {route_number} does not contain a '{required_key}'")
+  if ("internal_stage" in bulk_ingestion_route) == ("external_stage" in bulk_ingestion_route) :
+    raise ValueError(f"Bulk ingestion route {route_number} must contain exactly one of 'internal_stage' or 'external_stage'")
+  return {
+      "route_name": bulk_ingestion_route.get("route_name", f"route_{route_number}")
+    , "path_prefix": ""
+    , "file_extensions": []
+    , "file_format": None
+    , "copy_options": ""
+    , **bulk_ingestion_route
+  }
+
+## Define function to retrieve the routes, parsing
+## the app setting again only if it has changed
+def retrieve_bulk_ingestion_routes():
+  """
+  Retrieve the validated routes from the BULK_INGESTION_ROUTES app setting, which is empty if the app setting is not populated
+  """
+  app_setting_value = os.getenv("BULK_INGESTION_ROUTES") or ""
+  with _bulk_ingestion_lock:
+    if _parsed_routes["app_setting_value"] != app_setting_value :
+      bulk_ingestion_routes = json.loads(app_setting_value) if len(app_setting_value.strip()) > 0 else []
+      if not isinstance(bulk_ingestion_routes, list) :
+        raise ValueError("The BULK_INGESTION_ROUTES app setting must be a JSON array of routes")
+      _parsed_routes["routes"] = [
+          _validate_bulk_ingestion_route(route_number, bulk_ingestion_route)
+          for route_number, bulk_ingestion_route in enumerate(bulk_ingestion_routes, start=1)
+      ]
+      _parsed_routes["app_setting_value"] = app_setting_value
+    return _parsed_routes["routes"]
+
+## Define function to find the route for a blob
+def retrieve_bulk_ingestion_route(container: str, relative_file_path: str):
+  """
+  Retrieve the first bulk ingestion route which matches a blob, or None if the blob is a JSON control file
+  Keyword arguments:
+  container -- the container name
+  relative_file_path -- the path of the blob within the container
+
+  eg: retrieve_bulk_ingestion_route(container="landing", relative_file_path="sales/2024-01-01.csv")
+  """
+  lowercase_file_path = relative_file_path.lower()
+  for bulk_ingestion_route in retrieve_bulk_ingestion_routes():
+    if bulk_ingestion_route["container"] != container :
+      continue
+    if not relative_file_path.startswith(bulk_ingestion_route["path_prefix"]) :
+      continue
+    if len(bulk_ingestion_route["file_extensions"]) > 0 and not lowercase_file_path.endswith(tuple(file_extension.lower() for file_extension in bulk_ingestion_route["file_extensions"])) :
+      continue
+    return bulk_ingestion_route
+  return None
+
+## Define function to determine the file format
+## for a route and the files that it loads
+def _retrieve_file_format(bulk_ingestion_route: dict, relative_file_paths: list):
+  if bulk_ingestion_route["file_format"] is not None :
+    return bulk_ingestion_route["file_format"]
+  for file_extension in sorted(DEFAULT_FILE_FORMATS, key=len, reverse=True):
+    if relative_file_paths[0].lower().endswith(file_extension) :
+      return DEFAULT_FILE_FORMATS[file_extension]
+  raise ValueError(f"Bulk ingestion route {bulk_ingestion_route['route_name']} does not give a 'file_format' and one cannot be inferred for {relative_file_paths[0]}")
+
+## Define function to quote a file path for the FILES clause
+def _quote_file_path(relative_file_path: str):
+  return "'" + relative_file_path.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+## Define function to upload a blob to an internal stage
+def upload_blob_to_internal_stage(snowpark_session, storage_blob_service_uri: str, container: str, relative_file_path: str, internal_stage: str):
+  """
+  Download a blob into a spooled temporary file and upload it to an internal stage with a parallel PUT, keeping its path within the container
+  Keyword arguments:
+  snowpark_session -- the Snowpark session with which to upload the file
+  storage_blob_service_uri -- the uri for the blob storage service
+  container -- the container name
+  relative_file_path -- the path of the blob within the container
+  internal_stage -- the internal stage, such as "@RAW.SALES.LANDING_STAGE"
+
+  eg: upload_blob_to_internal_stage(snowpark_session=snowpark_session, storage_blob_service_uri="https://my-storage-account.blob.core.windows.net", container="landing", relative_file_path="sales/2024-01-01.csv", internal_stage="@RAW.SALES.LANDING_STAGE")
+  """
+  upload_parallelism = retrieve_int_app_setting("BULK_INGESTION_UPLOAD_PARALLELISM", 4)
+  spool_max_memory_bytes = retrieve_int_app_setting("BULK_INGESTION_SPOOL_MAX_MEMORY_BYTES", 64 * 1024 * 1024)
+
+  ### PUT needs a seekable stream, so the blob is downloaded in
+  ### parallel chunks into memory, spilling to disk if it is large
+  with tempfile.SpooledTemporaryFile(max_size=spool_max_memory_bytes) as spooled_file:
+    def download_into_spooled_file():
+      spooled_file.seek(0)
+      spooled_file.truncate()
+      return blob_client.download_blob(max_concurrency=upload_parallelism).readinto(spooled_file)
+
+    with timed_stage("data_file_download", relative_file_path=relative_file_path) as download_attributes:
+      blob_client = retrieve_blob_client(storage_blob_service_uri, container, relative_file_path)
+      download_attributes["blob_size_bytes"] = call_with_retries("blob_storage", download_into_spooled_file)
+    spooled_file.seek(0)
+
+    ### Files are not compressed on upload, so that the
+    ### staged file keeps the name given in the FILES clause
+    with timed_stage("stage_upload", relative_file_path=relative_file_path, stage=internal_stage):
+      snowpark_session.file.put_stream(
+          spooled_file
+        , f"{internal_stage.rstrip('/')}/{container}/{relative_file_path}"
+        , parallel = upload_parallelism
+        , auto_compress = False
+        , overwrite = True
+      )
+
+  return
+
+## Define function to load data files with COPY INTO
+def copy_data_files_into_table(snowpark_session, bulk_ingestion_route: dict, container: str, relative_file_paths: list, query_tag_attributes: dict = None):
+  """
+  Load staged data files into the target table of their route, issuing one COPY INTO for every MAX_FILES_PER_COPY files
+  Keyword arguments:
+  snowpark_session -- the Snowpark session on which to execute the COPY
+  bulk_ingestion_route -- the route for the files, as returned by retrieve_bulk_ingestion_route
+  container -- the container name
+  relative_file_paths -- the paths of the files within the container
+  query_tag_attributes -- the attributes of the QUERY_TAG set on each COPY, as returned by build_query_tag_attributes (default None)
+
+  Returns the rows reported by COPY for each file, and raises a ValueError
+  naming any file which was not fully loaded
+
+  eg: copy_data_files_into_table(snowpark_session=snowpark_session, bulk_ingestion_route=bulk_ingestion_route, container="landing", relative_file_paths=["sales/2024-01-01.csv"])
+  """
+
+  ### Files uploaded to an internal stage are kept beneath
+  ### the name of their container, whereas an external stage
+  ### is expected to point at the root of the container
+  if "internal_stage" in bulk_ingestion_route :
+    stage_location = f"{bulk_ingestion_route['internal_stage'].rstrip('/')}/{container}/"
+  else :
+    stage_location = f"{bulk_ingestion_route['external_stage'].rstrip('/')}/"
+  file_format = _retrieve_file_format(bulk_ingestion_route, relative_file_paths)
+
+  copy_results = []
+  max_files_per_copy = min(MAX_FILES_PER_COPY, retrieve_int_app_setting("BULK_INGESTION_MAX_FILES_PER_COPY", MAX_FILES_PER_COPY))
+  for batch_number, batch_start in enumerate(range(0, len(relative_file_paths), max_files_per_copy), start=1):
+    batch_file_paths = relative_file_paths[batch_start:batch_start + max_files_per_copy]
+    copy_statement = (
+        f"COPY INTO {bulk_ingestion_route['target_table']}"
+      + f" FROM {stage_location}"
+      + f" FILES = ({', '.join(_quote_file_path(relative_file_path) for relative_file_path in batch_file_paths)})"
+      + f" FILE_FORMAT = ({file_format})"
+      + (f" {bulk_ingestion_route['copy_options']}" if len(bulk_ingestion_route["copy_options"]) > 0 else "")
+    )
+    with timed_stage("copy_into", target_table=bulk_ingestion_route["target_table"], file_count=len(batch_file_paths)):
+      copy_results.extend(result_row.as_dict() for result_row in snowpark_session.sql(copy_statement).collect(statement_params=build_statement_params(query_tag_attributes, batch_number)))
+
+  ### Files already loaded within the last 64 days are skipped
+  ### by COPY, so retrying a batch only loads the failed files
+  failed_copy_results = [copy_result for copy_result in copy_results if str(copy_result.get("status", "")).upper() in FAILED_COPY_STATUSES]
+  if len(failed_copy_results) > 0 :
+    for failed_copy_result in failed_copy_results:
+      logging.error(f'Manual log - Failed to load {failed_copy_result.get("file")}: {failed_copy_result.get("first_error")}')
+    raise ValueError(f"Failed to load {len(failed_copy_results)} of {len(relative_file_paths)} files into {bulk_ingestion_route['target_table']}")
+
+  logging.info(f'Manual log - Loaded {len(relative_file_paths)} files into {bulk_ingestion_route["target_table"]} with route {bulk_ingestion_route["route_name"]}')
+  return copy_results
+
+## Define function to stage and load data files
+def ingest_data_files(snowpark_session, bulk_ingestion_route: dict, storage_blob_service_uri: str, container: str, relative_file_paths: list, query_tag_attributes: dict = None):
+  """
+  Upload data files to the internal stage of their route if it has one, then load them into its target table with COPY INTO
+  Keyword arguments:
+  snowpark_session -- the Snowpark session on which to upload and load the files
+  bulk_ingestion_route -- the route for the files, as returned by retrieve_bulk_ingestion_route
+  storage_blob_service_uri -- the uri for the blob storage service
+  container -- the container name
+  relative_file_paths -- the paths of the files within the container
+  query_tag_attributes -- the attributes of the QUERY_TAG set on each COPY, as returned by build_query_tag_attributes (default None)
+
+  eg: ingest_data_files(snowpark_session=snowpark_session, bulk_ingestion_route=bulk_ingestion_route, storage_blob_service_uri="https://my-storage-account.blob.core.windows.net", container="landing", relative_file_paths=["sales/2024-01-01.csv"])
+  """
+  if "internal_stage" in bulk_ingestion_route :
+    for relative_file_path in relative_file_paths:
+      upload_blob_to_internal_stage(snowpark_session, storage_blob_service_uri, container, relative_file_path, bulk_ingestion_route["internal_stage"])
+  return copy_data_files_into_table(snowpark_session, bulk_ingestion_route, container, relative_file_paths, query_tag_attributes)
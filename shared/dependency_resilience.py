@@ -0,0 +1,322 @@
+
+# Retries and circuit breaking for the services that the
+# functions depend upon. Each call to a dependency, such as
+# fetching a key vault secret, downloading a blob or logging
+# in to Snowflake, is retried on its own with jittered
+# exponential backoff when it fails transiently, so that a
+# failure in one stage does not repeat the stages before it.
+# Retries are in addition to those made within the Azure SDKs
+# and the Snowflake connector, so the defaults are modest
+#
+# Snowflake is also guarded by a circuit breaker. Once a
+# number of consecutive executions fail because Snowflake
+# could not be reached, the circuit opens and further
+# executions are rejected straight away, the timer
+# triggered batch function stops receiving messages and the
+# queue triggered functions defer their messages, until
+# the circuit has been open for a while. A single execution
+# is then let through to test whether Snowflake has recovered
+#
+# The retry policy for a dependency is taken from the
+# RETRY_MAX_ATTEMPTS_<DEPENDENCY>,
+# RETRY_BASE_DELAY_MILLISECONDS_<DEPENDENCY> and
+# RETRY_MAX_DELAY_MILLISECONDS_<DEPENDENCY> app settings
+# if they are populated, where the dependency is
+# KEY_VAULT, BLOB_STORAGE or SNOWFLAKE_LOGIN
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import time
+import random
+import asyncio
+import threading
+from contextlib import contextmanager
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .telemetry import register_metrics_snapshot
+
+## Default retry policy for each dependency
+DEFAULT_RETRY_POLICIES = {
+    "key_vault": {"max_attempts": 3, "base_delay_milliseconds": 200, "max_delay_milliseconds": 2000}
+  , "blob_storage": {"max_attempts": 3, "base_delay_milliseconds": 200, "max_delay_milliseconds": 2000}
+  , "snowflake_login": {"max_attempts": 3, "base_delay_milliseconds": 500, "max_delay_milliseconds": 5000, "circuit": "snowflake"}
+}
+
+## HTTP status codes which indicate that a request may succeed if repeated
+TRANSIENT_HTTP_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+## Names of the exception classes, from the Azure SDKs and the
+## Snowflake connector, which indicate that a service could not
+## be reached or did not respond in time. These are matched by
+## name so that neither package is imported to classify an error
+TRANSIENT_ERROR_CLASS_NAMES = {
+    "ServiceRequestError"
+  , "ServiceResponseError"
+  , "IncompleteReadError"
+  , "ServiceUnavailableError"
+  , "GatewayTimeoutError"
+  , "BadGatewayError"
+  , "InternalServerError"
+  , "RequestTimeoutError"
+  , "OtherHTTPRetryableError"
+}
+
+## Snowflake error numbers which indicate that a request
+## to Snowflake failed before a response was received
+SNOWFLAKE_TRANSIENT_ERROR_NUMBERS = {
+    250003  # Failed to execute request
+}
+
+## Module-level state which lives for the lifetime of the worker
+_circuit_breakers = {}
+_resilience_metrics = {}
+_resilience_lock = threading.Lock()
+
+## Error raised when a call is rejected because
+## the circuit for its dependency is open
+class DependencyCircuitOpenError(Exception):
+  """
+  Raised when work against a dependency is rejected because its circuit breaker is open
+  """
+
+## Define function to retrieve the retry policy for a dependency
+def _retrieve_retry_policy(dependency: str):
+  default_retry_policy = DEFAULT_RETRY_POLICIES[dependency]
+  return {
+      **default_retry_policy
+    , **{
+          policy_key: retrieve_int_app_setting(f"RETRY_{policy_key.upper()}_{dependency.upper()}", default_retry_policy[policy_key])
+          for policy_key in ("max_attempts", "base_delay_milliseconds", "max_delay_milliseconds")
+      }
+  }
+
+## Define function to increment a resilience metric
+def _increment_resilience_metric(dependency: str, metric_name: str):
+  with _resilience_lock:
+    dependency_metrics = _resilience_metrics.setdefault(dependency, {})
+    dependency_metrics[metric_name] = dependency_metrics.get(metric_name, 0) + 1
+
+## Define function that determines whether an error is
+## one which may not recur if the call is repeated
+def is_transient_dependency_error(error: Exception):
+  """
+  Determine whether an exception indicates a transient failure to reach a dependency, such as a timeout, a dropped connection or a throttled request
+  Keyword arguments:
+  error -- the exception raised by the Azure SDK, the Snowflake connector or Snowpark
+
+  eg: is_transient_dependency_error(error=e)
+  """
+  while error is not None :
+    if isinstance(error, (ConnectionError, TimeoutError)) :
+      return True
+    if getattr(error, "status_code", None) in TRANSIENT_HTTP_STATUS_CODES :
+      return True
+    if getattr(error, "errno", None) in SNOWFLAKE_TRANSIENT_ERROR_NUMBERS :
+      return True
+    if any(error_class.__name__ in TRANSIENT_ERROR_CLASS_NAMES for error_class in type(error).__mro__) :
+      return True
+    error = error.__cause__ or error.__context__
+  return False
+
+## Define function to calculate the delay before a retry,
+## with full jitter so that failed callers do not retry in step
+def _calculate_retry_delay_seconds(retry_policy: dict, attempt_number: int):
+  capped_delay_milliseconds = min(retry_policy["max_delay_milliseconds"], retry_policy["base_delay_milliseconds"] * 2 ** (attempt_number - 1))
+  return random.uniform(0, capped_delay_milliseconds) / 1000
+
+## Define function to decide whether a failed attempt is retried
+def _should_retry(dependency: str, retry_policy: dict, attempt_number: int, error: Exception):
+  if not is_transient_dependency_error(error) :
+    return False
+  if attempt_number >= retry_policy["max_attempts"] :
+    _increment_resilience_metric(dependency, "exhausted")
+    logging.warning(f'Manual log - Giving up on {dependency} after {attempt_number} attempts')
+    return False
+
+  ### Do not add to the load on a dependency
+  ### whose circuit has opened in the meantime
+  if "circuit" in retry_policy and is_dependency_circuit_open(retry_policy["circuit"]) :
+    return False
+  _increment_resilience_metric(dependency, "retries")
+  logging.warning(f'Manual log - Retrying {dependency} after transient failure on attempt {attempt_number}: {error}')
+  return True
+
+## Define function to call a dependency with retries
+def call_with_retries(dependency: str, dependency_function, *function_args, **function_kwargs):
+  """
+  Call a dependency, retrying with jittered exponential backoff whilst it fails transiently
+  Keyword arguments:
+  dependency -- the dependency being called, which selects the retry policy, one of "key_vault", "blob_storage" or "snowflake_login"
+  dependency_function -- the function which calls the dependency
+  function_args -- the positional arguments for dependency_function
+  function_kwargs -- the keyword arguments for dependency_function
+
+  eg: call_with_retries("key_vault", secret_client.get_secret, "my-secret-name")
+  """
+  retry_policy = _retrieve_retry_policy(dependency)
+  attempt_number = 0
+  while True :
+    attempt_number += 1
+    _increment_resilience_metric(dependency, "attempts")
+    try:
+      return dependency_function(*function_args, **function_kwargs)
+    except Exception as e:
+      if not _should_retry(dependency, retry_policy, attempt_number, e) :
+        raise
+    time.sleep(_calculate_retry_delay_seconds(retry_policy, attempt_number))
+
+## Define function to await a dependency with retries
+async def call_with_retries_async(dependency: str, dependency_function, *function_args, **function_kwargs):
+  """
+  Await a call to a dependency, retrying with jittered exponential backoff whilst it fails transiently, without blocking the event loop
+  Keyword arguments:
+  dependency -- the dependency being called, which selects the retry policy, one of "key_vault", "blob_storage" or "snowflake_login"
+  dependency_function -- the coroutine function which calls the dependency
+  function_args -- the positional arguments for dependency_function
+  function_kwargs -- the keyword arguments for dependency_function
+
+  eg: await call_with_retries_async("key_vault", secret_client.get_secret, "my-secret-name")
+  """
+  retry_policy = _retrieve_retry_policy(dependency)
+  attempt_number = 0
+  while True :
+    attempt_number += 1
+    _increment_resilience_metric(dependency, "attempts")
+    try:
+      return await dependency_function(*function_args, **function_kwargs)
+    except Exception as e:
+      if not _should_retry(dependency, retry_policy, attempt_number, e) :
+        raise
+    await asyncio.sleep(_calculate_retry_delay_seconds(retry_policy, attempt_number))
+
+## Define function to retrieve the state of the
+## circuit breaker for a dependency, creating it if needed
+def _retrieve_circuit_breaker(dependency: str):
+  return _circuit_breakers.setdefault(dependency, {
+      "state": "closed"
+    , "consecutive_failures": 0
+    , "opened_at": None
+    , "trial_in_flight": False
+  })
+
+## Define function to determine whether a circuit is open
+def is_dependency_circuit_open(dependency: str):
+  """
+  Determine whether work against a dependency is currently being rejected, without claiming the trial call made once the circuit has been open for CIRCUIT_BREAKER_OPEN_SECONDS
+  Keyword arguments:
+  dependency -- the dependency guarded by the circuit, such as "snowflake"
+
+  eg: is_dependency_circuit_open(dependency="snowflake")
+  """
+  open_seconds = retrieve_int_app_setting("CIRCUIT_BREAKER_OPEN_SECONDS", 60)
+  with _resilience_lock:
+    circuit_breaker = _retrieve_circuit_breaker(dependency)
+    if circuit_breaker["state"] == "closed" :
+      return False
+    if circuit_breaker["trial_in_flight"] :
+      return True
+    return time.monotonic() - circuit_breaker["opened_at"] < open_seconds
+
+## Define function to raise if a circuit is open
+def raise_if_dependency_circuit_open(dependency: str):
+  """
+  Raise a DependencyCircuitOpenError if work against a dependency is currently being rejected, so that a caller can fail before doing any work which would be wasted
+  Keyword arguments:
+  dependency -- the dependency guarded by the circuit, such as "snowflake"
+
+  eg: raise_if_dependency_circuit_open(dependency="snowflake")
+  """
+  if is_dependency_circuit_open(dependency) :
+    _increment_resilience_metric(dependency, "rejected")
+    raise DependencyCircuitOpenError(f"The circuit for {dependency} is open after repeated failures to reach it")
+
+## Define function to claim permission for a call,
+## claiming the trial call if the circuit has been open long enough
+def _claim_circuit_call(dependency: str):
+  open_seconds = retrieve_int_app_setting("CIRCUIT_BREAKER_OPEN_SECONDS", 60)
+  with _resilience_lock:
+    circuit_breaker = _retrieve_circuit_breaker(dependency)
+    if circuit_breaker["state"] == "closed" :
+      return False
+    call_rejected = circuit_breaker["trial_in_flight"] or time.monotonic() - circuit_breaker["opened_at"] < open_seconds
+    if not call_rejected :
+      circuit_breaker["state"] = "half_open"
+      circuit_breaker["trial_in_flight"] = True
+  if call_rejected :
+    _increment_resilience_metric(dependency, "rejected")
+    raise DependencyCircuitOpenError(f"The circuit for {dependency} is open after repeated failures to reach it")
+  logging.info(f'Manual log - Allowing a trial call to {dependency} after its circuit was open')
+  return True
+
+## Define function to record the outcome of a call,
+## opening the circuit after too many consecutive failures
+## or a failed trial call and closing it after any success
+def _record_circuit_outcome(dependency: str, is_trial_call: bool, call_failed: bool):
+  failure_threshold = retrieve_int_app_setting("CIRCUIT_BREAKER_FAILURE_THRESHOLD", 5)
+  with _resilience_lock:
+    circuit_breaker = _retrieve_circuit_breaker(dependency)
+    previous_state = circuit_breaker["state"]
+    if is_trial_call :
+      circuit_breaker["trial_in_flight"] = False
+    if not call_failed :
+      circuit_breaker.update({"state": "closed", "consecutive_failures": 0, "opened_at": None})
+    else :
+      circuit_breaker["consecutive_failures"] += 1
+      if is_trial_call or (previous_state == "closed" and circuit_breaker["consecutive_failures"] >= failure_threshold) :
+        circuit_breaker.update({"state": "open", "opened_at": time.monotonic()})
+    current_state = circuit_breaker["state"]
+    consecutive_failures = circuit_breaker["consecutive_failures"]
+  if current_state == "open" and (previous_state == "closed" or is_trial_call) :
+    _increment_resilience_metric(dependency, "opened")
+    logging.error(f'Manual log - Opening the circuit for {dependency} after {consecutive_failures} consecutive failures')
+  elif current_state == "closed" and previous_state != "closed" :
+    logging.info(f'Manual log - Closing the circuit for {dependency} after a successful call')
+
+## Define context manager which guards a block
+## of work against a dependency with its circuit
+@contextmanager
+def dependency_circuit(dependency: str):
+  """
+  Guard a block of work against a dependency with its circuit breaker, rejecting the block whilst the circuit is open and recording whether it failed to reach the dependency
+  Keyword arguments:
+  dependency -- the dependency guarded by the circuit, such as "snowflake"
+
+  Only transient failures count towards opening the circuit, so an error
+  raised by a statement which Snowflake rejected closes it like a success.
+  Raises DependencyCircuitOpenError if the circuit is open.
+
+  eg:
+  with dependency_circuit("snowflake"):
+    snowpark_session.sql("SELECT 1").collect()
+  """
+  is_trial_call = _claim_circuit_call(dependency)
+  try:
+    yield
+  except Exception as e:
+    _record_circuit_outcome(dependency, is_trial_call, is_transient_dependency_error(e))
+    raise
+  except BaseException:
+    if is_trial_call :
+      with _resilience_lock:
+        _retrieve_circuit_breaker(dependency)["trial_in_flight"] = False
+    raise
+  _record_circuit_outcome(dependency, is_trial_call, False)
+
+## Define function to retrieve a snapshot of the resilience metrics
+def retrieve_dependency_resilience_metrics():
+  """
+  Retrieve a snapshot of the attempts, retries and exhausted retries for each dependency, and the state of each circuit breaker
+  """
+  with _resilience_lock:
+    resilience_metrics = {dependency: dict(dependency_metrics) for dependency, dependency_metrics in _resilience_metrics.items()}
+    for dependency, circuit_breaker in _circuit_breakers.items():
+      resilience_metrics.setdefault(dependency, {})["circuit_state"] = circuit_breaker["state"]
+      resilience_metrics[dependency]["consecutive_failures"] = circuit_breaker["consecutive_failures"]
+  return resilience_metrics
+
+## Export the retry and circuit breaker counters for each
+## dependency, of which the circuit state itself is not a number
+register_metrics_snapshot("dependency_resilience", retrieve_dependency_resilience_metrics, "Retry and circuit breaker counters for each dependency", ("dependency",))
@@ -0,0 +1,342 @@
+
+# Durable execution state for the statements in a control
+# file. A long statement can outlast the execution timeout of
+# the function, so that the message is retried whilst the
+# statement is still running in Snowflake and the retry would
+# submit the same statement again. Instead, every statement is
+# submitted as an asynchronous query and its query ID is stored
+# against the blob event before its result is awaited. A retry
+# of the event reattaches to each stored query, waiting for it
+# if it is still running or fetching its persisted result if
+# it has finished, rather than executing the statement again.
+# A statement whose query failed is forgotten, so that its
+# retry executes it again, and the state for an event is
+# removed once every statement has completed
+#
+# An event whose worker timed out still holds its idempotency
+# key, so a retry which finds state stored for the event takes
+# the key over once it has been held for longer than
+# DURABLE_EXECUTION_TAKEOVER_AFTER_SECONDS, by which time the
+# worker holding it has timed out, rather than waiting for
+# the key to expire
+#
+# Statements which change the state of the session, such as USE
+# statements or the creation of temporary tables, are always
+# executed again, since a retry uses a different session
+#
+# The store is selected with the DURABLE_EXECUTION_STORE app setting:
+# - none   - statements are executed synchronously without any state (default)
+# - sqlite - a SQLite database on the local disk of the instance
+# - table  - an Azure storage table, shared by every instance
+
+## Import Azure packages
+import logging
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+## Import other packages
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .telemetry import register_metrics_snapshot
+from .lazy_imports import import_attribute_lazily
+from .azure_credential_cache import retrieve_default_azure_credential
+
+## Import heavy packages, deferred until first use
+TableClient = import_attribute_lazily("azure.data.tables", "TableClient")
+UpdateMode = import_attribute_lazily("azure.data.tables", "UpdateMode")
+
+## Supported durable execution stores
+DURABLE_EXECUTION_STORES = ("none", "sqlite", "table")
+
+## Statements which change the state of the session, and so
+## must execute again on the session used by a retry
+SESSION_STATE_STATEMENT_PATTERN = re.compile(
+    r"^\s*(USE\b|ALTER\s+SESSION\b|SET\b|UNSET\b|BEGIN\b|START\s+TRANSACTION\b|COMMIT\b|ROLLBACK\b"
+    r"|CREATE\s+(OR\s+REPLACE\s+)?(LOCAL\s+|GLOBAL\s+)?(TEMP|TEMPORARY|VOLATILE)\b)"
+  , re.IGNORECASE
+)
+
+## Module-level state which lives for the lifetime of the worker
+_durable_execution_store = None
+_durable_execution_lock = threading.Lock()
+_durable_execution_metrics = {
+    "submitted": 0
+  , "reattached": 0
+  , "forgotten": 0
+  , "completed": 0
+  , "evicted": 0
+  , "errors": 0
+}
+
+## Define function to increment a durable execution metric
+def _increment_durable_execution_metric(metric_name: str, amount=1):
+  with _durable_execution_lock:
+    _durable_execution_metrics[metric_name] += amount
+
+## Define a durable execution store backed by a local SQLite database
+class SqliteDurableExecutionStore:
+  """
+  Durable execution store in a SQLite database, shared by every worker process on the same instance
+  """
+  def __init__(self, database_path: str):
+    self._connection = sqlite3.connect(database_path, timeout=30, isolation_level=None, check_same_thread=False)
+    self._connection_lock = threading.Lock()
+    self._last_evicted_at = 0.0
+    with self._connection_lock:
+      self._connection.execute("PRAGMA journal_mode=WAL")
+      self._connection.execute("""
+        CREATE TABLE IF NOT EXISTS durable_executions (
+            execution_key TEXT PRIMARY KEY
+          , submitted_queries TEXT NOT NULL
+          , expires_at REAL NOT NULL
+        )
+      """)
+
+  def retrieve(self, execution_key: str):
+    with self._connection_lock:
+      existing_row = self._connection.execute(
+          "SELECT submitted_queries FROM durable_executions WHERE execution_key = ? AND expires_at > ?"
+        , (execution_key, time.time())
+      ).fetchone()
+    return json.loads(existing_row[0]) if existing_row is not None else {}
+
+  def store(self, execution_key: str, submitted_queries: dict, ttl_seconds: int):
+    with self._connection_lock:
+      self._connection.execute(
+          "INSERT OR REPLACE INTO durable_executions (execution_key, submitted_queries, expires_at) VALUES (?, ?, ?)"
+        , (execution_key, json.dumps(submitted_queries), time.time() + ttl_seconds)
+      )
+
+  def remove(self, execution_key: str):
+    with self._connection_lock:
+      self._connection.execute("DELETE FROM durable_executions WHERE execution_key = ?", (execution_key,))
+
+  def evict_expired(self):
+    with self._connection_lock:
+      evicted_count = self._connection.execute("DELETE FROM durable_executions WHERE expires_at <= ?", (time.time(),)).rowcount
+    return evicted_count
+
+## Define a durable execution store backed by an Azure storage table
+class TableStorageDurableExecutionStore:
+  """
+  Durable execution store in an Azure storage table, shared by every instance of the function app
+  """
+  PARTITION_KEY = "durable_execution"
+
+  def __init__(self, table_client):
+    self._table_client = table_client
+    self._last_evicted_at = 0.0
+    try:
+      self._table_client.create_table()
+    except ResourceExistsError:
+      pass
+
+  def retrieve(self, execution_key: str):
+    try:
+      existing_entity = self._table_client.get_entity(self.PARTITION_KEY, execution_key)
+    except ResourceNotFoundError:
+      return {}
+    if existing_entity["ExpiresAt"] <= time.time() :
+      return {}
+    return json.loads(existing_entity["SubmittedQueries"])
+
+  def store(self, execution_key: str, submitted_queries: dict, ttl_seconds: int):
+    self._table_client.upsert_entity({
+        "PartitionKey": self.PARTITION_KEY
+      , "RowKey": execution_key
+      , "SubmittedQueries": json.dumps(submitted_queries)
+      , "ExpiresAt": time.time() + ttl_seconds
+    }, mode=UpdateMode.REPLACE)
+
+  def remove(self, execution_key: str):
+    self._table_client.delete_entity(self.PARTITION_KEY, execution_key)
+
+  def evict_expired(self):
+    evicted_count = 0
+    for expired_entity in self._table_client.query_entities(
+        "PartitionKey eq @partition_key and ExpiresAt le @now"
+      , parameters = {"partition_key": self.PARTITION_KEY, "now": time.time()}
+      , select = ["PartitionKey", "RowKey"]
+    ):
+      self._table_client.delete_entity(expired_entity["PartitionKey"], expired_entity["RowKey"])
+      evicted_count += 1
+    return evicted_count
+
+## Define function to create the
+## store selected by the app settings
+def _create_durable_execution_store():
+  durable_execution_store_type = os.getenv("DURABLE_EXECUTION_STORE", "none").lower()
+  if durable_execution_store_type not in DURABLE_EXECUTION_STORES :
+    raise ValueError(f"DURABLE_EXECUTION_STORE must be one of {DURABLE_EXECUTION_STORES}, not {durable_execution_store_type}")
+
+  if durable_execution_store_type == "none" :
+    return None
+
+  if durable_execution_store_type == "table" :
+    table_client = TableClient(
+        endpoint = os.getenv("AZURE_STORAGE_IDENTITY__tableServiceUri")
+      , table_name = os.getenv("DURABLE_EXECUTION_TABLE_NAME", "snowparkfunctionexecutions")
+      , credential = retrieve_default_azure_credential()
+    )
+    return TableStorageDurableExecutionStore(table_client)
+
+  database_path = os.getenv("DURABLE_EXECUTION_SQLITE_PATH") or os.path.join(tempfile.gettempdir(), "snowpark_function_durable_execution.sqlite")
+  return SqliteDurableExecutionStore(database_path)
+
+## Define function to retrieve the worker-scoped store,
+## evicting expired state from it now and again
+def _retrieve_durable_execution_store():
+  global _durable_execution_store
+  with _durable_execution_lock:
+    if _durable_execution_store is None :
+      _durable_execution_store = _create_durable_execution_store() or False
+    durable_execution_store = _durable_execution_store or None
+    evict_expired = durable_execution_store is not None and time.monotonic() - durable_execution_store._last_evicted_at > retrieve_int_app_setting("DURABLE_EXECUTION_EVICTION_INTERVAL_SECONDS", 300)
+    if evict_expired :
+      durable_execution_store._last_evicted_at = time.monotonic()
+
+  if evict_expired :
+    try:
+      evicted_count = durable_execution_store.evict_expired()
+      _increment_durable_execution_metric("evicted", evicted_count)
+      logging.info(f'Manual log - Evicted {evicted_count} expired durable execution states')
+    except Exception as e:
+      _increment_durable_execution_metric("errors")
+      logging.warning(f'Manual log - Error evicting expired durable execution states: {e}')
+  return durable_execution_store
+
+## Define function to build the hash which identifies a
+## statement, so that a changed statement is never reattached
+def _build_statement_hash(sql_statement: str):
+  return hashlib.sha256(str(sql_statement).encode()).hexdigest()[:16]
+
+## Define the execution state for the statements of a single blob event
+class DurableExecution:
+  """
+  The query IDs submitted for the statements of a single blob event, which a retry of the event reattaches to
+  """
+  def __init__(self, durable_execution_store, execution_key: str):
+    self._durable_execution_store = durable_execution_store
+    self._execution_key = execution_key
+    self._submitted_queries = durable_execution_store.retrieve(execution_key)
+    if len(self._submitted_queries) > 0 :
+      logging.info(f'Manual log - Found {len(self._submitted_queries)} previously submitted queries to reattach to')
+
+  def _persist(self):
+    try:
+      self._durable_execution_store.store(self._execution_key, self._submitted_queries, retrieve_int_app_setting("DURABLE_EXECUTION_TTL_SECONDS", 86400))
+    except Exception as e:
+      _increment_durable_execution_metric("errors")
+      logging.warning(f'Manual log - Error storing durable execution state: {e}')
+
+  def retrieve_query_id(self, statement_number: int, sql_statement: str):
+    """
+    Retrieve the query ID previously submitted for a statement, or None if the statement should be submitted
+    """
+    if SESSION_STATE_STATEMENT_PATTERN.match(str(sql_statement)) is not None :
+      return None
+    submitted_query = self._submitted_queries.get(str(statement_number))
+    if submitted_query is None or submitted_query["statement_hash"] != _build_statement_hash(sql_statement) :
+      return None
+    _increment_durable_execution_metric("reattached")
+    return submitted_query["query_id"]
+
+  def record_query_ids(self, submitted_query_ids: dict):
+    """
+    Store the query IDs submitted for statements, keyed on the position of each statement, before their results are awaited
+    """
+    submitted_query_count = 0
+    for statement_number, (sql_statement, query_id) in submitted_query_ids.items():
+      if SESSION_STATE_STATEMENT_PATTERN.match(str(sql_statement)) is not None :
+        continue
+      self._submitted_queries[str(statement_number)] = {"query_id": query_id, "statement_hash": _build_statement_hash(sql_statement)}
+      submitted_query_count += 1
+    if submitted_query_count > 0 :
+      _increment_durable_execution_metric("submitted", submitted_query_count)
+      self._persist()
+
+  def forget_query_ids(self, statement_numbers: list):
+    """
+    Forget the query IDs for statements whose queries failed, so that a retry executes them again
+    """
+    forgotten_query_ids = [self._submitted_queries.pop(str(statement_number), None) for statement_number in statement_numbers]
+    forgotten_count = sum(1 for forgotten_query_id in forgotten_query_ids if forgotten_query_id is not None)
+    if forgotten_count > 0 :
+      _increment_durable_execution_metric("forgotten", forgotten_count)
+      self._persist()
+
+  def complete(self):
+    """
+    Remove the state once every statement has completed
+    """
+    try:
+      self._durable_execution_store.remove(self._execution_key)
+      _increment_durable_execution_metric("completed")
+    except Exception as e:
+      _increment_durable_execution_metric("errors")
+      logging.warning(f'Manual log - Error removing durable execution state: {e}')
+
+## Define function to retrieve the execution
+## state for the statements of a blob event
+def retrieve_durable_execution(execution_key: str = None):
+  """
+  Retrieve the execution state for the statements of a blob event, or None if the DURABLE_EXECUTION_STORE app setting is none or there is no key
+  Keyword arguments:
+  execution_key -- the key identifying the blob event, such as its idempotency key (default None)
+
+  Errors from the store never prevent execution, in which case None is returned
+
+  eg: retrieve_durable_execution(execution_key=idempotency_key)
+  """
+  if execution_key is None :
+    return None
+  try:
+    durable_execution_store = _retrieve_durable_execution_store()
+    if durable_execution_store is None :
+      return None
+    return DurableExecution(durable_execution_store, execution_key)
+  except Exception as e:
+    _increment_durable_execution_metric("errors")
+    logging.warning(f'Manual log - Error retrieving durable execution state, executing statements regardless: {e}')
+    return None
+
+## Define function to determine whether an earlier
+## delivery of a blob event submitted any queries
+def has_durable_execution_state(execution_key: str = None):
+  """
+  Determine whether query IDs are stored for the statements of a blob event, so that a retry of the event would reattach to them
+  Keyword arguments:
+  execution_key -- the key identifying the blob event, such as its idempotency key (default None)
+
+  Errors from the store are treated as there being no state
+
+  eg: has_durable_execution_state(execution_key=idempotency_key)
+  """
+  if execution_key is None :
+    return False
+  try:
+    durable_execution_store = _retrieve_durable_execution_store()
+    return durable_execution_store is not None and len(durable_execution_store.retrieve(execution_key)) > 0
+  except Exception as e:
+    _increment_durable_execution_metric("errors")
+    logging.warning(f'Manual log - Error retrieving durable execution state: {e}')
+    return False
+
+## Define function to retrieve a snapshot of the durable execution metrics
+def retrieve_durable_execution_metrics():
+  """
+  Retrieve a snapshot of the submitted, reattached, forgotten, completed and evicted counts and the store errors
+  """
+  with _durable_execution_lock:
+    return dict(_durable_execution_metrics)
+
+## Export the durable execution counters
+register_metrics_snapshot("durable_execution", retrieve_durable_execution_metrics, "Durable execution submission, reattachment and store error counters")
@@ -0,0 +1,191 @@
+
+# Arrow-native responses for the HTTP triggered functions.
+# Query results are fetched as Arrow batches through the
+# Snowflake connector cursor underlying the Snowpark session
+# and serialized straight into the response body, avoiding
+# intermediate Row objects and pandas dataframes.
+#
+# The response format is negotiated from the "format"
+# query parameter or the Accept header:
+# - json   - a JSON array of values (default)
+# - ndjson - one JSON value per line
+# - arrow  - an Arrow IPC stream
+#
+# The HttpResponse of the Python v1 programming model only
+# accepts a complete body, so the body cannot be streamed
+# to the client. Instead each batch is serialized into the
+# body as it is fetched, so that only the serialized body
+# and a single batch are held in memory at once
+
+## Import Azure packages
+import logging
+import azure.functions as func
+
+## Import other packages
+import io
+import json
+
+## Import shared packages
+from .lazy_imports import import_module_lazily
+
+## Import heavy packages, deferred until first use
+pyarrow = import_module_lazily("pyarrow")
+pyarrow_ipc = import_module_lazily("pyarrow.ipc")
+
+## Mimetype for each supported response format
+RESPONSE_MIMETYPES = {
+    "json": "application/json"
+  , "ndjson": "application/x-ndjson"
+  , "arrow": "application/vnd.apache.arrow.stream"
+}
+
+## Number of rows fetched per batch when the
+## result is not available in Arrow format
+FALLBACK_BATCH_SIZE_ROWS = 10000
+
+## Define function to choose the response format for a request
+def negotiate_response_format(req: func.HttpRequest):
+  """
+  Choose the response format from the "format" query parameter, falling back to the Accept header and then JSON
+  Keyword arguments:
+  req -- the HTTP request
+
+  eg: negotiate_response_format(req=req)
+  """
+
+  ### An explicit query parameter takes precedence
+  requested_format = req.params.get("format")
+  if requested_format is not None and requested_format.lower() in RESPONSE_MIMETYPES :
+    return requested_format.lower()
+
+  ### Otherwise honour the first supported mimetype in the Accept header
+  accept_header = req.headers.get("Accept") or ""
+  for accepted_mimetype in accept_header.split(","):
+    accepted_mimetype = accepted_mimetype.split(";")[0].strip().lower()
+    for response_format, response_mimetype in RESPONSE_MIMETYPES.items():
+      if accepted_mimetype == response_mimetype :
+        return response_format
+
+  return "json"
+
+## Define function to fetch the result of a SQL statement
+## as Arrow tables, without materializing Row objects
+def fetch_arrow_batches(snowpark_session, sql_statement: str, query_attributes: dict = None):
+  """
+  Execute a SQL statement and yield its result as Arrow tables
+  Keyword arguments:
+  snowpark_session -- the Snowpark session on which to execute the statement
+  sql_statement -- the SQL statement to execute
+  query_attributes -- a dictionary into which the Snowflake query ID is written, such as the attributes of a timed stage (default None)
+
+  Results that Snowflake does not return in Arrow format, such as those of some
+  SHOW commands, are converted into Arrow tables in batches of rows instead.
+
+  eg: fetch_arrow_batches(snowpark_session=snowpark_session, sql_statement="SHOW DATABASES")
+  """
+  with snowpark_session.connection.cursor() as cursor:
+    cursor.execute(sql_statement)
+    if query_attributes is not None :
+      query_attributes["snowflake.query_id"] = cursor.sfqid
+    column_names = [column.name for column in cursor.description]
+
+    ### Stream Arrow batches directly when the result supports it
+    try:
+      arrow_batches = cursor.fetch_arrow_batches()
+    except Exception as e:
+      logging.info(f'Manual log - Result is not available in Arrow format, converting rows in batches: {e}')
+      arrow_batches = None
+
+    if arrow_batches is not None :
+      for arrow_batch in arrow_batches:
+        yield arrow_batch
+      return
+
+    ### Otherwise convert the rows in bounded batches
+    while True :
+      result_rows = cursor.fetchmany(FALLBACK_BATCH_SIZE_ROWS)
+      if len(result_rows) == 0 :
+        break
+      yield pyarrow.Table.from_arrays(
+          [pyarrow.array([result_row[column_index] for result_row in result_rows]) for column_index in range(len(column_names))]
+        , names = column_names
+      )
+
+## Define function to serialize a single column
+## of Arrow batches in the requested format
+def serialize_arrow_column(arrow_batches, column_name: str, response_format: str = "json"):
+  """
+  Serialize a single column from an iterable of Arrow tables into a response body
+  Keyword arguments:
+  arrow_batches -- an iterable of Arrow tables, such as from fetch_arrow_batches
+  column_name -- the name of the column to serialize
+  response_format -- one of "json", "ndjson" or "arrow" (default "json")
+
+  eg: serialize_arrow_column(arrow_batches=fetch_arrow_batches(snowpark_session, "SHOW DATABASES"), column_name="name", response_format="json")
+  """
+  if response_format not in RESPONSE_MIMETYPES :
+    raise ValueError(f"Response format must be one of {list(RESPONSE_MIMETYPES)}, not {response_format}")
+
+  ### Write the column as an Arrow IPC stream
+  if response_format == "arrow" :
+    with io.BytesIO() as response_stream:
+      ipc_writer = None
+      for arrow_batch in arrow_batches:
+        column_table = arrow_batch.select([column_name])
+        if ipc_writer is None :
+          ipc_writer = pyarrow_ipc.new_stream(response_stream, column_table.schema)
+        ipc_writer.write_table(column_table)
+      if ipc_writer is None :
+        ipc_writer = pyarrow_ipc.new_stream(response_stream, pyarrow.schema([(column_name, pyarrow.string())]))
+      ipc_writer.close()
+      return response_stream.getvalue()
+
+  ### Write the column as JSON values, one batch at a time
+  with io.BytesIO() as response_stream:
+    value_separator = "\n" if response_format == "ndjson" else ", "
+    values_written = 0
+    if response_format == "json" :
+      response_stream.write(b"[")
+    for arrow_batch in arrow_batches:
+      encoded_values = [json.dumps(column_value, default=str) for column_value in arrow_batch.column(column_name).to_pylist()]
+      if len(encoded_values) == 0 :
+        continue
+      if values_written > 0 and response_format == "json" :
+        response_stream.write(value_separator.encode())
+      response_stream.write(value_separator.join(encoded_values).encode())
+      if response_format == "ndjson" :
+        response_stream.write(value_separator.encode())
+      values_written += len(encoded_values)
+    if response_format == "json" :
+      response_stream.write(b"]")
+    return response_stream.getvalue()
+
+## Define function to execute a SQL statement and
+## build an HTTP response from one column of the result
+def build_column_http_response(snowpark_session, sql_statement: str, column_name: str, response_format: str = "json"):
+  """
+  Execute a SQL statement and return one column of its result as an HTTP response in the requested format
+  Keyword arguments:
+  snowpark_session -- the Snowpark session on which to execute the statement
+  sql_statement -- the SQL statement to execute
+  column_name -- the name of the column to return
+  response_format -- one of "json", "ndjson" or "arrow" (default "json")
+
+  eg: build_column_http_response(snowpark_session=snowpark_session, sql_statement="SHOW DATABASES", column_name="name", response_format=negotiate_response_format(req))
+  """
+  return build_arrow_column_http_response(fetch_arrow_batches(snowpark_session, sql_statement), column_name, response_format)
+
+## Define function to build an HTTP response
+## from one column of some Arrow batches
+def build_arrow_column_http_response(arrow_batches, column_name: str, response_format: str = "json"):
+  """
+  Return one column of an iterable of Arrow tables as an HTTP response in the requested format
+  Keyword arguments:
+  arrow_batches -- an iterable of Arrow tables, such as from fetch_arrow_batches or the metadata cache
+  column_name -- the name of the column to return
+  response_format -- one of "json", "ndjson" or "arrow" (default "json")
+
+  eg: build_arrow_column_http_response(arrow_batches=metadata_batches, column_name="name", response_format=negotiate_response_format(req))
+  """
+  response_body = serialize_arrow_column(arrow_batches, column_name, response_format)
+  return func.HttpResponse(response_body, mimetype=RESPONSE_MIMETYPES[response_format])
@@ -0,0 +1,55 @@
+
+# Processing shared by the HTTP triggered functions.
+# Each function only differs in how it creates its
+# Snowpark session, so the function supplies its session
+# builder and the databases are listed here
+
+## Import Azure packages
+import logging
+import azure.functions as func
+
+## Import shared packages
+from .http_responses import negotiate_response_format, build_arrow_column_http_response
+from .metadata_cache import retrieve_cached_metadata_batches, invalidate_metadata_cache
+from .telemetry import timed_stage
+
+## Define function which lists the databases
+## in Snowflake in response to an HTTP request
+def respond_with_database_names(req: func.HttpRequest, session_builder) -> func.HttpResponse:
+  """
+  Respond to an HTTP request with the names of the databases in Snowflake, in the requested format
+  Keyword arguments:
+  req -- the HTTP request, where a POST request invalidates the cached list of databases
+  session_builder -- a function without arguments that creates a new Snowpark session, leveraged through the session pool
+
+  eg: respond_with_database_names(req=req, session_builder=build_snowpark_session_using_app_settings_password)
+  """
+
+  ### Time the whole invocation, as the parent of every stage
+  with timed_stage("invocation", http_method=req.method):
+    try:
+
+      ### Determine the requested response format
+      response_format = negotiate_response_format(req)
+
+      ### A POST request explicitly invalidates the cached
+      ### metadata so that the databases are listed again
+      if req.method == "POST" :
+        invalidate_metadata_cache(session_builder)
+
+      ### Retrieve the result of a SQL command to view the databases
+      ### in Snowflake, served from the worker-scoped metadata cache
+      ### where possible, and serialize the database names straight
+      ### from the Arrow result batches into the response body
+      metadata_batches = retrieve_cached_metadata_batches(session_builder, "SHOW DATABASES")
+      http_response = build_arrow_column_http_response(metadata_batches, "name", response_format)
+
+      logging.info(f'Returning database names as {response_format}')
+
+      return http_response
+
+    except Exception as e:
+
+      logging.info(f"Manual log - Error encountered")
+      logging.info(e)
+      return  func.HttpResponse(f"Error encountered")
@@ -0,0 +1,419 @@
+
+# Deduplication of storage queue messages. Event Grid and
+# storage queues deliver at least once, so the same blob
+# event can arrive more than once. Before any I/O, each
+# message claims a key built from its event ID and the ETag
+# of the blob. A repeated delivery of a message which has
+# completed finds the key already completed and is skipped.
+# A repeated delivery of a message which is still being
+# processed fails with a retryable error, so that the queue
+# delivers it again later rather than it being acknowledged
+# whilst the first delivery may yet fail. A message which
+# fails releases its key so that its retry is processed as normal.
+# A delivery of a message whose earlier delivery timed out after
+# submitting queries takes over its key, so that it reattaches
+# to those queries, as described in durable_execution
+#
+# The store is selected with the IDEMPOTENCY_STORE app setting:
+# - sqlite - a SQLite database on the local disk of the instance (default)
+# - table  - an Azure storage table, shared by every instance
+# - none   - no deduplication
+
+## Import Azure packages
+import logging
+import azure.functions as func
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+## Import other packages
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .telemetry import register_metrics_snapshot
+from .lazy_imports import import_attribute_lazily
+from .azure_credential_cache import retrieve_default_azure_credential
+from .durable_execution import has_durable_execution_state
+
+## Import heavy packages, deferred until first use
+TableClient = import_attribute_lazily("azure.data.tables", "TableClient")
+UpdateMode = import_attribute_lazily("azure.data.tables", "UpdateMode")
+
+## Supported idempotency stores
+IDEMPOTENCY_STORES = ("sqlite", "table", "none")
+
+## Module-level state which lives for the lifetime of the worker
+_idempotency_store = None
+_idempotency_store_lock = threading.Lock()
+_idempotency_metrics = {
+    "claimed": 0
+  , "duplicates": 0
+  , "in_progress": 0
+  , "taken_over": 0
+  , "completed": 0
+  , "released": 0
+  , "evicted": 0
+  , "errors": 0
+}
+
+## Error raised when a repeated delivery arrives whilst
+## an earlier delivery still holds the key for the message
+class IdempotencyKeyInProgressError(Exception):
+  """
+  Raised when the key for a message is held by a delivery which is still in progress, so that the message is retried later
+  """
+
+## Define function to increment an idempotency metric
+def _increment_metric(metric_name: str, increment: int = 1):
+  with _idempotency_store_lock:
+    _idempotency_metrics[metric_name] += increment
+
+## Define an idempotency store backed by a local SQLite database
+class SqliteIdempotencyStore:
+  """
+  Idempotency store in a SQLite database, shared by every worker process on the same instance
+  """
+  def __init__(self, database_path: str):
+    self._database_path = database_path
+    self._connection = sqlite3.connect(database_path, timeout=30, isolation_level=None, check_same_thread=False)
+    self._connection_lock = threading.Lock()
+    self._last_evicted_at = 0.0
+    with self._connection_lock:
+      self._connection.execute("PRAGMA journal_mode=WAL")
+      self._connection.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            idempotency_key TEXT PRIMARY KEY
+          , status TEXT NOT NULL
+          , expires_at REAL NOT NULL
+        )
+      """)
+
+  def claim(self, idempotency_key: str, lease_seconds: int):
+    now = time.time()
+    with self._connection_lock:
+      self._connection.execute("BEGIN IMMEDIATE")
+      try:
+        existing_row = self._connection.execute(
+            "SELECT status FROM idempotency_keys WHERE idempotency_key = ? AND expires_at > ?"
+          , (idempotency_key, now)
+        ).fetchone()
+        if existing_row is None :
+          self._connection.execute(
+              "INSERT OR REPLACE INTO idempotency_keys (idempotency_key, status, expires_at) VALUES (?, 'in_progress', ?)"
+            , (idempotency_key, now + lease_seconds)
+          )
+        self._connection.execute("COMMIT")
+      except Exception:
+        self._connection.execute("ROLLBACK")
+        raise
+    return "claimed" if existing_row is None else existing_row[0]
+
+  def take_over(self, idempotency_key: str, lease_seconds: int, claimed_before: float):
+    now = time.time()
+    with self._connection_lock:
+      taken_over_count = self._connection.execute(
+          "UPDATE idempotency_keys SET expires_at = ? WHERE idempotency_key = ? AND status = 'in_progress' AND expires_at <= ?"
+        , (now + lease_seconds, idempotency_key, claimed_before + lease_seconds)
+      ).rowcount
+    return "claimed" if taken_over_count == 1 else "in_progress"
+
+  def complete(self, idempotency_key: str, ttl_seconds: int):
+    with self._connection_lock:
+      self._connection.execute(
+          "UPDATE idempotency_keys SET status = 'completed', expires_at = ? WHERE idempotency_key = ?"
+        , (time.time() + ttl_seconds, idempotency_key)
+      )
+
+  def release(self, idempotency_key: str):
+    with self._connection_lock:
+      self._connection.execute("DELETE FROM idempotency_keys WHERE idempotency_key = ?", (idempotency_key,))
+
+  def evict_expired(self):
+    with self._connection_lock:
+      evicted_count = self._connection.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (time.time(),)).rowcount
+    return evicted_count
+
+## Define an idempotency store backed by an Azure storage table
+class TableStorageIdempotencyStore:
+  """
+  Idempotency store in an Azure storage table, shared by every instance of the function app
+  """
+  PARTITION_KEY = "idempotency"
+
+  def __init__(self, table_client):
+    self._table_client = table_client
+    self._last_evicted_at = 0.0
+    try:
+      self._table_client.create_table()
+    except ResourceExistsError:
+      pass
+
+  def claim(self, idempotency_key: str, lease_seconds: int):
+    now = time.time()
+    idempotency_entity = {
+        "PartitionKey": self.PARTITION_KEY
+      , "RowKey": idempotency_key
+      , "Status": "in_progress"
+      , "ExpiresAt": now + lease_seconds
+    }
+
+    ### Creating the entity only succeeds for the first claim
+    try:
+      self._table_client.create_entity(idempotency_entity)
+      return "claimed"
+    except ResourceExistsError:
+      pass
+
+    ### Take over an expired claim, only if no other
+    ### instance has taken it over in the meantime
+    try:
+      existing_entity = self._table_client.get_entity(self.PARTITION_KEY, idempotency_key)
+    except ResourceNotFoundError:
+      return self.claim(idempotency_key, lease_seconds)
+    if existing_entity["ExpiresAt"] > now :
+      return existing_entity["Status"]
+    try:
+      self._table_client.update_entity(
+          idempotency_entity
+        , mode = UpdateMode.REPLACE
+        , etag = existing_entity.metadata["etag"]
+        , match_condition = MatchConditions.IfNotModified
+      )
+      return "claimed"
+    except (ResourceModifiedError, ResourceNotFoundError):
+      return "in_progress"
+
+  def take_over(self, idempotency_key: str, lease_seconds: int, claimed_before: float):
+    try:
+      existing_entity = self._table_client.get_entity(self.PARTITION_KEY, idempotency_key)
+    except ResourceNotFoundError:
+      return self.claim(idempotency_key, lease_seconds)
+    if existing_entity["Status"] != "in_progress" or existing_entity["ExpiresAt"] > claimed_before + lease_seconds :
+      return existing_entity["Status"]
+    try:
+      self._table_client.update_entity(
+          {
+              "PartitionKey": self.PARTITION_KEY
+            , "RowKey": idempotency_key
+            , "Status": "in_progress"
+            , "ExpiresAt": time.time() + lease_seconds
+          }
+        , mode = UpdateMode.REPLACE
+        , etag = existing_entity.metadata["etag"]
+        , match_condition = MatchConditions.IfNotModified
+      )
+      return "claimed"
+    except (ResourceModifiedError, ResourceNotFoundError):
+      return "in_progress"
+
+  def complete(self, idempotency_key: str, ttl_seconds: int):
+    self._table_client.upsert_entity({
+        "PartitionKey": self.PARTITION_KEY
+      , "RowKey": idempotency_key
+      , "Status": "completed"
+      , "ExpiresAt": time.time() + ttl_seconds
+    }, mode=UpdateMode.REPLACE)
+
+  def release(self, idempotency_key: str):
+    self._table_client.delete_entity(self.PARTITION_KEY, idempotency_key)
+
+  def evict_expired(self):
+    evicted_count = 0
+    for expired_entity in self._table_client.query_entities(
+        "PartitionKey eq @partition_key and ExpiresAt le @now"
+      , parameters = {"partition_key": self.PARTITION_KEY, "now": time.time()}
+      , select = ["PartitionKey", "RowKey"]
+    ):
+      self._table_client.delete_entity(expired_entity["PartitionKey"], expired_entity["RowKey"])
+      evicted_count += 1
+    return evicted_count
+
+## Define function to create the
+## store selected by the app settings
+def _create_idempotency_store():
+  idempotency_store_type = os.getenv("IDEMPOTENCY_STORE", "sqlite").lower()
+  if idempotency_store_type not in IDEMPOTENCY_STORES :
+    raise ValueError(f"IDEMPOTENCY_STORE must be one of {IDEMPOTENCY_STORES}, not {idempotency_store_type}")
+
+  if idempotency_store_type == "none" :
+    return None
+
+  if idempotency_store_type == "table" :
+    table_client = TableClient(
+        endpoint = os.getenv("AZURE_STORAGE_IDENTITY__tableServiceUri")
+      , table_name = os.getenv("IDEMPOTENCY_TABLE_NAME", "snowparkfunctionidempotency")
+      , credential = retrieve_default_azure_credential()
+    )
+    return TableStorageIdempotencyStore(table_client)
+
+  database_path = os.getenv("IDEMPOTENCY_SQLITE_PATH") or os.path.join(tempfile.gettempdir(), "snowpark_function_idempotency.sqlite")
+  return SqliteIdempotencyStore(database_path)
+
+## Define function to retrieve the worker-scoped store,
+## evicting expired keys from it now and again
+def _retrieve_idempotency_store():
+  global _idempotency_store
+  with _idempotency_store_lock:
+    if _idempotency_store is None :
+      _idempotency_store = _create_idempotency_store() or False
+    idempotency_store = _idempotency_store or None
+    evict_expired = idempotency_store is not None and time.monotonic() - idempotency_store._last_evicted_at > retrieve_int_app_setting("IDEMPOTENCY_EVICTION_INTERVAL_SECONDS", 300)
+    if evict_expired :
+      idempotency_store._last_evicted_at = time.monotonic()
+
+  if evict_expired :
+    try:
+      evicted_count = idempotency_store.evict_expired()
+      _increment_metric("evicted", evicted_count)
+      logging.info(f'Manual log - Evicted {evicted_count} expired idempotency keys')
+    except Exception as e:
+      _increment_metric("errors")
+      logging.warning(f'Manual log - Error evicting expired idempotency keys: {e}')
+  return idempotency_store
+
+## Define function to build the idempotency
+## key for a storage queue message
+def build_message_idempotency_key(msg: func.QueueMessage):
+  """
+  Build the idempotency key for a storage queue message from the event ID and the ETag of the blob, without any I/O
+  Keyword arguments:
+  msg -- the storage queue message containing a blob created event
+
+  Returns None if the message does not contain an event ID
+
+  eg: build_message_idempotency_key(msg=msg)
+  """
+  try:
+    msg_json = msg.get_json()
+  except ValueError:
+    return None
+  if not isinstance(msg_json, dict) :
+    return None
+  msg_data = msg_json.get("data") if isinstance(msg_json.get("data"), dict) else {}
+  return build_blob_event_idempotency_key(msg_json.get("id"), msg_data.get("eTag"))
+
+## Define function to build the idempotency
+## key for a single blob event
+def build_blob_event_idempotency_key(event_id: str, etag: str = None):
+  """
+  Build the idempotency key for a single blob event from its event ID and the ETag of the blob, without any I/O
+  Keyword arguments:
+  event_id -- the ID of the Event Grid event
+  etag -- the ETag of the blob (default None)
+
+  Returns None if there is no event ID
+
+  eg: build_blob_event_idempotency_key(event_id=routed_blob_event["event_id"], etag=routed_blob_event["etag"])
+  """
+  if event_id is None :
+    return None
+
+  ### Hash the values so that the key is valid as a table row key
+  idempotency_hash = hashlib.sha256()
+  idempotency_hash.update(str(event_id).encode())
+  idempotency_hash.update(b"\0")
+  idempotency_hash.update(str(etag or "").encode())
+  return idempotency_hash.hexdigest()
+
+## Define function to claim an idempotency key
+def claim_idempotency_key(idempotency_key: str):
+  """
+  Claim an idempotency key before processing a message, returning False if the message has already been processed
+  Keyword arguments:
+  idempotency_key -- the key for the message, as returned by build_message_idempotency_key
+
+  Raises IdempotencyKeyInProgressError if another delivery of the message holds the key and
+  it has not expired, so that the message is retried later rather than acknowledged, unless
+  that delivery has timed out after submitting queries, in which case the key is taken over.
+  Messages without a key and errors from the store never prevent processing
+
+  eg: claim_idempotency_key(idempotency_key=build_message_idempotency_key(msg))
+  """
+  if idempotency_key is None :
+    return True
+  try:
+    idempotency_store = _retrieve_idempotency_store()
+    if idempotency_store is None :
+      return True
+    lease_seconds = retrieve_int_app_setting("IDEMPOTENCY_IN_PROGRESS_TIMEOUT_SECONDS", 900)
+    claim_status = idempotency_store.claim(idempotency_key, lease_seconds)
+
+    ### Take over a key held by a delivery which has timed out after
+    ### submitting queries, so that this delivery reattaches to them.
+    ### The time of the claim is taken from when its lease expires
+    if claim_status == "in_progress" and has_durable_execution_state(idempotency_key) :
+      claimed_before = time.time() - retrieve_int_app_setting("DURABLE_EXECUTION_TAKEOVER_AFTER_SECONDS", 600)
+      claim_status = idempotency_store.take_over(idempotency_key, lease_seconds, claimed_before)
+      if claim_status == "claimed" :
+        _increment_metric("taken_over")
+        logging.warning(f'Manual log - Taking over idempotency key from a delivery which timed out, reattaching to its queries')
+  except Exception as e:
+    _increment_metric("errors")
+    logging.warning(f'Manual log - Error claiming idempotency key, processing message regardless: {e}')
+    return True
+
+  ### Only a completed key marks a duplicate, whilst a key held by
+  ### another delivery may yet be released if that delivery fails
+  if claim_status == "in_progress" :
+    _increment_metric("in_progress")
+    logging.warning(f'Manual log - Idempotency key is held by a delivery which is still in progress, retrying message later')
+    raise IdempotencyKeyInProgressError("Idempotency key is held by a delivery which is still in progress")
+  _increment_metric("claimed" if claim_status == "claimed" else "duplicates")
+  return claim_status == "claimed"
+
+## Define function to record that a message was processed
+def complete_idempotency_key(idempotency_key: str):
+  """
+  Record that the message for an idempotency key was processed, so that repeated deliveries are skipped until the key expires
+  Keyword arguments:
+  idempotency_key -- the key for the message, as returned by build_message_idempotency_key
+
+  eg: complete_idempotency_key(idempotency_key=idempotency_key)
+  """
+  if idempotency_key is None :
+    return
+  try:
+    idempotency_store = _retrieve_idempotency_store()
+    if idempotency_store is not None :
+      idempotency_store.complete(idempotency_key, retrieve_int_app_setting("IDEMPOTENCY_TTL_SECONDS", 86400))
+      _increment_metric("completed")
+  except Exception as e:
+    _increment_metric("errors")
+    logging.warning(f'Manual log - Error completing idempotency key: {e}')
+
+## Define function to release an idempotency key
+## so that the message can be processed again
+def release_idempotency_key(idempotency_key: str):
+  """
+  Release the claim on an idempotency key after a failure, so that a retry of the message is processed
+  Keyword arguments:
+  idempotency_key -- the key for the message, as returned by build_message_idempotency_key
+
+  eg: release_idempotency_key(idempotency_key=idempotency_key)
+  """
+  if idempotency_key is None :
+    return
+  try:
+    idempotency_store = _retrieve_idempotency_store()
+    if idempotency_store is not None :
+      idempotency_store.release(idempotency_key)
+      _increment_metric("released")
+  except Exception as e:
+    _increment_metric("errors")
+    logging.warning(f'Manual log - Error releasing idempotency key: {e}')
+
+## Define function to retrieve a snapshot of the idempotency metrics
+def retrieve_idempotency_metrics():
+  """
+  Retrieve a snapshot of the claimed, duplicate, in progress, taken over, completed, released and evicted idempotency key counts and the store errors
+  """
+  with _idempotency_store_lock:
+    return dict(_idempotency_metrics)
+
+## Export the idempotency key counters
+register_metrics_snapshot("idempotency", retrieve_idempotency_metrics, "Idempotency key claim, duplicate, completion and store error counters")
@@ -0,0 +1,259 @@
+
+# Opt-in sampling profiler for function invocations, to
+# show where the time goes in a cold invocation compared
+# to a warm one, such as importing Snowpark, probing the
+# DefaultAzureCredential chain, deserializing a private key
+# or logging in to Snowflake. When the
+# INVOCATION_PROFILING_ENABLED app setting is true, each
+# invocation of a main function wrapped in
+# profile_invocation is sampled by a background thread,
+# tagged as cold for the first invocation of the function
+# in this worker and warm otherwise, and written to a blob
+# container in the folded stack format understood by flame
+# graph tools such as speedscope and flamegraph.pl
+#
+# The hottest functions are logged after each profiled
+# invocation and aggregated for the lifetime of the worker.
+# Profiles downloaded from the container can be aggregated
+# with benchmarks/invocation_profile_summary.py. Only the
+# thread running main is sampled, so work handed to a
+# thread pool appears as time spent waiting for it
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import os
+import sys
+import time
+import uuid
+import inspect
+import functools
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .blob_client_registry import retrieve_blob_client
+
+## Module-level state which lives for the lifetime of the worker
+_invoked_function_names = set()
+_aggregated_profiles = {}
+_frame_labels = {}
+_profile_upload_executor = None
+_invocation_profiling_lock = threading.Lock()
+
+## Define function to determine whether profiling is enabled
+def is_invocation_profiling_enabled():
+  """
+  Determine whether invocations are profiled, based on the INVOCATION_PROFILING_ENABLED app setting
+  """
+  return os.getenv("INVOCATION_PROFILING_ENABLED", "false").lower() == "true"
+
+## Define function to label a frame for the
+## folded stack format, caching the label by code object
+def _retrieve_frame_label(frame_code):
+  frame_label = _frame_labels.get(frame_code)
+  if frame_label is None :
+
+    ### Shorten the file path to be relative to the
+    ### longest matching entry on the import path
+    file_path = frame_code.co_filename
+    matching_import_paths = [import_path for import_path in sys.path if import_path and file_path.startswith(import_path.rstrip(os.sep) + os.sep)]
+    if len(matching_import_paths) > 0 :
+      file_path = os.path.relpath(file_path, max(matching_import_paths, key=len))
+
+    ### Semicolons separate frames in the folded stack format
+    frame_label = f"{frame_code.co_name} ({file_path}:{frame_code.co_firstlineno})".replace(";", ",")
+    _frame_labels[frame_code] = frame_label
+  return frame_label
+
+## Sampling profiler for a single thread
+class _StackSampler(threading.Thread):
+  def __init__(self, target_thread_id: int, interval_seconds: float):
+    super().__init__(name="invocation-profiler", daemon=True)
+    self._target_thread_id = target_thread_id
+    self._interval_seconds = interval_seconds
+    self._stop_event = threading.Event()
+    self.folded_stacks = Counter()
+
+  def run(self):
+    while not self._stop_event.wait(self._interval_seconds):
+      frame = sys._current_frames().get(self._target_thread_id)
+      frame_labels = []
+      while frame is not None :
+        frame_labels.append(_retrieve_frame_label(frame.f_code))
+        frame = frame.f_back
+      if len(frame_labels) > 0 :
+        self.folded_stacks[";".join(reversed(frame_labels))] += 1
+
+  def stop(self):
+    self._stop_event.set()
+    self.join()
+    return self.folded_stacks
+
+## Define function to tag an invocation as cold if it is the
+## first invocation of the function in this worker
+def _claim_start_type(function_name: str):
+  with _invocation_profiling_lock:
+    if function_name in _invoked_function_names :
+      return "warm"
+    _invoked_function_names.add(function_name)
+    return "cold"
+
+## Define function to start sampling the current thread
+def _start_stack_sampler():
+  interval_milliseconds = retrieve_int_app_setting("INVOCATION_PROFILING_INTERVAL_MILLISECONDS", 10)
+  stack_sampler = _StackSampler(threading.get_ident(), max(1, interval_milliseconds) / 1000)
+  stack_sampler.start()
+  return stack_sampler
+
+## Define function to summarize folded stacks
+def summarize_folded_stacks(folded_stacks: dict, top_n: int = 10):
+  """
+  Summarize the hottest functions in a profile, by the samples in which each function was running (self) or on the stack (inclusive)
+  Keyword arguments:
+  folded_stacks -- a dictionary of the sample count for each stack, in the folded stack format
+  top_n -- the number of functions to report (default 10)
+
+  eg: summarize_folded_stacks(folded_stacks={"main (app.py:1);run (app.py:9)": 42}, top_n=5)
+  """
+  self_samples = Counter()
+  inclusive_samples = Counter()
+  for folded_stack, sample_count in folded_stacks.items():
+    frame_labels = folded_stack.split(";")
+    self_samples[frame_labels[-1]] += sample_count
+    for frame_label in set(frame_labels):
+      inclusive_samples[frame_label] += sample_count
+
+  total_samples = sum(folded_stacks.values())
+  def build_ranking(function_samples: Counter):
+    return [
+        {"function": frame_label, "samples": sample_count, "percent": 100 * sample_count / total_samples}
+        for frame_label, sample_count in function_samples.most_common(top_n)
+    ]
+  return {
+      "samples": total_samples
+    , "self": build_ranking(self_samples)
+    , "inclusive": build_ranking(inclusive_samples)
+  }
+
+## Define function to upload a profile to blob storage
+def _upload_profile(blob_name: str, folded_stacks: Counter, profile_metadata: dict):
+  storage_blob_service_uri = os.getenv("AZURE_STORAGE_IDENTITY__blobServiceUri")
+  profiling_container = os.getenv("INVOCATION_PROFILING_CONTAINER", "function-invocation-profiles")
+  try:
+    blob_client = retrieve_blob_client(storage_blob_service_uri, profiling_container, blob_name)
+    blob_client.upload_blob(
+        "".join(f"{folded_stack} {sample_count}\n" for folded_stack, sample_count in folded_stacks.items()).encode()
+      , overwrite = True
+      , metadata = profile_metadata
+    )
+    logging.info(f'Manual log - Uploaded invocation profile to {profiling_container}/{blob_name}')
+  except Exception as e:
+    logging.warning(f'Manual log - Error uploading invocation profile {blob_name}: {e}')
+
+## Define function to record a completed profile, log its
+## hottest functions and upload it in the background
+def _conclude_profile(function_name: str, start_type: str, stack_sampler: _StackSampler, duration_seconds: float):
+  global _profile_upload_executor
+  folded_stacks = stack_sampler.stop()
+  top_n = retrieve_int_app_setting("INVOCATION_PROFILING_TOP_N", 10)
+
+  with _invocation_profiling_lock:
+    aggregated_profile = _aggregated_profiles.setdefault((function_name, start_type), {"profiles": 0, "seconds_total": 0.0, "folded_stacks": Counter()})
+    aggregated_profile["profiles"] += 1
+    aggregated_profile["seconds_total"] += duration_seconds
+    aggregated_profile["folded_stacks"].update(folded_stacks)
+    if _profile_upload_executor is None :
+      _profile_upload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="invocation-profile-upload")
+
+  profile_summary = summarize_folded_stacks(folded_stacks, top_n)
+  logging.info(f'Manual log - Profiled {start_type} invocation of {function_name} in {duration_seconds:.3f} seconds with {profile_summary["samples"]} samples')
+  for hot_function in profile_summary["self"]:
+    logging.info(f'Manual log - {hot_function["percent"]:5.1f}% {hot_function["function"]}')
+
+  ### Upload the profile without delaying the invocation
+  if len(folded_stacks) > 0 :
+    profile_timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    _profile_upload_executor.submit(
+        _upload_profile
+      , f"{function_name}/{start_type}/{profile_timestamp}_{uuid.uuid4().hex[:8]}.folded"
+      , folded_stacks
+      , {
+            "function_name": function_name
+          , "start_type": start_type
+          , "duration_ms": f"{duration_seconds * 1000:.1f}"
+          , "samples": str(profile_summary["samples"])
+        }
+    )
+
+## Define decorator which profiles each invocation
+## of a main function when profiling is enabled
+def profile_invocation(function_main):
+  """
+  Wrap the main function of an Azure function so that each invocation is profiled when the INVOCATION_PROFILING_ENABLED app setting is true
+  Keyword arguments:
+  function_main -- the main function, which may be asynchronous
+
+  The wrapper keeps the signature of the main function, which
+  the Azure Functions host inspects to bind the trigger
+
+  eg:
+  @profile_invocation
+  def main(req: func.HttpRequest) -> func.HttpResponse:
+  """
+  function_name = function_main.__module__.rsplit(".", 1)[-1]
+
+  if inspect.iscoroutinefunction(function_main) :
+    @functools.wraps(function_main)
+    async def profiled_main_async(*args, **kwargs):
+      start_type = _claim_start_type(function_name)
+      if not is_invocation_profiling_enabled() :
+        return await function_main(*args, **kwargs)
+      stack_sampler = _start_stack_sampler()
+      invocation_start = time.perf_counter()
+      try:
+        return await function_main(*args, **kwargs)
+      finally:
+        _conclude_profile(function_name, start_type, stack_sampler, time.perf_counter() - invocation_start)
+    return profiled_main_async
+
+  @functools.wraps(function_main)
+  def profiled_main(*args, **kwargs):
+    start_type = _claim_start_type(function_name)
+    if not is_invocation_profiling_enabled() :
+      return function_main(*args, **kwargs)
+    stack_sampler = _start_stack_sampler()
+    invocation_start = time.perf_counter()
+    try:
+      return function_main(*args, **kwargs)
+    finally:
+      _conclude_profile(function_name, start_type, stack_sampler, time.perf_counter() - invocation_start)
+  return profiled_main
+
+## Define function to retrieve the hottest functions
+## of the profiles recorded by this worker
+def retrieve_invocation_profile_summary(top_n: int = 10):
+  """
+  Retrieve the hottest functions across the profiles recorded by this worker, for each function and start type
+  Keyword arguments:
+  top_n -- the number of functions to report for each function and start type (default 10)
+
+  eg: retrieve_invocation_profile_summary(top_n=5)["connection_leveraging_app_settings_directly/cold"]
+  """
+  with _invocation_profiling_lock:
+    aggregated_profiles = {
+        profile_key: {**aggregated_profile, "folded_stacks": Counter(aggregated_profile["folded_stacks"])}
+        for profile_key, aggregated_profile in _aggregated_profiles.items()
+    }
+  return {
+      f"{function_name}/{start_type}": {
+          "profiles": aggregated_profile["profiles"]
+        , "seconds_mean": aggregated_profile["seconds_total"] / aggregated_profile["profiles"]
+        , **summarize_folded_stacks(aggregated_profile["folded_stacks"], top_n)
+      }
+      for (function_name, start_type), aggregated_profile in aggregated_profiles.items()
+  }
@@ -0,0 +1,92 @@
+
+# Deferred imports for heavy packages. The Python worker
+# loads every function in the function app when it starts,
+# so importing Snowpark, pandas, pyarrow, cryptography and
+# the Azure SDKs at module load adds to every cold start,
+# even for functions that never use them. The objects
+# returned here only import their module the first time
+# that one of their attributes is used or they are called.
+# Exception classes must be imported directly instead, since
+# an except clause only accepts the class itself
+
+## Import other packages
+import importlib
+import threading
+
+## Define a module whose import is deferred until first use
+class LazyModule:
+  """
+  Stand-in for a module which imports the module the first time one of its attributes is accessed
+  """
+  def __init__(self, module_name: str, package: str = None):
+    self._module_name = module_name
+    self._package = package
+    self._module = None
+    self._import_lock = threading.Lock()
+
+  def _load(self):
+    if self._module is None :
+      with self._import_lock:
+        if self._module is None :
+          self._module = importlib.import_module(self._module_name, self._package)
+    return self._module
+
+  def __getattr__(self, attribute_name: str):
+    return getattr(self._load(), attribute_name)
+
+  def __repr__(self):
+    return f"<lazily imported module {self._module_name}>"
+
+## Define an attribute of a module whose
+## import is deferred until first use
+class LazyAttribute:
+  """
+  Stand-in for a class or function from a module which imports the module the first time it is used or called
+  """
+  def __init__(self, module_name: str, attribute_name: str, package: str = None):
+    self._lazy_module = LazyModule(module_name, package)
+    self._attribute_name = attribute_name
+
+  def _load(self):
+    return getattr(self._lazy_module, self._attribute_name)
+
+  ### Follow the functools convention so that callers
+  ### can reach the real class or function if needed
+  @property
+  def __wrapped__(self):
+    return self._load()
+
+  def __getattr__(self, attribute_name: str):
+    return getattr(self._load(), attribute_name)
+
+  def __call__(self, *args, **kwargs):
+    return self._load()(*args, **kwargs)
+
+  def __repr__(self):
+    return f"<lazily imported {self._lazy_module._module_name}.{self._attribute_name}>"
+
+## Define function to defer the import of a module
+def import_module_lazily(module_name: str, package: str = None):
+  """
+  Return a stand-in for a module which is only imported when first used
+  Keyword arguments:
+  module_name -- the full name of the module, or a relative name if package is given
+  package -- the package to resolve a relative module name against (default None)
+
+  eg: pyarrow = import_module_lazily("pyarrow")
+  """
+  return LazyModule(module_name, package)
+
+## Define function to defer the import
+## of an attribute of a module
+def import_attribute_lazily(module_name: str, attribute_name: str, package: str = None):
+  """
+  Return a stand-in for a class or function from a module, which is only imported when first used or called
+  Keyword arguments:
+  module_name -- the full name of the module, or a relative name if package is given
+  attribute_name -- the name of the class or function within the module
+  package -- the package to resolve a relative module name against (default None)
+
+  eg: Session = import_attribute_lazily("snowflake.snowpark", "Session")
+  """
+  return LazyAttribute(module_name, attribute_name, package)
@@ -0,0 +1,268 @@
+
+# Routing of the blob events delivered to the storage queue
+# triggered functions. The storage accounts and containers
+# which the function app ingests from are read from app
+# settings once, into a lookup table keyed on the host of
+# each storage account, so that routing a message needs
+# neither app settings nor any Azure SDK object. Each message
+# is parsed once, whether it holds a single Event Grid event
+# or a batched array of events, and each event is matched to
+# the handler and credential of its storage account and
+# container. Events for any other storage account or
+# container are rejected before any download, blob client
+# or Snowflake session is created
+#
+# Expected format of the STORAGE_MESSAGE_ROUTES app setting:
+#   [
+#     {
+#         "connection": "AZURE_STORAGE_IDENTITY"
+#       , "containers": ["automated-function-trigger-demo"]
+#       , "handler": "auto"
+#     }
+#   ]
+#
+# where each "connection" is the prefix of the app settings
+# for an identity-based storage connection, so the storage
+# account is taken from <connection>__blobServiceUri and a
+# user-assigned managed identity, if any, from
+# <connection>__clientId. Both "containers" and "handler"
+# are optional, where omitting "containers" matches every
+# container. The "handler" is one of:
+#   - "auto", which loads blobs matching a bulk ingestion
+#     route with COPY INTO and executes any other blob as
+#     a JSON control file
+#   - "control_file", which executes every blob as a JSON
+#     control file
+#   - "ignore", which acknowledges events without any
+#     processing, such as for a container of spilled results
+# When the app setting is not populated, every container in
+# the AZURE_STORAGE_IDENTITY connection is routed to "auto"
+
+## Import Azure packages
+import logging
+import azure.functions as func
+
+## Import other packages
+import os
+import json
+import threading
+
+## Import shared packages
+from .telemetry import register_metrics_snapshot
+
+## Handlers which may be given for a route
+MESSAGE_HANDLERS = ("auto", "control_file", "ignore")
+
+## Route used when the STORAGE_MESSAGE_ROUTES app setting is not populated
+DEFAULT_STORAGE_MESSAGE_ROUTES = [{"connection": "AZURE_STORAGE_IDENTITY"}]
+
+## Module-level state which lives for the lifetime of the worker
+_message_routing_table = None
+_message_routing_lock = threading.Lock()
+_message_routing_metrics = {
+    "messages": 0
+  , "events": 0
+  , "routed": 0
+  , "rejected": 0
+  , "ignored": 0
+}
+
+## Define function to increment a routing metric
+def _increment_message_routing_metric(metric_name: str, amount=1):
+  with _message_routing_lock:
+    _message_routing_metrics[metric_name] += amount
+
+## Define function to split a URL into the host of
+## its storage account and the path beneath it
+def _split_storage_url(storage_url: str):
+  _, _, url_without_scheme = storage_url.partition("://")
+  storage_account_host, _, url_path = url_without_scheme.partition("/")
+  return storage_account_host.lower(), url_path
+
+## Define function to build the lookup table from app settings
+def _build_message_routing_table():
+  storage_message_routes_value = os.getenv("STORAGE_MESSAGE_ROUTES") or ""
+  using_default_routes = len(storage_message_routes_value.strip()) == 0
+  storage_message_routes = DEFAULT_STORAGE_MESSAGE_ROUTES if using_default_routes else json.loads(storage_message_routes_value)
+  if not isinstance(storage_message_routes, list) :
+    raise ValueError("The STORAGE_MESSAGE_ROUTES app setting must be a JSON array of routes")
+
+  message_routing_table = {}
+  for route_number, storage_message_route in enumerate(storage_message_routes, start=1):
+    if not isinstance(storage_message_route, dict) or not isinstance(storage_message_route.get("connection"), str) :
+      raise ValueError(f"Storage message route {route_number} does not contain a 'connection'")
+    handler = storage_message_route.get("handler", "auto")
+    if handler not in MESSAGE_HANDLERS :
+      raise ValueError(f"Storage message route {route_number} contains an unsupported 'handler' {handler}")
+    containers = storage_message_route.get("containers")
+    if containers is not None and (not isinstance(containers, list) or not all(isinstance(container, str) for container in containers)) :
+      raise ValueError(f"Storage message route {route_number} contains a 'containers' that is not a list of container names")
+
+    ### Read the storage account and identity of the connection
+    connection = storage_message_route["connection"]
+    storage_blob_service_uri = os.getenv(f"{connection}__blobServiceUri")
+    if storage_blob_service_uri is None or len(storage_blob_service_uri) == 0 :
+
+      #### Functions which do not read from the queue may
+      #### not populate the default connection at all
+      if using_default_routes :
+        continue
+      raise ValueError(f"Storage message route {route_number} refers to connection {connection}, but {connection}__blobServiceUri is not populated")
+    storage_blob_service_uri = storage_blob_service_uri.rstrip("/")
+    storage_account_host, _ = _split_storage_url(storage_blob_service_uri)
+
+    storage_account_entry = message_routing_table.setdefault(storage_account_host, {
+        "storage_blob_service_uri": storage_blob_service_uri
+      , "client_id": os.getenv(f"{connection}__clientId") or None
+      , "containers": {}
+      , "default_handler": None
+    })
+    if containers is None :
+      storage_account_entry["default_handler"] = storage_account_entry["default_handler"] or handler
+    else :
+      for container in containers:
+        storage_account_entry["containers"].setdefault(container, handler)
+
+    ### Data Lake events may refer to the blob by its dfs
+    ### endpoint, so that host is routed to the same account
+    if ".blob." in storage_account_host :
+      message_routing_table.setdefault(storage_account_host.replace(".blob.", ".dfs.", 1), storage_account_entry)
+
+  return message_routing_table
+
+## Define function to retrieve the lookup table,
+## building it on first use
+def retrieve_message_routing_table():
+  """
+  Retrieve the worker-scoped lookup table of storage accounts and containers, keyed on the host of each storage account
+  """
+  global _message_routing_table
+  if _message_routing_table is None :
+    with _message_routing_lock:
+      if _message_routing_table is None :
+        _message_routing_table = _build_message_routing_table()
+        logging.info(f'Manual log - Built message routing table for {len(_message_routing_table)} storage account hosts')
+  return _message_routing_table
+
+## Define function to rebuild the lookup table,
+## for example after app settings have changed
+def refresh_message_routing_table():
+  """
+  Rebuild the lookup table of storage accounts and containers from the STORAGE_MESSAGE_ROUTES app setting
+  """
+  global _message_routing_table
+  message_routing_table = _build_message_routing_table()
+  with _message_routing_lock:
+    _message_routing_table = message_routing_table
+  return message_routing_table
+
+## Define function to retrieve the managed identity
+## for a storage account in the lookup table
+def retrieve_storage_account_client_id(storage_blob_service_uri: str):
+  """
+  Retrieve the client ID of the user-assigned managed identity for a storage account, or None to use the DefaultAzureCredential
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service
+
+  eg: retrieve_storage_account_client_id(storage_blob_service_uri="https://my-storage-account.blob.core.windows.net")
+  """
+  storage_account_host, _ = _split_storage_url(storage_blob_service_uri)
+  storage_account_entry = retrieve_message_routing_table().get(storage_account_host)
+  return storage_account_entry["client_id"] if storage_account_entry is not None else None
+
+## Define function to parse the events in a message
+def parse_event_grid_events(msg: func.QueueMessage):
+  """
+  Parse the Event Grid events in a storage queue message once, whether the message holds a single event or a batched array of events
+  Keyword arguments:
+  msg -- the storage queue message containing one or more blob events
+
+  eg: parse_event_grid_events(msg=msg)
+  """
+  msg_json = msg.get_json()
+  events = msg_json if isinstance(msg_json, list) else [msg_json]
+  if not all(isinstance(event, dict) for event in events) :
+    raise ValueError("Function abort - Message does not contain Event Grid events")
+  return events
+
+## Define function to match a single event
+## to its storage account and container
+def route_blob_event(event: dict):
+  """
+  Match a single Event Grid blob event against the lookup table, returning the blob and its handler, or None if the event is not for a known storage account and container
+  Keyword arguments:
+  event -- the Event Grid event, in either the Event Grid or the CloudEvents schema
+
+  eg: route_blob_event(event={"id": "...", "data": {"url": "https://my-storage-account.blob.core.windows.net/my-container/file.json"}})
+  """
+  event_data = event.get("data") if isinstance(event.get("data"), dict) else {}
+
+  ### Prefer the blob URL, since Data Lake events may
+  ### give the dfs endpoint as the URL of the blob
+  file_path_url = event_data.get("blobUrl") or event_data.get("url")
+  if not isinstance(file_path_url, str) :
+    return None
+
+  ### Reject events for unknown storage accounts and
+  ### containers with dictionary lookups alone
+  storage_account_host, file_path = _split_storage_url(file_path_url)
+  storage_account_entry = retrieve_message_routing_table().get(storage_account_host)
+  if storage_account_entry is None :
+    return None
+  container, _, relative_file_path = file_path.partition("/")
+  handler = storage_account_entry["containers"].get(container, storage_account_entry["default_handler"])
+  if handler is None or len(relative_file_path) == 0 :
+    return None
+
+  return {
+      "event_id": event.get("id")
+    , "etag": event_data.get("eTag")
+    , "content_length": event_data.get("contentLength")
+    , "content_type": event_data.get("contentType")
+    , "storage_blob_service_uri": storage_account_entry["storage_blob_service_uri"]
+    , "container": container
+    , "relative_file_path": relative_file_path
+    , "handler": handler
+  }
+
+## Define function to route every event in a message
+def route_queue_message(msg: func.QueueMessage):
+  """
+  Parse a storage queue message once and route each of its blob events, logging and dropping any event which is ignored or not for a known storage account and container
+  Keyword arguments:
+  msg -- the storage queue message containing one or more blob events
+
+  Returns a list with one dictionary per routed event, containing its event_id, etag, content_length,
+  content_type, storage_blob_service_uri, container, relative_file_path and handler
+
+  eg: route_queue_message(msg=msg)
+  """
+  events = parse_event_grid_events(msg)
+  routed_blob_events = []
+  for event in events:
+    routed_blob_event = route_blob_event(event)
+    if routed_blob_event is None :
+      _increment_message_routing_metric("rejected")
+      logging.warning(f'Manual log - Rejecting event {event.get("id")} in message {msg.id}, which is not for a known storage account and container')
+    elif routed_blob_event["handler"] == "ignore" :
+      _increment_message_routing_metric("ignored")
+      logging.info(f'Manual log - Ignoring event {routed_blob_event["event_id"]} for {routed_blob_event["container"]}/{routed_blob_event["relative_file_path"]}')
+    else :
+      _increment_message_routing_metric("routed")
+      logging.info(f'Manual log - Routed event {routed_blob_event["event_id"]} to {routed_blob_event["handler"]} for {routed_blob_event["container"]}/{routed_blob_event["relative_file_path"]}')
+      routed_blob_events.append(routed_blob_event)
+  with _message_routing_lock:
+    _message_routing_metrics["messages"] += 1
+    _message_routing_metrics["events"] += len(events)
+  return routed_blob_events
+
+## Define function to retrieve a snapshot of the routing metrics
+def retrieve_message_routing_metrics():
+  """
+  Retrieve a snapshot of the message, event, routed, rejected and ignored counters
+  """
+  with _message_routing_lock:
+    return dict(_message_routing_metrics)
+
+## Export the routing counters
+register_metrics_snapshot("message_routing", retrieve_message_routing_metrics, "Storage queue message and blob event routing counters")
@@ -0,0 +1,218 @@
+
+# Worker-scoped cache of the results of read-only metadata
+# queries, such as SHOW DATABASES. Results are cached as Arrow
+# batches keyed on the connection configuration, user, role,
+# warehouse and SQL statement. Fresh results are served without
+# a Snowflake session at all, stale results are served whilst
+# they are refreshed in the background, and the cache can be
+# invalidated explicitly
+#
+# An explicit invalidation only clears the cache of the worker
+# which receives it, unless METADATA_CACHE_INVALIDATION_BLOB is
+# populated. The invalidation then also overwrites that blob,
+# and every worker clears its cache when it sees the ETag of
+# the blob change, checking at most once every
+# METADATA_CACHE_INVALIDATION_CHECK_SECONDS
+
+## Import Azure packages
+import logging
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+## Import other packages
+import os
+import time
+import threading
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .snowpark_session_pool import pooled_snowpark_session, build_session_pool_key
+from .http_responses import fetch_arrow_batches
+from .blob_client_registry import retrieve_blob_client, retrieve_container_client
+from .dependency_resilience import call_with_retries
+from .telemetry import timed_stage
+
+## Leading keywords of the statements which may be cached
+READ_ONLY_METADATA_KEYWORDS = ("SHOW", "DESCRIBE", "DESC", "LIST", "LS")
+
+## Module-level state which lives for the lifetime of the worker
+_cached_metadata_results = {}
+_refreshing_metadata_results = set()
+_metadata_cache_lock = threading.Lock()
+_invalidation_marker = {"etag": None, "observed": False, "checked_at": None}
+
+## Define function that determines whether a
+## statement may be served from the cache
+def is_read_only_metadata_statement(sql_statement: str):
+  """
+  Determine whether a SQL statement is a read-only metadata statement that may be cached
+  Keyword arguments:
+  sql_statement -- the SQL statement
+
+  eg: is_read_only_metadata_statement(sql_statement="SHOW DATABASES")
+  """
+  statement_words = sql_statement.strip().split(None, 1)
+  return len(statement_words) > 0 and statement_words[0].upper() in READ_ONLY_METADATA_KEYWORDS
+
+## Define function to retrieve the blob client for the
+## shared invalidation marker, or None if there is none
+def _retrieve_invalidation_marker_blob_client():
+  invalidation_blob = os.getenv("METADATA_CACHE_INVALIDATION_BLOB") or ""
+  if len(invalidation_blob.strip()) == 0 :
+    return None
+  container, _, blob_name = invalidation_blob.strip().partition("/")
+  if len(container) == 0 or len(blob_name) == 0 :
+    raise ValueError("The METADATA_CACHE_INVALIDATION_BLOB app setting must be given as <container>/<blob path>")
+  return retrieve_blob_client(os.getenv("AZURE_STORAGE_IDENTITY__blobServiceUri"), container, blob_name)
+
+## Define function which clears the cache of this worker if
+## another worker has invalidated it since the last check
+def _check_invalidation_marker():
+  invalidation_marker_blob_client = _retrieve_invalidation_marker_blob_client()
+  if invalidation_marker_blob_client is None :
+    return
+
+  ### Only check the marker once per interval
+  check_interval_seconds = retrieve_int_app_setting("METADATA_CACHE_INVALIDATION_CHECK_SECONDS", 30)
+  now = time.monotonic()
+  with _metadata_cache_lock:
+    if _invalidation_marker["checked_at"] is not None and now - _invalidation_marker["checked_at"] < check_interval_seconds :
+      return
+    _invalidation_marker["checked_at"] = now
+
+  ### Serve the cache as it is if the marker cannot be read
+  try:
+    invalidation_marker_etag = call_with_retries("blob_storage", invalidation_marker_blob_client.get_blob_properties).etag
+  except ResourceNotFoundError:
+    invalidation_marker_etag = None
+  except Exception as e:
+    logging.warning(f'Manual log - Error checking the metadata cache invalidation marker: {e}')
+    return
+
+  with _metadata_cache_lock:
+    invalidated_elsewhere = _invalidation_marker["observed"] and _invalidation_marker["etag"] != invalidation_marker_etag
+    _invalidation_marker["etag"] = invalidation_marker_etag
+    _invalidation_marker["observed"] = True
+    if invalidated_elsewhere :
+      _cached_metadata_results.clear()
+  if invalidated_elsewhere :
+    logging.info(f'Manual log - Cleared cached metadata results invalidated by another worker')
+
+## Define function which overwrites the invalidation
+## marker so that every other worker clears its cache
+def _touch_invalidation_marker():
+  invalidation_marker_blob_client = _retrieve_invalidation_marker_blob_client()
+  if invalidation_marker_blob_client is None :
+    return
+  try:
+    call_with_retries("blob_storage", retrieve_container_client(os.getenv("AZURE_STORAGE_IDENTITY__blobServiceUri"), invalidation_marker_blob_client.container_name).create_container)
+  except ResourceExistsError:
+    pass
+  call_with_retries("blob_storage", invalidation_marker_blob_client.upload_blob, str(time.time()).encode(), overwrite=True)
+
+  ### Observe the new ETag at the next check without
+  ### clearing the cache of this worker a second time
+  with _metadata_cache_lock:
+    _invalidation_marker["observed"] = False
+    _invalidation_marker["checked_at"] = None
+
+## Define function to build the cache key for a statement
+def _build_metadata_cache_key(session_builder, sql_statement: str):
+  return (
+      build_session_pool_key(session_builder)
+    , os.getenv("SNOWFLAKE_USER")
+    , os.getenv("SNOWFLAKE_ROLE")
+    , os.getenv("SNOWFLAKE_WAREHOUSE")
+    , " ".join(sql_statement.split())
+  )
+
+## Define function to execute a metadata statement
+## and store its result in the cache
+def _fetch_and_cache_metadata_result(cache_key: tuple, session_builder, sql_statement: str):
+  with pooled_snowpark_session(session_builder) as snowpark_session:
+    with timed_stage("query_execute", statement=sql_statement) as query_attributes:
+      metadata_batches = list(fetch_arrow_batches(snowpark_session, sql_statement, query_attributes))
+  with _metadata_cache_lock:
+    _cached_metadata_results[cache_key] = {"batches": metadata_batches, "cached_at": time.monotonic()}
+  return metadata_batches
+
+## Define function which refreshes a cached
+## result on a background thread
+def _refresh_metadata_result_in_background(cache_key: tuple, session_builder, sql_statement: str):
+  try:
+    _fetch_and_cache_metadata_result(cache_key, session_builder, sql_statement)
+    logging.info(f'Manual log - Refreshed cached metadata result for {sql_statement} in the background')
+  except Exception as e:
+    logging.warning(f'Manual log - Error refreshing cached metadata result for {sql_statement} in the background: {e}')
+  finally:
+    with _metadata_cache_lock:
+      _refreshing_metadata_results.discard(cache_key)
+
+## Define function to retrieve the result of a
+## metadata statement, leveraging the cache
+def retrieve_cached_metadata_batches(session_builder, sql_statement: str):
+  """
+  Retrieve the result of a read-only metadata statement as Arrow batches, served from the worker-scoped cache where possible
+  Keyword arguments:
+  session_builder -- a function without arguments that creates a new Snowpark session, leveraged through the session pool
+  sql_statement -- the read-only metadata statement, such as "SHOW DATABASES"
+
+  Results younger than METADATA_CACHE_TTL_SECONDS are served directly. Results up to
+  METADATA_CACHE_STALE_SECONDS older than that are served whilst being refreshed in the background.
+
+  eg: retrieve_cached_metadata_batches(session_builder=build_snowpark_session, sql_statement="SHOW DATABASES")
+  """
+  if not is_read_only_metadata_statement(sql_statement) :
+    raise ValueError(f"Only read-only metadata statements beginning with {READ_ONLY_METADATA_KEYWORDS} may be cached")
+
+  ### Clear the cache first if another worker has invalidated it
+  _check_invalidation_marker()
+
+  cache_key = _build_metadata_cache_key(session_builder, sql_statement)
+  ttl_seconds = retrieve_int_app_setting("METADATA_CACHE_TTL_SECONDS", 300)
+  stale_seconds = retrieve_int_app_setting("METADATA_CACHE_STALE_SECONDS", 3600)
+
+  with _metadata_cache_lock:
+    cached_result = _cached_metadata_results.get(cache_key)
+
+  ### Execute synchronously if there is no usable cached result
+  if cached_result is None :
+    return _fetch_and_cache_metadata_result(cache_key, session_builder, sql_statement)
+  cached_result_age = time.monotonic() - cached_result["cached_at"]
+  if cached_result_age > ttl_seconds + stale_seconds :
+    return _fetch_and_cache_metadata_result(cache_key, session_builder, sql_statement)
+
+  ### Serve a stale result whilst refreshing it in the background
+  if cached_result_age > ttl_seconds :
+    with _metadata_cache_lock:
+      start_refresh = cache_key not in _refreshing_metadata_results
+      _refreshing_metadata_results.add(cache_key)
+    if start_refresh :
+      threading.Thread(
+          target = _refresh_metadata_result_in_background
+        , args = (cache_key, session_builder, sql_statement)
+        , daemon = True
+      ).start()
+
+  return cached_result["batches"]
+
+## Define function to invalidate cached metadata results
+def invalidate_metadata_cache(session_builder=None):
+  """
+  Remove cached metadata results so that they are executed again on next use
+  Keyword arguments:
+  session_builder -- only remove results cached for this session builder (default None, removing every result)
+
+  Only the cache of this worker is cleared, unless METADATA_CACHE_INVALIDATION_BLOB is populated,
+  in which case every other worker clears its whole cache within METADATA_CACHE_INVALIDATION_CHECK_SECONDS
+
+  eg: invalidate_metadata_cache(session_builder=build_snowpark_session)
+  """
+  with _metadata_cache_lock:
+    if session_builder is None :
+      _cached_metadata_results.clear()
+    else :
+      session_pool_key = build_session_pool_key(session_builder)
+      for cache_key in [cache_key for cache_key in _cached_metadata_results if cache_key[0] == session_pool_key]:
+        del _cached_metadata_results[cache_key]
+  _touch_invalidation_marker()
+  logging.info(f'Manual log - Invalidated cached metadata results')
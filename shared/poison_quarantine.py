@@ -0,0 +1,346 @@
+
+# Quarantine of blobs which can never be processed. A malformed
+# control file, or one without any SQL statements, only fails
+# after it has been downloaded and parsed, and the queue would
+# otherwise retry it up to the dequeue limit, paying for the
+# download every time. Instead, the size and content type of
+# each control file are checked before it is downloaded, from
+# the blob created event where possible and otherwise from the
+# properties of the blob. A control file which fails these
+# checks, or whose content cannot be interpreted, is recorded
+# against a fingerprint of its blob URL, ETag and the class of
+# the error, copied with diagnostics to a poison container and
+# acknowledged, so that its message is not retried. A repeated
+# delivery of a blob which is already recorded is short-circuited
+# before any download. Transient failures, such as timeouts or
+# throttling, and authorization failures are never quarantined
+#
+# Each quarantined blob is written to the poison container of
+# its own storage account as:
+#   <container>/<relative_file_path>.<fingerprint>.diagnostics.json
+#   <container>/<relative_file_path>.<fingerprint>
+# where the copy of the blob itself is only written if the
+# blob is no larger than the maximum size of a control file,
+# or 10 MB if the size of control files is not limited.
+# The original blob is left in place
+
+## Import Azure packages
+import logging
+from azure.core.exceptions import ResourceExistsError
+
+## Import other packages
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .blob_client_registry import retrieve_blob_client, retrieve_container_client
+from .dependency_resilience import call_with_retries, is_transient_dependency_error
+from .telemetry import timed_stage, register_metrics_snapshot
+
+## Content types which may be given for a control file by default
+DEFAULT_ALLOWED_CONTENT_TYPES = "application/json,text/json,text/plain,application/octet-stream"
+
+## HTTP status codes which indicate that the function app is not
+## authorized, rather than that the blob itself is at fault
+AUTHORIZATION_HTTP_STATUS_CODES = {401, 403}
+
+## Classes of error raised when the content of a blob is not valid JSON
+JSON_ERROR_CLASS_NAMES = {"JSONError", "IncompleteJSONError", "JSONDecodeError", "UnicodeDecodeError", "JSONNotObjectError"}
+
+## Class of error raised when the function app could not authenticate
+AUTHENTICATION_ERROR_CLASS_NAME = "ClientAuthenticationError"
+
+## Largest blob which is copied to the poison container when
+## the size of control files is not limited, so that quarantining
+## an oversized blob does not download it into memory
+DEFAULT_MAX_COPIED_BLOB_BYTES = 10 * 1024 * 1024
+
+## Module-level state which lives for the lifetime of the worker
+_quarantine_records = OrderedDict()
+_poison_containers = set()
+_poison_quarantine_lock = threading.Lock()
+_poison_quarantine_metrics = {
+    "validated": 0
+  , "validation_failures": 0
+  , "quarantined": 0
+  , "short_circuited": 0
+  , "quarantine_errors": 0
+}
+
+## Define an error for a blob which can never be processed
+class PoisonBlobError(ValueError):
+  """
+  Raised when a control file fails its checks before download, or has already been quarantined
+  """
+
+## Define function to increment a quarantine metric
+def _increment_poison_quarantine_metric(metric_name: str, amount=1):
+  with _poison_quarantine_lock:
+    _poison_quarantine_metrics[metric_name] += amount
+
+## Define function to determine whether quarantine is enabled
+def is_poison_quarantine_enabled():
+  """
+  Determine whether control files are checked before download and quarantined, from the POISON_QUARANTINE_ENABLED app setting
+  """
+  return os.getenv("POISON_QUARANTINE_ENABLED", "true").lower() != "false"
+
+## Define function to build the URL of the blob for an event
+def _build_blob_url(routed_blob_event: dict):
+  return f'{routed_blob_event["storage_blob_service_uri"]}/{routed_blob_event["container"]}/{routed_blob_event["relative_file_path"]}'
+
+## Define function to build the key under which a blob is recorded
+def _build_quarantine_record_key(routed_blob_event: dict):
+  return f'{_build_blob_url(routed_blob_event)}\0{routed_blob_event.get("etag") or ""}'
+
+## Define function to find the error at the root of a chain
+def _retrieve_root_error(error: Exception):
+  while (error.__cause__ or error.__context__) is not None :
+    error = error.__cause__ or error.__context__
+  return error
+
+## Define function to build the fingerprint of a failure
+def build_failure_fingerprint(routed_blob_event: dict, error_class: str):
+  """
+  Build the fingerprint of a failure from the blob URL, the ETag of the blob and the class of the error
+  Keyword arguments:
+  routed_blob_event -- the routed blob event, as returned by route_queue_message
+  error_class -- the name of the class of the error at the root of the failure
+
+  eg: build_failure_fingerprint(routed_blob_event=routed_blob_event, error_class="IncompleteJSONError")
+  """
+  failure_hash = hashlib.sha256()
+  failure_hash.update(_build_blob_url(routed_blob_event).encode())
+  failure_hash.update(b"\0")
+  failure_hash.update(str(routed_blob_event.get("etag") or "").encode())
+  failure_hash.update(b"\0")
+  failure_hash.update(error_class.encode())
+  return failure_hash.hexdigest()[:32]
+
+## Define function to determine whether an error means
+## that a blob can never be processed
+def is_poison_blob_error(error: Exception, stage: str = None):
+  """
+  Determine whether an error raised whilst checking, downloading or interpreting a control file means that the blob can never be processed, rather than that a dependency failed
+  Keyword arguments:
+  error -- the exception raised before the statements were sent to Snowflake
+  stage -- the stage which failed, such as validate, download or interpret (default None)
+
+  Only a PoisonBlobError, an error decoding the content of the blob as JSON, or
+  a ValueError raised whilst interpreting the statements of a control file are
+  poison, so a misconfigured app setting or a failed SDK call is still retried.
+
+  eg: is_poison_blob_error(error=e, stage="interpret")
+  """
+  if not is_poison_quarantine_enabled() or is_transient_dependency_error(error) :
+    return False
+
+  ### Never quarantine a blob because the function
+  ### app was not allowed to read it
+  chained_error = error
+  while chained_error is not None :
+    if getattr(chained_error, "status_code", None) in AUTHORIZATION_HTTP_STATUS_CODES or any(error_class.__name__ == AUTHENTICATION_ERROR_CLASS_NAME for error_class in type(chained_error).__mro__) :
+      return False
+    chained_error = chained_error.__cause__ or chained_error.__context__
+
+  ### Only errors in the content of the blob are poison,
+  ### so a missing blob or an SDK error is still retried
+  if isinstance(error, PoisonBlobError) :
+    return True
+  if stage == "interpret" and isinstance(error, ValueError) :
+    return True
+  root_error = _retrieve_root_error(error)
+  return any(error_class.__name__ in JSON_ERROR_CLASS_NAMES for error_class in type(root_error).__mro__)
+
+## Define function to retrieve the record for a
+## blob which has already been quarantined
+def retrieve_quarantine_record(routed_blob_event: dict):
+  """
+  Retrieve the worker-scoped record of a quarantined blob, or None if the blob and ETag have not been quarantined
+  Keyword arguments:
+  routed_blob_event -- the routed blob event, as returned by route_queue_message
+  """
+  record_key = _build_quarantine_record_key(routed_blob_event)
+  with _poison_quarantine_lock:
+    quarantine_record = _quarantine_records.get(record_key)
+    if quarantine_record is None :
+      return None
+    if time.monotonic() > quarantine_record["expires_at"] :
+      del _quarantine_records[record_key]
+      return None
+    _quarantine_records.move_to_end(record_key)
+    return quarantine_record
+
+## Define function to store the record for a blob,
+## evicting the oldest records beyond the limit
+def _store_quarantine_record(routed_blob_event: dict, quarantine_record: dict):
+  max_records = retrieve_int_app_setting("POISON_QUARANTINE_MAX_RECORDS", 1024)
+  quarantine_record["expires_at"] = time.monotonic() + retrieve_int_app_setting("POISON_QUARANTINE_RECORD_TTL_SECONDS", 86400)
+  with _poison_quarantine_lock:
+    _quarantine_records[_build_quarantine_record_key(routed_blob_event)] = quarantine_record
+    while len(_quarantine_records) > max_records :
+      _quarantine_records.popitem(last=False)
+
+## Define function to retrieve the size and content type of a
+## blob, from the event where possible to avoid a round trip
+def _retrieve_blob_size_and_content_type(routed_blob_event: dict):
+  if routed_blob_event.get("content_length") is not None and routed_blob_event.get("content_type") is not None :
+    return int(routed_blob_event["content_length"]), routed_blob_event["content_type"]
+  blob_client = retrieve_blob_client(routed_blob_event["storage_blob_service_uri"], routed_blob_event["container"], routed_blob_event["relative_file_path"])
+  with timed_stage("blob_properties", blob_name=routed_blob_event["relative_file_path"]):
+    blob_properties = call_with_retries("blob_storage", blob_client.get_blob_properties)
+
+  ### Keep the properties with the event, so that
+  ### quarantining the blob does not fetch them again
+  routed_blob_event["content_length"] = blob_properties.size
+  routed_blob_event["content_type"] = getattr(getattr(blob_properties, "content_settings", None), "content_type", None)
+  return routed_blob_event["content_length"], routed_blob_event["content_type"]
+
+## Define function to check a control file before it is downloaded
+def validate_control_file_blob(routed_blob_event: dict):
+  """
+  Check that a control file has not already been quarantined and that its size and content type are acceptable, before it is downloaded
+  Keyword arguments:
+  routed_blob_event -- the routed blob event, as returned by route_queue_message
+
+  Raises a PoisonBlobError if the control file should be quarantined
+
+  eg: validate_control_file_blob(routed_blob_event=routed_blob_event)
+  """
+  if not is_poison_quarantine_enabled() :
+    return
+
+  ### Short-circuit blobs which have already failed,
+  ### without downloading them again
+  quarantine_record = retrieve_quarantine_record(routed_blob_event)
+  if quarantine_record is not None :
+    raise PoisonBlobError(f'Blob has already been quarantined with fingerprint {quarantine_record["fingerprint"]}: {quarantine_record["error_message"]}')
+
+  blob_size, content_type = _retrieve_blob_size_and_content_type(routed_blob_event)
+  _increment_poison_quarantine_metric("validated")
+  max_blob_bytes = retrieve_int_app_setting("POISON_QUARANTINE_MAX_BLOB_BYTES", 0)
+  if max_blob_bytes > 0 and blob_size > max_blob_bytes :
+    _increment_poison_quarantine_metric("validation_failures")
+    raise PoisonBlobError(f"Control file of {blob_size} bytes is larger than the maximum of {max_blob_bytes} bytes")
+  if blob_size == 0 :
+    _increment_poison_quarantine_metric("validation_failures")
+    raise PoisonBlobError("Control file is empty")
+
+  ### Compare the media type alone, ignoring any charset
+  allowed_content_types = {
+      allowed_content_type.strip().lower()
+      for allowed_content_type in os.getenv("POISON_QUARANTINE_ALLOWED_CONTENT_TYPES", DEFAULT_ALLOWED_CONTENT_TYPES).split(",")
+  }
+  media_type = (content_type or "").split(";")[0].strip().lower()
+  if len(media_type) > 0 and media_type not in allowed_content_types :
+    _increment_poison_quarantine_metric("validation_failures")
+    raise PoisonBlobError(f"Control file has unsupported content type {content_type}")
+
+## Define function to retrieve the client for a blob in the poison
+## container, creating the container once per worker if needed
+def _retrieve_poison_blob_client(storage_blob_service_uri: str, poison_blob_name: str):
+  poison_container = os.getenv("POISON_QUARANTINE_CONTAINER", "snowpark-function-poison")
+  poison_container_key = (storage_blob_service_uri, poison_container)
+  with _poison_quarantine_lock:
+    poison_container_exists = poison_container_key in _poison_containers
+  if not poison_container_exists :
+    try:
+      call_with_retries("blob_storage", retrieve_container_client(storage_blob_service_uri, poison_container).create_container)
+    except ResourceExistsError:
+      pass
+    with _poison_quarantine_lock:
+      _poison_containers.add(poison_container_key)
+  return retrieve_blob_client(storage_blob_service_uri, poison_container, poison_blob_name)
+
+## Define function to copy a blob and its
+## diagnostics into the poison container
+def _move_blob_to_poison_container(routed_blob_event: dict, quarantine_record: dict):
+  storage_blob_service_uri = routed_blob_event["storage_blob_service_uri"]
+  poison_blob_name = f'{routed_blob_event["container"]}/{routed_blob_event["relative_file_path"]}.{quarantine_record["fingerprint"]}'
+  source_blob_client = retrieve_blob_client(storage_blob_service_uri, routed_blob_event["container"], routed_blob_event["relative_file_path"])
+
+  ### Copy the blob itself only if it is small enough to be
+  ### a control file, so that an oversized blob is not downloaded
+  max_copied_blob_bytes = retrieve_int_app_setting("POISON_QUARANTINE_MAX_BLOB_BYTES", 0) or DEFAULT_MAX_COPIED_BLOB_BYTES
+  blob_size = routed_blob_event.get("content_length")
+  if blob_size is not None and int(blob_size) <= max_copied_blob_bytes :
+    def download_blob_data():
+      return source_blob_client.download_blob().readall()
+    blob_data = call_with_retries("blob_storage", download_blob_data)
+    call_with_retries("blob_storage", _retrieve_poison_blob_client(storage_blob_service_uri, poison_blob_name).upload_blob, blob_data, overwrite=True)
+    quarantine_record["copied_blob_name"] = poison_blob_name
+
+  diagnostics = {key: value for key, value in quarantine_record.items() if key not in ("expires_at", "moved")}
+  call_with_retries("blob_storage", _retrieve_poison_blob_client(storage_blob_service_uri, f"{poison_blob_name}.diagnostics.json").upload_blob, json.dumps(diagnostics, indent=2, default=str).encode(), overwrite=True)
+
+## Define function to quarantine a blob which can never be processed
+def quarantine_blob_event(message_id: str, routed_blob_event: dict, stage: str, error: Exception):
+  """
+  Record the failure of a blob against its fingerprint and copy the blob, with diagnostics, to the poison container, so that its message can be acknowledged rather than retried
+  Keyword arguments:
+  message_id -- the ID of the storage queue message
+  routed_blob_event -- the routed blob event, as returned by route_queue_message
+  stage -- the stage which failed, such as validate, download or interpret
+  error -- the error for which the blob is quarantined, for which is_poison_blob_error is True
+
+  Raises if the blob could not be copied to the poison container, in which case the
+  message should be retried and its redelivery is short-circuited to another attempt
+
+  eg: quarantine_blob_event(message_id=msg.id, routed_blob_event=routed_blob_event, stage="interpret", error=e)
+  """
+
+  ### A blob which is already recorded has only to be
+  ### moved again if the previous attempt failed
+  quarantine_record = retrieve_quarantine_record(routed_blob_event)
+  if quarantine_record is not None and quarantine_record["moved"] :
+    _increment_poison_quarantine_metric("short_circuited")
+    logging.warning(f'Manual log - Skipping blob {_build_blob_url(routed_blob_event)} which was already quarantined with fingerprint {quarantine_record["fingerprint"]}')
+    return quarantine_record
+
+  if quarantine_record is None :
+    error_class = type(_retrieve_root_error(error)).__name__
+    quarantine_record = {
+        "fingerprint": build_failure_fingerprint(routed_blob_event, error_class)
+      , "blob_url": _build_blob_url(routed_blob_event)
+      , "etag": routed_blob_event.get("etag")
+      , "event_id": routed_blob_event.get("event_id")
+      , "message_id": message_id
+      , "content_length": routed_blob_event.get("content_length")
+      , "content_type": routed_blob_event.get("content_type")
+      , "failed_stage": stage
+      , "error_class": error_class
+      , "error_message": str(error)
+      , "quarantined_at": datetime.now(timezone.utc).isoformat()
+      , "moved": False
+    }
+    _store_quarantine_record(routed_blob_event, quarantine_record)
+
+  logging.error(f'Manual log - Quarantining blob {quarantine_record["blob_url"]} after {quarantine_record["error_class"]} during {stage} with fingerprint {quarantine_record["fingerprint"]}')
+  try:
+    with timed_stage("blob_quarantine", fingerprint=quarantine_record["fingerprint"]):
+      _move_blob_to_poison_container(routed_blob_event, quarantine_record)
+  except Exception:
+    _increment_poison_quarantine_metric("quarantine_errors")
+    raise
+  quarantine_record["moved"] = True
+  _increment_poison_quarantine_metric("quarantined")
+  return quarantine_record
+
+## Define function to retrieve a snapshot of the quarantine metrics
+def retrieve_poison_quarantine_metrics():
+  """
+  Retrieve a snapshot of the validated, validation failure, quarantined, short-circuited and quarantine error counters
+  """
+  with _poison_quarantine_lock:
+    poison_quarantine_metrics = dict(_poison_quarantine_metrics)
+    poison_quarantine_metrics["records"] = len(_quarantine_records)
+  return poison_quarantine_metrics
+
+## Export the validation and quarantine counters
+register_metrics_snapshot("poison_quarantine", retrieve_poison_quarantine_metrics, "Control file validation and poison quarantine counters")
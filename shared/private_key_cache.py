@@ -0,0 +1,136 @@
+
+# Process-wide cache of deserialized private keys for
+# Snowflake key pair authentication. Decrypting a PEM
+# private key runs a deliberately slow key derivation
+# function, so the DER bytes are derived once for each
+# distinct private key and passphrase pair. As the cache
+# is keyed on a hash of both values, a changed app setting
+# or vault secret is reloaded automatically
+#
+# Each deserialization is timed as the private_key_load
+# stage, and the cache counters are exported as the
+# snowpark_function.private_key_cache gauge
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+## Import shared packages
+from .lazy_imports import import_module_lazily, import_attribute_lazily
+from .telemetry import timed_stage, register_metrics_snapshot
+
+## Import packages with which to parse the private
+## key, deferred until a key is first deserialized
+default_backend = import_attribute_lazily("cryptography.hazmat.backends", "default_backend")
+serialization = import_module_lazily("cryptography.hazmat.primitives.serialization")
+
+## Number of distinct private keys kept in the cache,
+## allowing for a key rotation without holding
+## stale decrypted key material indefinitely
+PRIVATE_KEY_CACHE_MAX_ENTRIES = 4
+
+## Module-level state which lives for the lifetime of the worker
+_serialized_private_keys = OrderedDict()
+_private_key_cache_lock = threading.Lock()
+_private_key_cache_metrics = {
+    "hits": 0
+  , "loads": 0
+  , "load_seconds_total": 0.0
+  , "load_seconds_max": 0.0
+  , "load_seconds_last": 0.0
+}
+
+## Define function to hash the private key and
+## passphrase into a key for the cache
+def _build_private_key_cache_key(private_key_plain_text: str, private_key_passphrase: str = None):
+  private_key_hash = hashlib.sha256()
+  private_key_hash.update(private_key_plain_text.encode())
+  private_key_hash.update(b"\0")
+  if private_key_passphrase is not None :
+    private_key_hash.update(private_key_passphrase.encode())
+  return private_key_hash.hexdigest()
+
+## Define function to load a PEM private key
+## and serialize it for Snowpark for Python
+def _load_and_serialize_private_key(private_key_plain_text: str, private_key_passphrase: str = None):
+
+  ### Encode the private key
+  private_key_encoded = private_key_plain_text.encode()
+
+  ### Encode the private key passphrase if it has been provided
+  private_key_passphrase_encoded = None
+  if private_key_passphrase is not None :
+    private_key_passphrase_encoded = private_key_passphrase.encode()
+
+  ### Load the private key, leveraging passphrase if needed
+  private_key_loaded = serialization.load_pem_private_key(
+      private_key_encoded
+    , password = private_key_passphrase_encoded
+    , backend = default_backend()
+  )
+
+  ### Serialize loaded private key
+  private_key_serialized = private_key_loaded.private_bytes(
+      encoding = serialization.Encoding.DER
+    , format = serialization.PrivateFormat.PKCS8
+    , encryption_algorithm = serialization.NoEncryption()
+  )
+
+  return private_key_serialized
+
+## Define function to retrieve the serialized private
+## key, leveraging the cache where possible
+def retrieve_cached_serialized_private_key(private_key_plain_text: str, private_key_passphrase: str = None):
+  """
+  Retrieve the DER PKCS8 serialization of a PEM private key, only deserializing each distinct private key and passphrase pair once per worker
+  Keyword arguments:
+  private_key_plain_text -- the private key in PEM format
+  private_key_passphrase -- the passphrase for the private key, if it is encrypted (default None)
+
+  eg: retrieve_cached_serialized_private_key(private_key_plain_text=os.getenv("SNOWFLAKE_PRIVATE_KEY_PLAIN_TEXT"), private_key_passphrase=os.getenv("SNOWFLAKE_PRIVATE_KEY_PASSPHRASE"))
+  """
+  cache_key = _build_private_key_cache_key(private_key_plain_text, private_key_passphrase)
+
+  with _private_key_cache_lock:
+    private_key_serialized = _serialized_private_keys.get(cache_key)
+    if private_key_serialized is not None :
+      _serialized_private_keys.move_to_end(cache_key)
+      _private_key_cache_metrics["hits"] += 1
+      return private_key_serialized
+
+  ### Deserialize outside of the lock as
+  ### decryption may take a noticeable time
+  with timed_stage("private_key_load", private_key_encrypted=private_key_passphrase is not None):
+    load_start = time.perf_counter()
+    private_key_serialized = _load_and_serialize_private_key(private_key_plain_text, private_key_passphrase)
+    load_seconds = time.perf_counter() - load_start
+  logging.info(f'Manual log - Deserialized private key in {load_seconds:.3f} seconds')
+
+  with _private_key_cache_lock:
+    _serialized_private_keys[cache_key] = private_key_serialized
+    _serialized_private_keys.move_to_end(cache_key)
+    while len(_serialized_private_keys) > PRIVATE_KEY_CACHE_MAX_ENTRIES :
+      _serialized_private_keys.popitem(last=False)
+    _private_key_cache_metrics["loads"] += 1
+    _private_key_cache_metrics["load_seconds_total"] += load_seconds
+    _private_key_cache_metrics["load_seconds_max"] = max(_private_key_cache_metrics["load_seconds_max"], load_seconds)
+    _private_key_cache_metrics["load_seconds_last"] = load_seconds
+
+  return private_key_serialized
+
+## Define function to retrieve a snapshot of the cache metrics
+def retrieve_private_key_cache_metrics():
+  """
+  Retrieve a snapshot of the private key cache hit and load cost counters
+  """
+  with _private_key_cache_lock:
+    private_key_cache_metrics = dict(_private_key_cache_metrics)
+    private_key_cache_metrics["cached_private_keys"] = len(_serialized_private_keys)
+  return private_key_cache_metrics
+
+register_metrics_snapshot("private_key_cache", retrieve_private_key_cache_metrics, "Private key cache hit and load cost counters")
@@ -0,0 +1,281 @@
+
+# Micro-batched processing of storage queue messages.
+# Each message is parsed once and may hold several blob
+# events, each of which is routed and processed as its
+# own unit of work. The blobs referenced by a batch are
+# downloaded concurrently and their SQL statements
+# are executed on a single shared Snowpark session,
+# whilst the outcome of each message is still
+# recorded separately so that one bad file does
+# not cause its siblings to fail. Repeated deliveries
+# of an event are skipped before their file is downloaded,
+# and control files which can never be processed are
+# quarantined rather than failing their message.
+# Data files which match a bulk ingestion route are not
+# downloaded, and the files for each route are loaded
+# together by a single COPY INTO. Messages are grouped by
+# their workload route, so that each group executes on the
+# warehouse and role of its route
+
+## Import Azure packages
+import logging
+
+## Import other packages
+from concurrent.futures import ThreadPoolExecutor
+
+## Import shared packages
+from .snowpark_session_pool import is_snowflake_authentication_error
+from .blob_storage import azure_download_json_file
+from .message_routing import route_queue_message
+from .sql_statement_pipeline import retrieve_sql_statement_groups_to_execute, execute_sql_statement_groups
+from .result_handling import build_result_handler, log_statement_results
+from .snowflake_execution import warehouse_execution_slot
+from .idempotency_store import IdempotencyKeyInProgressError, build_blob_event_idempotency_key, claim_idempotency_key, complete_idempotency_key, release_idempotency_key
+from .telemetry import timed_stage
+from .bulk_ingestion import retrieve_bulk_ingestion_route, ingest_data_files
+from .durable_execution import retrieve_durable_execution
+from .poison_quarantine import validate_control_file_blob, is_poison_blob_error, quarantine_blob_event
+from .workload_routing import WORKLOAD_HINT_KEY, retrieve_workload_route, retrieve_workload_warehouse, routed_pooled_snowpark_session, resized_warehouse, build_query_tag_attributes
+
+## Define function to record a failure
+## against the result for a message
+def _record_message_failure(message_result: dict, stage: str, error: Exception):
+  logging.error(f'Manual log - Message {message_result["message_id"]} failed during {stage}')
+  logging.error(error)
+  message_result["status"] = "failed"
+  message_result["failed_stage"] = stage
+  message_result["error"] = error
+
+## Define function to record a failure against the result for
+## an event, quarantining a control file which can never be
+## processed so that its message is acknowledged
+def _record_control_file_failure(event_result: dict, stage: str, error: Exception):
+  if is_poison_blob_error(error, stage) :
+    try:
+      quarantine_blob_event(event_result["message_id"], event_result, stage, error)
+      event_result["status"] = "quarantined"
+      return
+    except Exception as quarantine_error:
+      logging.error(f'Manual log - Error quarantining event {event_result["event_id"]}: {quarantine_error}')
+  _record_message_failure(event_result, stage, error)
+
+## Define function to parse a message once and build
+## a result for each of its routed blob events
+def _route_events_for_message(message_result: dict, queue_message):
+  try:
+    with timed_stage("message_parse", message_id=message_result["message_id"]):
+      routed_blob_events = route_queue_message(queue_message)
+  except Exception as e:
+    _record_message_failure(message_result, "parse", e)
+    return []
+  return [
+      {"message_id": message_result["message_id"], "status": None, **routed_blob_event}
+      for routed_blob_event in routed_blob_events
+  ]
+
+## Define function to download and interpret
+## the JSON file that a blob event references
+def _retrieve_sql_statement_groups_for_event(event_result: dict):
+  event_result["idempotency_key"] = build_blob_event_idempotency_key(event_result["event_id"], event_result["etag"])
+
+  ### Leave an event whose key is held by another delivery for
+  ### retry, without releasing the key that delivery holds
+  try:
+    event_claimed = claim_idempotency_key(event_result["idempotency_key"])
+  except IdempotencyKeyInProgressError as e:
+    event_result["idempotency_key"] = None
+    _record_message_failure(event_result, "claim", e)
+    return
+  if not event_claimed :
+    logging.info(f'Manual log - Skipping duplicate delivery of event {event_result["event_id"]} in message {event_result["message_id"]}')
+    event_result["status"] = "duplicate"
+    event_result["idempotency_key"] = None
+    return
+  storage_blob_service_uri = event_result["storage_blob_service_uri"]
+  container = event_result["container"]
+  relative_file_path = event_result["relative_file_path"]
+  event_result["result_path_prefix"] = f"{container}/{relative_file_path}"
+
+  ### Only blobs routed to the auto handler may be data files,
+  ### which are loaded from the stage with the rest of their
+  ### route, so are not downloaded here
+  try:
+    event_result["bulk_ingestion_route"] = retrieve_bulk_ingestion_route(container, relative_file_path) if event_result["handler"] == "auto" else None
+    if event_result["bulk_ingestion_route"] is not None :
+      event_result["workload_route"] = retrieve_workload_route(container, relative_file_path)
+      return
+  except Exception as e:
+    _record_message_failure(event_result, "parse", e)
+    return
+
+  ### Check the control file before downloading it
+  try:
+    validate_control_file_blob(event_result)
+  except Exception as e:
+    _record_control_file_failure(event_result, "validate", e)
+    return
+  try:
+    json_input = azure_download_json_file(storage_blob_service_uri=storage_blob_service_uri, container=container, relative_file_path=relative_file_path)
+  except Exception as e:
+    _record_control_file_failure(event_result, "download", e)
+    return
+  try:
+    event_result["sql_statement_groups_to_execute"] = retrieve_sql_statement_groups_to_execute(json_input)
+  except Exception as e:
+    _record_control_file_failure(event_result, "interpret", e)
+    return
+  try:
+    event_result["workload_route"] = retrieve_workload_route(container, relative_file_path, json_input.get(WORKLOAD_HINT_KEY))
+  except Exception as e:
+    _record_message_failure(event_result, "interpret", e)
+
+## Define function to settle the result for a
+## message from the results for its blob events
+def _settle_message_result(message_result: dict, event_results: list):
+  message_result["event_results"] = event_results
+  if message_result["status"] is not None :
+    return
+
+  ### A message fails with its first failed event, and a
+  ### message whose events were all rejected, ignored or
+  ### quarantined succeeds, so that it is removed from the queue
+  failed_event_results = [event_result for event_result in event_results if event_result["status"] == "failed"]
+  if len(failed_event_results) > 0 :
+    message_result["status"] = "failed"
+    message_result["failed_stage"] = failed_event_results[0]["failed_stage"]
+    message_result["error"] = failed_event_results[0]["error"]
+  elif len(event_results) > 0 and all(event_result["status"] == "duplicate" for event_result in event_results) :
+    message_result["status"] = "duplicate"
+  else :
+    message_result["status"] = "succeeded"
+
+## Define function to load the data files of a batch, with
+## a single COPY INTO for the files of each route
+def _ingest_data_files_for_messages(snowpark_session, data_file_message_results: list, workload_route: dict = None):
+  data_file_message_groups = {}
+  for message_result in data_file_message_results:
+    data_file_group_key = (message_result["bulk_ingestion_route"]["route_name"], message_result["storage_blob_service_uri"], message_result["container"])
+    data_file_message_groups.setdefault(data_file_group_key, []).append(message_result)
+
+  for (route_name, storage_blob_service_uri, container), message_results_for_route in data_file_message_groups.items():
+    try:
+      ingest_data_files(
+          snowpark_session
+        , message_results_for_route[0]["bulk_ingestion_route"]
+        , storage_blob_service_uri
+        , container
+        , [message_result["relative_file_path"] for message_result in message_results_for_route]
+        , build_query_tag_attributes(container=container, workload_route=workload_route)
+      )
+      for message_result in message_results_for_route:
+        message_result["status"] = "succeeded"
+    except Exception as e:
+      for message_result in message_results_for_route:
+        _record_message_failure(message_result, "ingest", e)
+
+      #### Stop using the session if Snowflake has rejected it,
+      #### which also evicts it from the session pool
+      if is_snowflake_authentication_error(e) :
+        raise
+
+## Define function which processes a batch of queue messages
+def process_queue_messages_in_batch(queue_messages: list, session_builder, max_download_workers: int = 8):
+  """
+  Process a batch of queue messages, downloading their files concurrently and executing their SQL statements on pooled Snowpark sessions
+  Keyword arguments:
+  queue_messages -- the list of func.QueueMessage objects to process
+  session_builder -- a function without arguments that creates a new Snowpark session, leveraged through the session pool
+  max_download_workers -- the maximum number of files to download concurrently (default 8)
+
+  Returns a list with one result dictionary per message, in the same order as queue_messages,
+  each with a "status" of "succeeded", "failed" or "duplicate"
+
+  eg: process_queue_messages_in_batch(queue_messages=[msg_1, msg_2], session_builder=build_snowpark_session_using_key_vault_password)
+  """
+  logging.info(f'Manual log - Beginning processing of batch of {len(queue_messages)} messages')
+  message_results = [{"message_id": queue_message.id, "status": None} for queue_message in queue_messages]
+  if len(queue_messages) == 0 :
+    return message_results
+
+  ### Parse and route each message once, then download
+  ### the files for every routed event concurrently
+  event_results_by_message = [
+      _route_events_for_message(message_result, queue_message)
+      for message_result, queue_message in zip(message_results, queue_messages)
+  ]
+  event_results = [event_result for event_results_for_message in event_results_by_message for event_result in event_results_for_message]
+  if len(event_results) > 0 :
+    with ThreadPoolExecutor(max_workers=max(1, min(max_download_workers, len(event_results)))) as download_executor:
+      list(download_executor.map(_retrieve_sql_statement_groups_for_event, event_results))
+
+  ### Group the events by the route for their workload
+  pending_message_groups = {}
+  for event_result in event_results:
+    if event_result["status"] is None :
+      workload_route = event_result["workload_route"]
+      pending_message_groups.setdefault(workload_route["route_name"] if workload_route is not None else None, []).append(event_result)
+
+  ### Execute every retrieved SQL statement for a route
+  for pending_message_results in pending_message_groups.values():
+    workload_route = pending_message_results[0]["workload_route"]
+    try:
+
+      ### Hold a single execution slot on the warehouse for the group
+      with warehouse_execution_slot(retrieve_workload_warehouse(workload_route)):
+        with resized_warehouse(session_builder, workload_route):
+          data_file_message_results = [message_result for message_result in pending_message_results if message_result["bulk_ingestion_route"] is not None]
+          if len(data_file_message_results) > 0 :
+            with routed_pooled_snowpark_session(session_builder, workload_route) as snowpark_session:
+              _ingest_data_files_for_messages(snowpark_session, data_file_message_results, workload_route)
+          for message_result in pending_message_results:
+            if message_result["bulk_ingestion_route"] is not None :
+              continue
+            try:
+              result_handler = build_result_handler(storage_blob_service_uri=message_result["storage_blob_service_uri"], result_path_prefix=message_result["result_path_prefix"])
+              query_tag_attributes = build_query_tag_attributes(message_result["message_id"], message_result["container"], message_result["relative_file_path"], workload_route)
+              durable_execution = retrieve_durable_execution(message_result["idempotency_key"])
+
+              #### Check out the session for each message separately, as
+              #### the pool restores the session before handing it to the
+              #### next message, so that one file cannot leave a role,
+              #### warehouse or open transaction behind for its siblings
+              with routed_pooled_snowpark_session(session_builder, workload_route) as snowpark_session:
+                sf_df_statement_results = execute_sql_statement_groups(snowpark_session, message_result["sql_statement_groups_to_execute"], result_handler, query_tag_attributes, durable_execution)
+              if durable_execution is not None :
+                durable_execution.complete()
+              logging.info(f'SQL statement results for message {message_result["message_id"]}:')
+              log_statement_results(sf_df_statement_results)
+              message_result["status"] = "succeeded"
+            except Exception as e:
+              _record_message_failure(message_result, "execute", e)
+
+              #### Stop if Snowflake has rejected the session,
+              #### which also evicts it from the session pool
+              if is_snowflake_authentication_error(e) :
+                raise
+
+    except Exception as e:
+
+      ### Any message in the group which was not executed fails
+      ### with the error that prevented the session from being used
+      for message_result in pending_message_results:
+        if message_result["status"] is None :
+          _record_message_failure(message_result, "session", e)
+
+  ### Record the events which succeeded or were quarantined so that
+  ### repeated deliveries are skipped, and release the others so
+  ### that their retries run
+  for event_result in event_results:
+    if event_result["status"] in ("succeeded", "quarantined") :
+      complete_idempotency_key(event_result.get("idempotency_key"))
+    elif event_result["status"] == "failed" :
+      release_idempotency_key(event_result.get("idempotency_key"))
+
+  ### Settle each message from the results for its events
+  for message_result, event_results_for_message in zip(message_results, event_results_by_message):
+    _settle_message_result(message_result, event_results_for_message)
+
+  succeeded_count = sum(1 for message_result in message_results if message_result["status"] == "succeeded")
+  logging.info(f'Manual log - Concluded processing of batch with {succeeded_count} of {len(message_results)} messages succeeding')
+
+  return message_results
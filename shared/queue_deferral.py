@@ -0,0 +1,113 @@
+
+# Deferral of storage queue messages whilst Snowflake is down.
+# A queue triggered function which fails a message because the
+# circuit for Snowflake is open would consume one of its dequeue
+# attempts, so a long outage would move every message to the
+# poison queue. Instead, the message is sent back to the queue
+# with a visibility delay of CIRCUIT_BREAKER_OPEN_SECONDS, after
+# which the circuit will let a trial call through, and the
+# original delivery is acknowledged. The copy is a new message
+# whose dequeue count starts again, so a message is deferred for
+# as long as the outage lasts rather than being counted against
+# its dequeue limit
+#
+# The message is sent to the queue named by the
+# AZURE_STORAGE_TRIGGER_QUEUE_NAME app setting, which should
+# match the queueName in the function.json of the triggers,
+# within the storage account given by the
+# AZURE_STORAGE_IDENTITY__queueServiceUri app setting. Messages
+# are failed for retry as before if that app setting is not populated
+
+## Import Azure packages
+import logging
+import azure.functions as func
+
+## Import other packages
+import os
+import threading
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .telemetry import register_metrics_snapshot
+from .lazy_imports import import_attribute_lazily
+from .azure_credential_cache import retrieve_default_azure_credential
+
+## Import heavy packages, deferred until first use
+QueueClient = import_attribute_lazily("azure.storage.queue", "QueueClient")
+BinaryBase64EncodePolicy = import_attribute_lazily("azure.storage.queue", "BinaryBase64EncodePolicy")
+BinaryBase64DecodePolicy = import_attribute_lazily("azure.storage.queue", "BinaryBase64DecodePolicy")
+
+## Default name of the queue read by the queue triggered functions
+DEFAULT_TRIGGER_QUEUE_NAME = "automated-function-trigger-demo"
+
+## Module-level state which lives for the lifetime of the worker
+_queue_clients = {}
+_queue_deferral_lock = threading.Lock()
+_queue_deferral_metrics = {
+    "deferred": 0
+  , "deferral_errors": 0
+}
+
+## Define function to retrieve the queue client for the
+## trigger queue, creating it once per worker
+def _retrieve_trigger_queue_client(storage_queue_service_uri: str, queue_name: str):
+  queue_client_key = (storage_queue_service_uri, queue_name)
+  with _queue_deferral_lock:
+    if queue_client_key not in _queue_clients :
+
+      ### Messages are base64 encoded, matching
+      ### the encoding expected by queue triggers
+      _queue_clients[queue_client_key] = QueueClient(
+          storage_queue_service_uri
+        , queue_name = queue_name
+        , credential = retrieve_default_azure_credential()
+        , message_encode_policy = BinaryBase64EncodePolicy()
+        , message_decode_policy = BinaryBase64DecodePolicy()
+      )
+    return _queue_clients[queue_client_key]
+
+## Define function to send a message back to the
+## queue, to be delivered again after a delay
+def defer_queue_message(msg: func.QueueMessage):
+  """
+  Send a copy of a storage queue message back to the trigger queue, hidden until the circuit for Snowflake allows a trial call, returning False if deferral is not configured or fails so that the caller fails the message instead
+  Keyword arguments:
+  msg -- the storage queue message to defer
+
+  Once this returns True, the original delivery should be acknowledged by returning
+  from the function without raising.
+
+  eg: defer_queue_message(msg=msg)
+  """
+  storage_queue_service_uri = os.getenv("AZURE_STORAGE_IDENTITY__queueServiceUri")
+  if storage_queue_service_uri is None or len(storage_queue_service_uri) == 0 :
+    return False
+  queue_name = os.getenv("AZURE_STORAGE_TRIGGER_QUEUE_NAME", DEFAULT_TRIGGER_QUEUE_NAME)
+  visibility_timeout_seconds = retrieve_int_app_setting("CIRCUIT_BREAKER_OPEN_SECONDS", 60)
+
+  try:
+    _retrieve_trigger_queue_client(storage_queue_service_uri, queue_name).send_message(
+        msg.get_body()
+      , visibility_timeout = visibility_timeout_seconds
+    )
+  except Exception as e:
+    with _queue_deferral_lock:
+      _queue_deferral_metrics["deferral_errors"] += 1
+    logging.error(f'Manual log - Failed to defer message {msg.id}, failing it for retry instead: {e}')
+    return False
+
+  with _queue_deferral_lock:
+    _queue_deferral_metrics["deferred"] += 1
+  logging.warning(f'Manual log - Circuit for Snowflake is open, deferring message {msg.id} for {visibility_timeout_seconds} seconds')
+  return True
+
+## Define function to retrieve a snapshot of the deferral metrics
+def retrieve_queue_deferral_metrics():
+  """
+  Retrieve a snapshot of the number of messages deferred whilst Snowflake was down, and of failed deferrals
+  """
+  with _queue_deferral_lock:
+    return dict(_queue_deferral_metrics)
+
+## Export the deferral counters
+register_metrics_snapshot("queue_deferral", retrieve_queue_deferral_metrics, "Storage queue messages deferred whilst Snowflake was down")
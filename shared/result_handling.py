@@ -0,0 +1,232 @@
+
+# Bounded handling of Snowflake query results. Rather
+# than collecting every row into worker memory and
+# logging the full result, results can be iterated to
+# produce a row count and a bounded sample, or streamed
+# batch by batch into a blob in a compact format
+#
+# The handling mode is selected with the
+# SNOWFLAKE_RESULT_HANDLING_MODE app setting:
+# - collect - collect every row, as a list of Row objects (default)
+# - sample  - iterate the rows, only keeping a row count and a bounded sample
+# - spill   - write the rows to a blob as Parquet or gzip compressed CSV,
+#             only keeping a row count and a bounded sample
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import os
+import io
+import gzip
+import uuid
+import base64
+import itertools
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .lazy_imports import import_module_lazily
+from .blob_client_registry import retrieve_blob_client
+from .sql_statement_pipeline import collect_result
+
+## Import heavy packages, deferred until first use
+pyarrow = import_module_lazily("pyarrow")
+pyarrow_parquet = import_module_lazily("pyarrow.parquet")
+
+## Supported result handling modes
+RESULT_HANDLING_MODES = ("collect", "sample", "spill")
+
+## Supported formats for results spilled to blob storage
+RESULT_SPILL_FORMATS = ("parquet", "csv.gz")
+
+## Size of each block staged when spilling results to a blob
+RESULT_SPILL_BLOCK_SIZE_BYTES = 4 * 1024 * 1024
+
+## Define a write-only file-like object which uploads
+## its contents to a block blob in fixed size blocks
+class BlobBlockWriter(io.RawIOBase):
+  """
+  File-like writer which stages its contents to a block blob incrementally and commits the blocks on close
+  """
+  def __init__(self, blob_client, block_size_bytes: int = RESULT_SPILL_BLOCK_SIZE_BYTES):
+    self._blob_client = blob_client
+    self._block_size_bytes = block_size_bytes
+    self._buffer = bytearray()
+    self._block_ids = []
+    self.bytes_written = 0
+
+  def writable(self):
+    return True
+
+  def tell(self):
+    return self.bytes_written
+
+  def write(self, data):
+    self._buffer.extend(data)
+    self.bytes_written += len(data)
+    while len(self._buffer) >= self._block_size_bytes :
+      self._stage_block(bytes(self._buffer[:self._block_size_bytes]))
+      del self._buffer[:self._block_size_bytes]
+    return len(data)
+
+  def _stage_block(self, block_data: bytes):
+    block_id = base64.b64encode(uuid.uuid4().bytes).decode()
+    self._blob_client.stage_block(block_id=block_id, data=block_data)
+    self._block_ids.append(block_id)
+
+  def close(self):
+    if not self.closed :
+      if len(self._buffer) > 0 or len(self._block_ids) == 0 :
+        self._stage_block(bytes(self._buffer))
+        self._buffer.clear()
+      self._blob_client.commit_block_list(self._block_ids)
+    super().close()
+
+  def abort(self):
+    """
+    Close the writer without committing, leaving any staged blocks to be discarded by the storage service
+    """
+    self._buffer.clear()
+    super().close()
+
+## Define function to count the rows in an iterator
+## whilst only keeping a bounded sample of them
+def summarize_result_rows(result_rows, sample_size: int = None):
+  """
+  Consume an iterator of result rows, keeping only a row count and the first rows as a sample
+  Keyword arguments:
+  result_rows -- an iterable of result rows, such as from to_local_iterator()
+  sample_size -- the maximum number of rows to keep (default the SNOWFLAKE_RESULT_LOG_SAMPLE_ROWS app setting, or 10)
+
+  eg: summarize_result_rows(result_rows=snowpark_session.sql("SELECT 1").to_local_iterator())
+  """
+  if sample_size is None :
+    sample_size = retrieve_int_app_setting("SNOWFLAKE_RESULT_LOG_SAMPLE_ROWS", 10)
+  result_rows = iter(result_rows)
+  sample_rows = list(itertools.islice(result_rows, sample_size))
+  row_count = len(sample_rows) + sum(1 for _ in result_rows)
+  return {"row_count": row_count, "sample": sample_rows}
+
+## Define function to write batches of pandas
+## dataframes to a blob without holding them all
+def spill_result_batches_to_blob(pandas_batches, blob_client, spill_format: str = "parquet", sample_size: int = None):
+  """
+  Write an iterator of pandas dataframes to a blob incrementally, keeping only a row count and the first rows as a sample
+  Keyword arguments:
+  pandas_batches -- an iterable of pandas dataframes, such as from to_pandas_batches()
+  blob_client -- the blob client for the blob to write
+  spill_format -- either "parquet" or "csv.gz" (default "parquet")
+  sample_size -- the maximum number of rows to keep (default the SNOWFLAKE_RESULT_LOG_SAMPLE_ROWS app setting, or 10)
+
+  eg: spill_result_batches_to_blob(pandas_batches=snowpark_session.sql("SELECT 1").to_pandas_batches(), blob_client=blob_client)
+  """
+  if spill_format not in RESULT_SPILL_FORMATS :
+    raise ValueError(f"Result spill format must be one of {RESULT_SPILL_FORMATS}, not {spill_format}")
+  if sample_size is None :
+    sample_size = retrieve_int_app_setting("SNOWFLAKE_RESULT_LOG_SAMPLE_ROWS", 10)
+
+  row_count = 0
+  sample_rows = []
+  blob_writer = BlobBlockWriter(blob_client)
+  parquet_writer = None
+  csv_writer = gzip.GzipFile(fileobj=blob_writer, mode="wb") if spill_format == "csv.gz" else None
+
+  try:
+    for batch_number, pandas_batch in enumerate(pandas_batches):
+      row_count += len(pandas_batch)
+      if len(sample_rows) < sample_size :
+        sample_rows.extend(pandas_batch.head(sample_size - len(sample_rows)).to_dict("records"))
+
+      ### Append the batch to the blob in the requested format
+      if spill_format == "parquet" :
+        arrow_table = pyarrow.Table.from_pandas(pandas_batch, preserve_index=False)
+        if parquet_writer is None :
+          parquet_writer = pyarrow_parquet.ParquetWriter(blob_writer, arrow_table.schema, compression="snappy")
+        parquet_writer.write_table(arrow_table)
+      else :
+        csv_writer.write(pandas_batch.to_csv(index=False, header=(batch_number == 0)).encode())
+
+    ### Finish the file and commit the staged blocks
+    if parquet_writer is not None :
+      parquet_writer.close()
+    if csv_writer is not None :
+      csv_writer.close()
+    blob_writer.close()
+
+  except Exception:
+
+    ### Never commit a partially written result
+    blob_writer.abort()
+    raise
+
+  return {"row_count": row_count, "sample": sample_rows, "blob_url": blob_client.url, "bytes_written": blob_writer.bytes_written}
+
+## Define function to build a result handler for
+## the pipeline according to the app settings
+def build_result_handler(storage_blob_service_uri: str = None, result_path_prefix: str = None):
+  """
+  Build a result handler for execute_sql_statement_groups according to the SNOWFLAKE_RESULT_HANDLING_MODE app setting
+  Keyword arguments:
+  storage_blob_service_uri -- the uri for the blob storage service that spilled results are written to (default None)
+  result_path_prefix -- the path prefix for spilled results within the spill container (default None)
+
+  The result handler is called with a fetch_result function, which accepts
+  "row", "row_iterator" or "pandas_batches", and the position of the statement.
+
+  eg: build_result_handler(storage_blob_service_uri="https://my-storage-account.blob.core.windows.net", result_path_prefix="path/to/file.json")
+  """
+  result_handling_mode = os.getenv("SNOWFLAKE_RESULT_HANDLING_MODE", "collect").lower()
+  if result_handling_mode not in RESULT_HANDLING_MODES :
+    raise ValueError(f"SNOWFLAKE_RESULT_HANDLING_MODE must be one of {RESULT_HANDLING_MODES}, not {result_handling_mode}")
+
+  if result_handling_mode == "collect" :
+    return collect_result
+
+  if result_handling_mode == "sample" :
+    return lambda fetch_result, statement_number: summarize_result_rows(fetch_result("row_iterator"))
+
+  ### Spilling results requires somewhere to write them
+  if not all([storage_blob_service_uri, result_path_prefix]) :
+    raise ValueError("Spilling results requires a storage blob service uri and result path prefix")
+  spill_container = os.getenv("SNOWFLAKE_RESULT_SPILL_CONTAINER", "snowflake-query-results")
+  spill_format = os.getenv("SNOWFLAKE_RESULT_SPILL_FORMAT", "parquet").lower()
+  result_run_id = uuid.uuid4().hex
+
+  def spill_result(fetch_result, statement_number: int):
+    blob_client = retrieve_blob_client(
+        storage_blob_service_uri
+      , container = spill_container
+      , blob = f"{result_path_prefix}/{result_run_id}/statement_{statement_number:04d}.{spill_format}"
+    )
+    result_summary = spill_result_batches_to_blob(fetch_result("pandas_batches"), blob_client, spill_format)
+    logging.info(f'Manual log - Spilled {result_summary["row_count"]} result rows to {result_summary["blob_url"]}')
+    return result_summary
+
+  return spill_result
+
+## Define function to describe a statement result
+## for logging without logging every row
+def describe_result_for_logging(statement_result, sample_size: int = None):
+  """
+  Describe a statement result with a row count and a bounded sample, suitable for logging
+  Keyword arguments:
+  statement_result -- either a list of collected rows or a summary returned by a result handler
+  sample_size -- the maximum number of rows to describe (default the SNOWFLAKE_RESULT_LOG_SAMPLE_ROWS app setting, or 10)
+  """
+  if isinstance(statement_result, dict) :
+    return statement_result
+  if sample_size is None :
+    sample_size = retrieve_int_app_setting("SNOWFLAKE_RESULT_LOG_SAMPLE_ROWS", 10)
+  return {"row_count": len(statement_result), "sample": statement_result[:sample_size]}
+
+## Define function to log the results of a series
+## of statements without logging every row
+def log_statement_results(sql_statement_results: list):
+  """
+  Log a row count and a bounded sample for each statement result
+  Keyword arguments:
+  sql_statement_results -- the list of results returned by execute_sql_statement_groups
+  """
+  for statement_number, statement_result in enumerate(sql_statement_results, start=1):
+    logging.info(f"SQL statement {statement_number} result:")
+    logging.info(describe_result_for_logging(statement_result))
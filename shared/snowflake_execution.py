@@ -0,0 +1,262 @@
+
+# Bounded execution of work against Snowflake. Statements
+# are executed on a worker-scoped thread pool for their
+# warehouse, and each execution first takes one of a limited
+# number of in-flight slots for its warehouse, so that the number of
+# concurrent queries a worker sends to each warehouse can
+# be sized against the capacity of that warehouse. The time
+# spent waiting for a slot and the time spent executing are
+# recorded separately, and when a warehouse has no free
+# slots callers can stop taking on more work
+#
+# The number of in-flight slots for a warehouse is taken
+# from the SNOWFLAKE_MAX_IN_FLIGHT_<WAREHOUSE> app setting
+# if it is populated, otherwise from the
+# SNOWFLAKE_MAX_IN_FLIGHT_PER_WAREHOUSE app setting
+#
+# Each warehouse has its own thread pool, no larger than its
+# in-flight limit, so that work waiting for a busy warehouse
+# queues without holding threads that another warehouse needs
+#
+# Every execution is also guarded by the circuit breaker
+# for Snowflake in shared/dependency_resilience.py, so that
+# work is rejected straight away whilst Snowflake is down
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import os
+import re
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .telemetry import register_metrics_snapshot
+from .dependency_resilience import dependency_circuit, raise_if_dependency_circuit_open
+
+## Module-level state which lives for the lifetime of the worker
+_warehouse_slots = {}
+_execution_lock = threading.Lock()
+_execution_metrics = {}
+
+## Error raised when a warehouse slot does not
+## become free within the permitted queueing time
+class SnowflakeExecutionBackpressureError(Exception):
+  """
+  Raised when an execution waits longer than SNOWFLAKE_EXECUTION_MAX_QUEUE_SECONDS for an in-flight slot on its warehouse
+  """
+
+## Define function to resolve the warehouse for an
+## execution, defaulting to the app setting
+def _resolve_warehouse(warehouse: str = None):
+  if warehouse is None or len(warehouse) == 0 :
+    warehouse = os.getenv("SNOWFLAKE_WAREHOUSE") or "DEFAULT"
+  return warehouse.upper()
+
+## Define function to retrieve the maximum
+## number of in-flight executions for a warehouse
+def retrieve_max_in_flight_for_warehouse(warehouse: str = None):
+  """
+  Retrieve the maximum number of concurrent executions that this worker sends to a warehouse
+  Keyword arguments:
+  warehouse -- the name of the warehouse (default the SNOWFLAKE_WAREHOUSE app setting)
+
+  eg: retrieve_max_in_flight_for_warehouse(warehouse="MY_WAREHOUSE")
+  """
+  warehouse = _resolve_warehouse(warehouse)
+  default_max_in_flight = retrieve_int_app_setting("SNOWFLAKE_MAX_IN_FLIGHT_PER_WAREHOUSE", 4)
+  return retrieve_int_app_setting(f"SNOWFLAKE_MAX_IN_FLIGHT_{re.sub('[^A-Z0-9_]', '_', warehouse)}", default_max_in_flight)
+
+## Define function to retrieve the slots and
+## metrics for a warehouse, creating them on first use
+def _retrieve_warehouse_state(warehouse: str):
+  with _execution_lock:
+    warehouse_slots = _warehouse_slots.get(warehouse)
+    if warehouse_slots is None :
+      max_in_flight = retrieve_max_in_flight_for_warehouse(warehouse)
+      warehouse_slots = {"semaphore": threading.BoundedSemaphore(max_in_flight), "max_in_flight": max_in_flight, "executor": None}
+      _warehouse_slots[warehouse] = warehouse_slots
+      _execution_metrics[warehouse] = {
+          "max_in_flight": max_in_flight
+        , "in_flight": 0
+        , "queued": 0
+        , "waiting": 0
+        , "completed": 0
+        , "failed": 0
+        , "rejected": 0
+        , "queue_seconds_total": 0.0
+        , "queue_seconds_max": 0.0
+        , "execution_seconds_total": 0.0
+        , "execution_seconds_max": 0.0
+      }
+  return warehouse_slots, _execution_metrics[warehouse]
+
+## Define function to record a duration against
+## a total and a maximum metric
+def _record_duration(warehouse_metrics: dict, metric_prefix: str, duration_seconds: float):
+  warehouse_metrics[f"{metric_prefix}_total"] += duration_seconds
+  warehouse_metrics[f"{metric_prefix}_max"] = max(warehouse_metrics[f"{metric_prefix}_max"], duration_seconds)
+
+## Define context manager which holds one of the
+## in-flight slots for a warehouse for a block
+@contextmanager
+def warehouse_execution_slot(warehouse: str = None, queued_at: float = None):
+  """
+  Hold an in-flight slot for a warehouse whilst executing a block, waiting for a slot to become free if needed
+  Keyword arguments:
+  warehouse -- the name of the warehouse (default the SNOWFLAKE_WAREHOUSE app setting)
+  queued_at -- the time.monotonic() at which the work was queued, for reporting queueing time (default now)
+
+  Raises SnowflakeExecutionBackpressureError if no slot becomes free within
+  SNOWFLAKE_EXECUTION_MAX_QUEUE_SECONDS, when that app setting is populated,
+  and DependencyCircuitOpenError whilst the circuit for Snowflake is open.
+
+  eg:
+  with warehouse_execution_slot(warehouse="MY_WAREHOUSE"):
+    snowpark_session.sql("SELECT 1").collect()
+  """
+  warehouse = _resolve_warehouse(warehouse)
+  if queued_at is None :
+    queued_at = time.monotonic()
+  warehouse_slots, warehouse_metrics = _retrieve_warehouse_state(warehouse)
+
+  ### Reject the work before it waits for a
+  ### slot if Snowflake is known to be down
+  raise_if_dependency_circuit_open("snowflake")
+
+  ### Wait for a free slot, giving up after the
+  ### maximum queueing time if one is configured
+  max_queue_seconds = retrieve_int_app_setting("SNOWFLAKE_EXECUTION_MAX_QUEUE_SECONDS", 0)
+  remaining_queue_seconds = max_queue_seconds - (time.monotonic() - queued_at) if max_queue_seconds > 0 else None
+  with _execution_lock:
+    warehouse_metrics["waiting"] += 1
+  slot_acquired = warehouse_slots["semaphore"].acquire(timeout=max(0, remaining_queue_seconds) if remaining_queue_seconds is not None else None)
+  queue_seconds = time.monotonic() - queued_at
+  with _execution_lock:
+    warehouse_metrics["waiting"] -= 1
+    if not slot_acquired :
+      warehouse_metrics["rejected"] += 1
+    else :
+      warehouse_metrics["in_flight"] += 1
+      _record_duration(warehouse_metrics, "queue_seconds", queue_seconds)
+  if not slot_acquired :
+    logging.warning(f'Manual log - No free execution slot for warehouse {warehouse} after {queue_seconds:.3f} seconds')
+    raise SnowflakeExecutionBackpressureError(f"No free execution slot for warehouse {warehouse} after {queue_seconds:.3f} seconds")
+
+  ### Execute the block, recording how long it took and
+  ### whether it could reach Snowflake
+  execution_start = time.monotonic()
+  execution_succeeded = False
+  try:
+    with dependency_circuit("snowflake"):
+      yield
+    execution_succeeded = True
+  finally:
+    execution_seconds = time.monotonic() - execution_start
+    warehouse_slots["semaphore"].release()
+    with _execution_lock:
+      warehouse_metrics["in_flight"] -= 1
+      warehouse_metrics["completed" if execution_succeeded else "failed"] += 1
+      _record_duration(warehouse_metrics, "execution_seconds", execution_seconds)
+    logging.info(f'Manual log - Execution on warehouse {warehouse} queued for {queue_seconds:.3f} seconds and executed for {execution_seconds:.3f} seconds')
+
+## Define function to retrieve the thread pool for a warehouse
+def _retrieve_execution_executor(warehouse: str):
+  warehouse_slots, _ = _retrieve_warehouse_state(warehouse)
+  with _execution_lock:
+    if warehouse_slots["executor"] is None :
+      thread_pool_size = min(retrieve_int_app_setting("SNOWFLAKE_EXECUTION_THREAD_POOL_SIZE", 8), warehouse_slots["max_in_flight"])
+      warehouse_slots["executor"] = ThreadPoolExecutor(max_workers=max(1, thread_pool_size), thread_name_prefix=f"snowflake-execution-{warehouse.lower()}")
+    return warehouse_slots["executor"]
+
+## Define function to run a slot-holding
+## execution on a thread from the pool
+def _execute_in_warehouse_slot(warehouse: str, queued_at: float, execution_function, execution_args: tuple):
+  _, warehouse_metrics = _retrieve_warehouse_state(warehouse)
+  with _execution_lock:
+    warehouse_metrics["queued"] -= 1
+  with warehouse_execution_slot(warehouse, queued_at):
+    return execution_function(*execution_args)
+
+## Define function to submit work to the thread pool
+def submit_snowflake_execution(execution_function, *execution_args, warehouse: str = None):
+  """
+  Submit work against Snowflake to the worker-scoped thread pool for its warehouse, holding an in-flight slot for the warehouse whilst it runs
+  Keyword arguments:
+  execution_function -- the function performing the work, such as execute_sql_in_snowflake
+  execution_args -- the positional arguments for execution_function
+  warehouse -- the name of the warehouse that the work runs on (default the SNOWFLAKE_WAREHOUSE app setting)
+
+  Returns a concurrent.futures.Future for the value returned by execution_function
+
+  eg: submit_snowflake_execution(execute_sql_in_snowflake, build_snowpark_session, sql_statement_groups_to_execute, result_handler)
+  """
+  warehouse = _resolve_warehouse(warehouse)
+  execution_executor = _retrieve_execution_executor(warehouse)
+
+  ### Count the work against the capacity of the
+  ### warehouse from the moment it is submitted
+  _, warehouse_metrics = _retrieve_warehouse_state(warehouse)
+  with _execution_lock:
+    warehouse_metrics["queued"] += 1
+
+  ### Run in a copy of the current context, so that spans
+  ### created on the pool thread share the invocation trace
+  return execution_executor.submit(
+      contextvars.copy_context().run
+    , _execute_in_warehouse_slot
+    , warehouse
+    , time.monotonic()
+    , execution_function
+    , execution_args
+  )
+
+## Define function to run work on the thread
+## pool and wait for it to complete
+def run_snowflake_execution(execution_function, *execution_args, warehouse: str = None):
+  """
+  Run work against Snowflake on the worker-scoped thread pool, within the in-flight limit of its warehouse, and return its result
+  Keyword arguments:
+  execution_function -- the function performing the work, such as execute_sql_in_snowflake
+  execution_args -- the positional arguments for execution_function
+  warehouse -- the name of the warehouse that the work runs on (default the SNOWFLAKE_WAREHOUSE app setting)
+
+  eg: run_snowflake_execution(execute_sql_in_snowflake, build_snowpark_session, sql_statement_groups_to_execute, result_handler)
+  """
+  return submit_snowflake_execution(execution_function, *execution_args, warehouse=warehouse).result()
+
+## Define function to retrieve the number of
+## free in-flight slots for a warehouse
+def retrieve_available_execution_capacity(warehouse: str = None):
+  """
+  Retrieve the number of in-flight slots for a warehouse that are neither in use nor already claimed by queued or waiting work
+  Keyword arguments:
+  warehouse -- the name of the warehouse (default the SNOWFLAKE_WAREHOUSE app setting)
+
+  eg: retrieve_available_execution_capacity(warehouse="MY_WAREHOUSE")
+  """
+  warehouse_slots, warehouse_metrics = _retrieve_warehouse_state(_resolve_warehouse(warehouse))
+  with _execution_lock:
+    return max(0, warehouse_slots["max_in_flight"] - warehouse_metrics["in_flight"] - warehouse_metrics["queued"] - warehouse_metrics["waiting"])
+
+## Define function to retrieve a snapshot of the execution metrics
+def retrieve_snowflake_execution_metrics():
+  """
+  Retrieve a snapshot of the in-flight, queued, waiting, completed, failed and rejected counts and the queueing and execution times for each warehouse
+  """
+  with _execution_lock:
+    execution_metrics = {warehouse: dict(warehouse_metrics) for warehouse, warehouse_metrics in _execution_metrics.items()}
+  for warehouse_metrics in execution_metrics.values():
+    executed_count = warehouse_metrics["completed"] + warehouse_metrics["failed"]
+    if executed_count > 0 :
+      warehouse_metrics["queue_seconds_mean"] = warehouse_metrics["queue_seconds_total"] / executed_count
+      warehouse_metrics["execution_seconds_mean"] = warehouse_metrics["execution_seconds_total"] / executed_count
+  return execution_metrics
+
+## Export the execution counters for each warehouse
+register_metrics_snapshot("snowflake_execution", retrieve_snowflake_execution_metrics, "Snowflake execution slot, queueing and execution counters for each warehouse", ("warehouse",))
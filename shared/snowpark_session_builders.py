@@ -0,0 +1,139 @@
+
+# Functions which create Snowpark for Python sessions
+# from app settings, shared by every function which does
+# not leverage the InterWorks submodule. Each builder takes
+# no arguments so that it can be handed to the session pool,
+# which keys its pooled sessions on the builder, meaning
+# that every function leveraging the same builder shares
+# the same pooled sessions within a worker
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import os
+
+## Import shared packages
+from .lazy_imports import import_attribute_lazily
+from .snowpark_session_pool import is_snowflake_authentication_error
+from .azure_credential_cache import retrieve_key_vault_secret, invalidate_key_vault_secret
+from .private_key_cache import retrieve_cached_serialized_private_key
+
+## Import heavy packages, deferred until first use
+Session = import_attribute_lazily("snowflake.snowpark", "Session")
+
+## Define function to retrieve the connection
+## parameters that are common to every builder
+def build_snowflake_connection_parameters(**authentication_parameters):
+  """
+  Build the Snowflake connection parameters from app settings, combined with the given authentication parameters
+  Keyword arguments:
+  authentication_parameters -- the parameters with which to authenticate, such as password or private_key
+
+  eg: build_snowflake_connection_parameters(password=os.getenv("SNOWFLAKE_PASSWORD"))
+  """
+  snowflake_connection_parameters = {
+      "account": os.getenv("SNOWFLAKE_ACCOUNT")
+    , "user": os.getenv("SNOWFLAKE_USER")
+    , "role": os.getenv("SNOWFLAKE_ROLE")
+    , "warehouse": os.getenv("SNOWFLAKE_WAREHOUSE")
+  }
+  snowflake_connection_parameters.update(authentication_parameters)
+  return snowflake_connection_parameters
+
+## Define function to create a Snowpark
+## session from connection parameters
+def create_snowpark_session(snowflake_connection_parameters: dict):
+  """
+  Create a Snowflake Snowpark session from a dictionary of connection parameters
+  Keyword arguments:
+  snowflake_connection_parameters -- the connection parameters, such as from build_snowflake_connection_parameters
+
+  eg: create_snowpark_session(snowflake_connection_parameters=build_snowflake_connection_parameters(password="my-password"))
+  """
+  return Session.builder.configs(snowflake_connection_parameters).create()
+
+## Function to create Snowpark session using
+## a password stored directly in app settings
+def build_snowpark_session_using_app_settings_password() :
+
+  ### Retrieve connection parameters from app settings
+  snowflake_connection_parameters = build_snowflake_connection_parameters(password=os.getenv("SNOWFLAKE_PASSWORD"))
+
+  ### Create Snowflake Snowpark session
+  return create_snowpark_session(snowflake_connection_parameters)
+
+## Function to retrieve the private key
+## from app settings and serialize it
+## for Snowpark for Python
+def retrieve_serialized_private_key_from_app_settings() :
+
+  ### Retrieve the private key from app settings
+  private_key_plain_text = os.getenv("SNOWFLAKE_PRIVATE_KEY_PLAIN_TEXT")
+
+  ### Retrieve the private key passphrase from app settings
+  private_key_passphrase = os.getenv("SNOWFLAKE_PRIVATE_KEY_PASSPHRASE")
+
+  ### Only leverage the private key passphrase if it has been provided
+  if private_key_passphrase is not None :
+    if len(private_key_passphrase) == 0 or private_key_passphrase == "None" :
+      private_key_passphrase = None
+
+  ### Load and serialize the private key, leveraging the
+  ### worker-scoped cache so that the key is only
+  ### deserialized again if either app setting changes
+  private_key_serialized = retrieve_cached_serialized_private_key(
+      private_key_plain_text = private_key_plain_text
+    , private_key_passphrase = private_key_passphrase
+  )
+
+  return private_key_serialized
+
+## Function to create Snowpark session using
+## a private key stored directly in app settings
+def build_snowpark_session_using_app_settings_private_key() :
+
+  ### Retrieve connection parameters from app settings
+  snowflake_connection_parameters = build_snowflake_connection_parameters(private_key=retrieve_serialized_private_key_from_app_settings())
+
+  ### Create Snowflake Snowpark session
+  return create_snowpark_session(snowflake_connection_parameters)
+
+## Function to retrieve the password
+## from Azure key vault using app
+## settings for key variables
+def retrieve_password_from_key_vault() :
+
+  ### Retrieve password secret name from app settings
+  snowflake_password_secret_name = os.getenv("SNOWFLAKE_PASSWORD_SECRET_NAME")
+
+  ### Retrieve the secret password from the key vault,
+  ### leveraging the worker-scoped credential and secret cache
+  snowflake_password = retrieve_key_vault_secret(snowflake_password_secret_name)
+
+  return snowflake_password
+
+## Function to create Snowpark session using
+## a password stored as a key vault secret
+def build_snowpark_session_using_key_vault_password() :
+
+  ### Retrieve connection parameters from app settings,
+  ### with the password from the key vault
+  snowflake_connection_parameters = build_snowflake_connection_parameters(password=retrieve_password_from_key_vault())
+
+  ### Create Snowflake Snowpark session
+  try:
+    snowpark_session = create_snowpark_session(snowflake_connection_parameters)
+
+  except Exception as e:
+
+    ### If Snowflake rejects the login then the cached password
+    ### may have been rotated, so invalidate it and retry once
+    if not is_snowflake_authentication_error(e) :
+      raise
+    logging.warning(f'Manual log - Snowflake rejected the login, refreshing the cached password')
+    invalidate_key_vault_secret(os.getenv("SNOWFLAKE_PASSWORD_SECRET_NAME"))
+    snowflake_connection_parameters["password"] = retrieve_password_from_key_vault()
+    snowpark_session = create_snowpark_session(snowflake_connection_parameters)
+
+  return snowpark_session
@@ -0,0 +1,351 @@
+
+# Worker-scoped pool of Snowpark for Python sessions.
+# Sessions are created lazily, reused across function
+# invocations, health-checked before they are handed
+# out and evicted when idle for too long or when
+# Snowflake rejects their authentication
+#
+# A session is returned to the pool with the role, warehouse,
+# database and schema it was created with, and without any
+# open transaction, so that one control file cannot change
+# how the next one executes. A session whose variables,
+# parameters or temporary objects were changed is closed
+# rather than returned, since these cannot be restored
+#
+# The pool counters, including the hits, misses and the
+# latency of creating sessions, are exported as the
+# snowpark_function.session_pool gauge
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import re
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .telemetry import timed_stage, register_metrics_snapshot
+from .dependency_resilience import call_with_retries
+
+## Snowflake error numbers which indicate that the
+## session token or master token is no longer valid
+SNOWFLAKE_AUTHENTICATION_ERROR_NUMBERS = {
+    390100  # Incorrect username or password
+  , 390101  # User temporarily locked
+  , 390111  # Session no longer exists
+  , 390112  # Session token expired
+  , 390114  # Master token expired
+  , 390144  # JWT token invalid
+  , 250001  # Could not connect to Snowflake backend after login
+}
+
+## Context of a session which is restored before it is returned to the pool
+SESSION_CONTEXT_OBJECT_TYPES = ("role", "warehouse", "database", "schema")
+
+## Statements which begin or end a transaction
+TRANSACTION_START_STATEMENT_PATTERN = re.compile(r"^\s*(BEGIN|START\s+TRANSACTION)\b", re.IGNORECASE)
+TRANSACTION_END_STATEMENT_PATTERN = re.compile(r"^\s*(COMMIT|ROLLBACK)\b", re.IGNORECASE)
+
+## Statements which change state of the session that cannot be
+## restored, so that the session is closed rather than returned
+UNRESTORABLE_SESSION_STATE_STATEMENT_PATTERN = re.compile(
+    r"^\s*(ALTER\s+SESSION\b|SET\b|UNSET\b"
+    r"|CREATE\s+(OR\s+REPLACE\s+)?(LOCAL\s+|GLOBAL\s+)?(TEMP|TEMPORARY|VOLATILE)\b)"
+  , re.IGNORECASE
+)
+
+## Module-level state which lives for the lifetime of the worker
+_session_pool = {}
+_session_pool_lock = threading.Lock()
+_session_pool_metrics = {
+    "hits": 0
+  , "misses": 0
+  , "creates": 0
+  , "create_seconds_total": 0.0
+  , "create_seconds_max": 0.0
+  , "evictions_idle": 0
+  , "evictions_unhealthy": 0
+  , "evictions_authentication": 0
+  , "evictions_session_state": 0
+  , "session_state_restores": 0
+}
+
+## Define function to increment a pool metric
+def _increment_session_pool_metric(metric_name: str, amount=1):
+  with _session_pool_lock:
+    _session_pool_metrics[metric_name] += amount
+
+## Define function that determines whether an error
+## was raised because Snowflake rejected the session
+## authentication
+def is_snowflake_authentication_error(error: Exception):
+  """
+  Determine whether an exception indicates that Snowflake rejected the login or session token
+  Keyword arguments:
+  error -- the exception raised by Snowpark or the Snowflake connector
+
+  eg: is_snowflake_authentication_error(error=e)
+  """
+  while error is not None :
+    if getattr(error, "errno", None) in SNOWFLAKE_AUTHENTICATION_ERROR_NUMBERS :
+      return True
+    error = error.__cause__ or error.__context__
+  return False
+
+## Define function to close a session without
+## raising if the session is already broken
+def _close_snowpark_session_quietly(snowpark_session):
+  try:
+    with timed_stage("session_close"):
+      snowpark_session.close()
+  except Exception as e:
+    logging.warning(f'Manual log - Error closing pooled Snowpark session: {e}')
+
+## Define function that checks whether a pooled
+## session is still usable before it is handed out
+def _is_pooled_session_healthy(pooled_entry: dict):
+  snowpark_session = pooled_entry["session"]
+  try:
+
+    ### Cheap local check that the underlying connection is still open
+    if snowpark_session.connection.is_closed() :
+      return False
+
+    ### Only pay for a round trip to Snowflake if
+    ### the session has been idle for a while
+    health_check_after_seconds = retrieve_int_app_setting("SNOWPARK_SESSION_POOL_HEALTH_CHECK_AFTER_SECONDS", 60)
+    if time.monotonic() - pooled_entry["last_used_at"] > health_check_after_seconds :
+      snowpark_session.sql("SELECT 1").collect()
+
+    return True
+
+  except Exception as e:
+    logging.warning(f'Manual log - Pooled Snowpark session failed health check: {e}')
+    if is_snowflake_authentication_error(e) :
+      _increment_session_pool_metric("evictions_authentication")
+    else :
+      _increment_session_pool_metric("evictions_unhealthy")
+    return False
+
+## Define function to remove sessions which have
+## been idle for longer than the configured timeout
+def _evict_idle_sessions():
+  idle_timeout_seconds = retrieve_int_app_setting("SNOWPARK_SESSION_POOL_IDLE_TIMEOUT_SECONDS", 600)
+  now = time.monotonic()
+  sessions_to_close = []
+  with _session_pool_lock:
+    for pool_key, pooled_entries in _session_pool.items():
+      still_fresh_entries = [entry for entry in pooled_entries if now - entry["last_used_at"] <= idle_timeout_seconds]
+      sessions_to_close.extend(entry["session"] for entry in pooled_entries if now - entry["last_used_at"] > idle_timeout_seconds)
+      _session_pool[pool_key] = still_fresh_entries
+    _session_pool_metrics["evictions_idle"] += len(sessions_to_close)
+  for snowpark_session in sessions_to_close:
+    _close_snowpark_session_quietly(snowpark_session)
+
+## Define function to take a healthy session
+## from the pool, or None if there is none
+def _checkout_pooled_session(pool_key: str):
+  while True :
+    with _session_pool_lock:
+      pooled_entries = _session_pool.get(pool_key)
+      if not pooled_entries :
+        return None
+      pooled_entry = pooled_entries.pop()
+    if _is_pooled_session_healthy(pooled_entry) :
+      return pooled_entry
+    _close_snowpark_session_quietly(pooled_entry["session"])
+
+## Define function to create a new session
+## and record how long the login took
+def _create_pooled_session(session_builder, pool_key: str):
+  create_start = time.perf_counter()
+  with timed_stage("session_create", pool_key=pool_key):
+    snowpark_session = call_with_retries("snowflake_login", session_builder)
+  create_seconds = time.perf_counter() - create_start
+  with _session_pool_lock:
+    _session_pool_metrics["creates"] += 1
+    _session_pool_metrics["create_seconds_total"] += create_seconds
+    _session_pool_metrics["create_seconds_max"] = max(_session_pool_metrics["create_seconds_max"], create_seconds)
+  logging.info(f'Manual log - Created new pooled Snowpark session in {create_seconds:.3f} seconds')
+  now = time.monotonic()
+  return {"session": snowpark_session, "created_at": now, "last_used_at": now, "initial_context": retrieve_session_context(snowpark_session)}
+
+## Define function to retrieve the context of a session
+def retrieve_session_context(snowpark_session):
+  """
+  Retrieve the current role, warehouse, database and schema of a session, as tracked by its connection without a round trip to Snowflake
+  Keyword arguments:
+  snowpark_session -- the Snowpark session
+
+  eg: retrieve_session_context(snowpark_session=snowpark_session)
+  """
+  return {
+      object_type: getattr(snowpark_session.connection, object_type, None)
+      for object_type in SESSION_CONTEXT_OBJECT_TYPES
+  }
+
+## Define function to quote an identifier exactly as
+## it was returned by Snowflake, preserving its case
+def _quote_identifier(identifier: str):
+  return '"' + identifier.replace('"', '""') + '"'
+
+## Define function to restore a session to the context it was
+## created with, returning whether it may be returned to the pool
+def _restore_pooled_session_state(pooled_entry: dict, executed_sql_statements: list):
+  snowpark_session = pooled_entry["session"]
+
+  ### Variables, parameters and temporary objects cannot be restored
+  if any(UNRESTORABLE_SESSION_STATE_STATEMENT_PATTERN.match(sql_statement) is not None for sql_statement in executed_sql_statements) :
+    logging.info(f'Manual log - Closing pooled Snowpark session whose session state was changed')
+    _increment_session_pool_metric("evictions_session_state")
+    return False
+
+  try:
+
+    ### Roll back a transaction which was begun but never ended
+    transaction_statements = [
+        sql_statement for sql_statement in executed_sql_statements
+        if TRANSACTION_START_STATEMENT_PATTERN.match(sql_statement) is not None or TRANSACTION_END_STATEMENT_PATTERN.match(sql_statement) is not None
+    ]
+    session_state_restored = False
+    if len(transaction_statements) > 0 and TRANSACTION_START_STATEMENT_PATTERN.match(transaction_statements[-1]) is not None :
+      logging.info(f'Manual log - Rolling back transaction left open on pooled Snowpark session')
+      snowpark_session.sql("ROLLBACK").collect()
+      session_state_restored = True
+
+    ### Switch back to any role, warehouse, database or schema that has changed,
+    ### restoring the role first as it determines which objects may be used
+    initial_context = pooled_entry["initial_context"]
+    current_context = retrieve_session_context(snowpark_session)
+    for object_type in SESSION_CONTEXT_OBJECT_TYPES:
+      if current_context[object_type] == initial_context[object_type] :
+        continue
+      if initial_context[object_type] is None :
+        logging.info(f'Manual log - Closing pooled Snowpark session whose {object_type} cannot be unset')
+        _increment_session_pool_metric("evictions_session_state")
+        return False
+      snowpark_session.sql(f"USE {object_type.upper()} {_quote_identifier(initial_context[object_type])}").collect()
+      session_state_restored = True
+
+    if session_state_restored :
+      _increment_session_pool_metric("session_state_restores")
+    return True
+
+  except Exception as e:
+    logging.warning(f'Manual log - Error restoring pooled Snowpark session: {e}')
+    _increment_session_pool_metric("evictions_session_state")
+    return False
+
+## Define function to return a session to the pool,
+## closing it instead if the pool is already full or
+## its state could not be restored
+def _checkin_pooled_session(pool_key: str, pooled_entry: dict, executed_sql_statements: list):
+  if not _restore_pooled_session_state(pooled_entry, executed_sql_statements) :
+    _close_snowpark_session_quietly(pooled_entry["session"])
+    return
+  max_idle_sessions = retrieve_int_app_setting("SNOWPARK_SESSION_POOL_MAX_IDLE_SESSIONS", 4)
+  pooled_entry["last_used_at"] = time.monotonic()
+  with _session_pool_lock:
+    pooled_entries = _session_pool.setdefault(pool_key, [])
+    if len(pooled_entries) < max_idle_sessions :
+      pooled_entries.append(pooled_entry)
+      return
+  _close_snowpark_session_quietly(pooled_entry["session"])
+
+## Define function to build the default pool key for
+## sessions created by a given session builder
+def build_session_pool_key(session_builder):
+  """
+  Build the key identifying sessions created by a given session builder
+  Keyword arguments:
+  session_builder -- a function without arguments that creates a new Snowpark session
+  """
+
+  ### Identify lazily imported builders by the real function
+  session_builder = getattr(session_builder, "__wrapped__", session_builder)
+  return f"{session_builder.__module__}.{session_builder.__qualname__}"
+
+## Define context manager which hands out a pooled
+## Snowpark session for the duration of a block
+@contextmanager
+def pooled_snowpark_session(session_builder, pool_key: str = None):
+  """
+  Retrieve a Snowpark session from the worker-scoped pool, creating one if needed, and return it to the pool afterwards
+  Keyword arguments:
+  session_builder -- a function without arguments that creates a new Snowpark session
+  pool_key -- the key identifying which sessions are interchangeable (default the module and name of session_builder)
+
+  eg:
+  with pooled_snowpark_session(build_snowpark_session) as snowpark_session:
+    snowpark_session.sql("SHOW DATABASES").collect()
+  """
+  if pool_key is None :
+    pool_key = build_session_pool_key(session_builder)
+
+  ### Evict idle sessions before trying to reuse one
+  _evict_idle_sessions()
+
+  ### Reuse a pooled session if one is available
+  pooled_entry = _checkout_pooled_session(pool_key)
+  if pooled_entry is not None :
+    _increment_session_pool_metric("hits")
+  else :
+    _increment_session_pool_metric("misses")
+    pooled_entry = _create_pooled_session(session_builder, pool_key)
+
+  ### Record every statement executed on the session, so that
+  ### its state can be restored before it is returned to the pool
+  query_history = None
+  try:
+    with pooled_entry["session"].query_history() as query_history:
+      yield pooled_entry["session"]
+
+  except Exception as e:
+
+    ### Never return a session to the pool if
+    ### Snowflake has rejected its authentication
+    if is_snowflake_authentication_error(e) :
+      logging.warning(f'Manual log - Evicting pooled Snowpark session after authentication error')
+      _increment_session_pool_metric("evictions_authentication")
+      _close_snowpark_session_quietly(pooled_entry["session"])
+      pooled_entry = None
+    raise
+
+  ### Check the session in however the block exits, including when
+  ### the generator is closed or the invocation is cancelled
+  finally:
+    if pooled_entry is not None :
+      executed_sql_statements = [query.sql_text for query in query_history.queries] if query_history is not None else []
+      _checkin_pooled_session(pool_key, pooled_entry, executed_sql_statements)
+
+## Define function to retrieve a snapshot of the pool metrics
+def retrieve_session_pool_metrics():
+  """
+  Retrieve a snapshot of the session pool hit, miss, creation latency, session state restore and eviction counters
+  """
+  with _session_pool_lock:
+    session_pool_metrics = dict(_session_pool_metrics)
+    session_pool_metrics["idle_sessions"] = sum(len(pooled_entries) for pooled_entries in _session_pool.values())
+  if session_pool_metrics["creates"] > 0 :
+    session_pool_metrics["create_seconds_mean"] = session_pool_metrics["create_seconds_total"] / session_pool_metrics["creates"]
+  return session_pool_metrics
+
+register_metrics_snapshot("session_pool", retrieve_session_pool_metrics, "Snowpark session pool hit, miss, creation latency, session state restore and eviction counters")
+
+## Define function to close every pooled session,
+## which is also registered to run on worker shutdown
+def close_all_pooled_sessions():
+  """
+  Close and remove every session currently held in the pool
+  """
+  with _session_pool_lock:
+    sessions_to_close = [entry["session"] for pooled_entries in _session_pool.values() for entry in pooled_entries]
+    _session_pool.clear()
+  for snowpark_session in sessions_to_close:
+    _close_snowpark_session_quietly(snowpark_session)
+
+atexit.register(close_all_pooled_sessions)
@@ -0,0 +1,258 @@
+
+# Pipelined execution of the SQL statements in a JSON
+# control file. A control file may contain an ordered
+# list of statement groups: the statements within a
+# group are independent of each other and are submitted
+# together as asynchronous Snowpark jobs, whilst each
+# group only begins once every statement in the previous
+# group has completed. With durable execution, the query ID
+# of every statement is stored before it is awaited, so that
+# a retry reattaches to it, as described in
+# shared/durable_execution.py
+#
+# Expected format of JSON file, either:
+#   {
+#     "sql_statement_to_execute" : "<sql_statement_to_execute>"
+#   }
+# or:
+#   {
+#     "sql_statements_to_execute" : [
+#         "<statement which runs first>"
+#       , ["<independent statement>", "<independent statement>"]
+#       , "<statement which runs once both independent statements complete>"
+#     ]
+#   }
+#
+# Any statement may instead be given as an object marking
+# it as read-only, so that its result may be served from
+# the statement result cache:
+#   {"sql_statement": "<read-only statement>", "cacheable": true}
+#
+# A control file may also name the workload it belongs to,
+# so that its statements are routed to the warehouse and
+# role of the matching route in shared/workload_routing.py:
+#   "workload" : "<workload name>"
+
+## Import Azure packages
+import logging
+
+## Import other packages
+from contextlib import contextmanager
+
+## Import shared packages
+from .statement_result_cache import build_statement_result_cache_key, retrieve_cached_statement_result, store_statement_result
+from .telemetry import timed_stage
+from .workload_routing import WORKLOAD_HINT_KEY, build_statement_params
+
+## Keys within the JSON file which may contain SQL statements
+SQL_STATEMENT_KEYS = ("sql_statement_to_execute", "sql_statements_to_execute")
+
+## Keys to extract from a JSON control file, which
+## also include the optional workload hint
+CONTROL_FILE_KEYS = (*SQL_STATEMENT_KEYS, WORKLOAD_HINT_KEY)
+
+## SQL statement which has been marked as read-only in the
+## JSON file, so that its result may be served from the cache
+class CacheableSqlStatement(str):
+  """
+  SQL statement whose result may be served from the statement result cache
+  """
+
+## Define function to validate a single SQL statement
+def _validate_sql_statement(sql_statement):
+  if isinstance(sql_statement, dict) :
+    if not isinstance(sql_statement.get("cacheable", False), bool) :
+      logging.error(f"Manual log - Downloaded file contains a SQL statement whose 'cacheable' value is not a boolean")
+      raise ValueError("Manual log - Downloaded file contains a SQL statement whose 'cacheable' value is not a boolean")
+    statement_is_cacheable = sql_statement.get("cacheable", False)
+    sql_statement = _validate_sql_statement(sql_statement.get("sql_statement"))
+    return CacheableSqlStatement(sql_statement) if statement_is_cacheable else sql_statement
+  if not isinstance(sql_statement, str) or len(sql_statement.strip()) == 0 :
+    logging.error(f"Manual log - Downloaded file contains a SQL statement that is not a non-empty string")
+    raise ValueError("Manual log - Downloaded file contains a SQL statement that is not a non-empty string")
+  return sql_statement
+
+## Define function that retrieves the ordered groups
+## of SQL statements to execute from the JSON input
+def retrieve_sql_statement_groups_to_execute(json_input: dict):
+  """
+  Retrieve the ordered list of SQL statement groups from a JSON control file
+  Keyword arguments:
+  json_input -- the JSON input containing either "sql_statement_to_execute" or "sql_statements_to_execute"
+
+  Returns a list of groups, each of which is a list of statements that may execute concurrently
+
+  eg: retrieve_sql_statement_groups_to_execute(json_input={"sql_statements_to_execute": ["SELECT 1", ["SELECT 2", "SELECT 3"]]})
+  """
+
+  ### Support the original single statement format
+  if "sql_statement_to_execute" in json_input.keys() :
+    return [[_validate_sql_statement(json_input["sql_statement_to_execute"])]]
+
+  ### Error if JSON file is not in expected format
+  if "sql_statements_to_execute" not in json_input.keys() :
+    logging.error(f"Manual log - Downloaded file did not include the key 'sql_statement_to_execute' or 'sql_statements_to_execute'")
+    raise ValueError("Manual log - Downloaded file did not include the key 'sql_statement_to_execute' or 'sql_statements_to_execute'")
+
+  sql_statements_to_execute = json_input["sql_statements_to_execute"]
+  if not isinstance(sql_statements_to_execute, list) or len(sql_statements_to_execute) == 0 :
+    logging.error(f"Manual log - The key 'sql_statements_to_execute' is not a non-empty list")
+    raise ValueError("Manual log - The key 'sql_statements_to_execute' is not a non-empty list")
+
+  ### Each entry is either a single statement or
+  ### a list of statements that are independent
+  sql_statement_groups = []
+  for sql_statement_group in sql_statements_to_execute:
+    if isinstance(sql_statement_group, list) :
+      if len(sql_statement_group) == 0 :
+        logging.error(f"Manual log - Downloaded file contains an empty group of SQL statements")
+        raise ValueError("Manual log - Downloaded file contains an empty group of SQL statements")
+      sql_statement_groups.append([_validate_sql_statement(sql_statement) for sql_statement in sql_statement_group])
+    else :
+      sql_statement_groups.append([_validate_sql_statement(sql_statement_group)])
+
+  return sql_statement_groups
+
+## Define function which fetches the result of a Snowpark
+## dataframe in the form requested by a result handler
+def _fetch_dataframe_result(sf_df_statement, result_type: str, statement_params: dict = None):
+  if result_type == "row" :
+    return sf_df_statement.collect(statement_params=statement_params)
+  if result_type == "row_iterator" :
+    return sf_df_statement.to_local_iterator(statement_params=statement_params)
+  if result_type == "pandas_batches" :
+    return sf_df_statement.to_pandas_batches(statement_params=statement_params)
+  raise ValueError(f"Unsupported result type {result_type}")
+
+## Default result handler, which collects every row
+def collect_result(fetch_result, statement_number: int):
+  return fetch_result("row")
+
+## Define context manager which times the execution of
+## a single statement, attaching the ID of its last query
+@contextmanager
+def _timed_statement_execution(snowpark_session, group_number: int, statement_number: int):
+  with timed_stage("query_execute", group_number=group_number, statement_number=statement_number) as query_attributes:
+    with snowpark_session.query_history() as query_history:
+      try:
+        yield
+      finally:
+        if len(query_history.queries) > 0 :
+          query_attributes["snowflake.query_id"] = query_history.queries[-1].query_id
+
+## Define function that executes groups of
+## SQL statements on a Snowpark session
+def execute_sql_statement_groups(snowpark_session, sql_statement_groups: list, result_handler=collect_result, query_tag_attributes: dict = None, durable_execution=None):
+  """
+  Execute ordered groups of SQL statements, submitting the statements in each group as concurrent asynchronous jobs
+  Keyword arguments:
+  snowpark_session -- the Snowpark session on which to execute the statements
+  sql_statement_groups -- the ordered list of statement groups, as returned by retrieve_sql_statement_groups_to_execute
+  result_handler -- function called with a fetch_result function, which accepts "row", "row_iterator" or "pandas_batches", and the position of the statement (default collect_result)
+  query_tag_attributes -- the attributes of the QUERY_TAG set on each statement, as returned by build_query_tag_attributes (default None)
+  durable_execution -- the execution state for the statements, as returned by retrieve_durable_execution, in which case every statement is submitted as an asynchronous job and reattached to by a retry (default None)
+
+  Returns a list containing the value returned by the result handler for each statement, in the order the statements were given.
+  If any statement in a group fails, the remaining statements in that group are still awaited,
+  later groups are not executed and the first error is raised.
+  Statements marked as cacheable are served from the statement result cache where possible
+
+  eg: execute_sql_statement_groups(snowpark_session=snowpark_session, sql_statement_groups=[["SELECT 1"], ["SELECT 2", "SELECT 3"]])
+  """
+  sql_statement_results = []
+  statement_number = 0
+  for group_number, sql_statement_group in enumerate(sql_statement_groups, start=1):
+
+    ### Serve cacheable statements from the cache where possible.
+    ### The cache key is built when the group begins, so that it
+    ### reflects any USE statements in earlier groups
+    cache_keys = [
+        build_statement_result_cache_key(snowpark_session, sql_statement) if isinstance(sql_statement, CacheableSqlStatement) else None
+        for sql_statement in sql_statement_group
+    ]
+    cached_results = [
+        retrieve_cached_statement_result(cache_key) if cache_key is not None else (False, None)
+        for cache_key in cache_keys
+    ]
+    statements_to_execute = [
+        sql_statement for sql_statement, (is_cached, _) in zip(sql_statement_group, cached_results) if not is_cached
+    ]
+    if len(statements_to_execute) < len(sql_statement_group) :
+      logging.info(f'Manual log - Serving {len(sql_statement_group) - len(statements_to_execute)} cached statement results for group {group_number}')
+
+    ### A single statement does not benefit from an async job,
+    ### unless its query ID must be stored before it is awaited
+    if len(statements_to_execute) <= 1 and durable_execution is None :
+      for sql_statement, cache_key, (is_cached, cached_result) in zip(sql_statement_group, cache_keys, cached_results):
+        statement_number += 1
+        if is_cached :
+          sql_statement_results.append(cached_result)
+          continue
+        with _timed_statement_execution(snowpark_session, group_number, statement_number):
+          sf_df_statement = snowpark_session.sql(sql_statement)
+          statement_params = build_statement_params(query_tag_attributes, statement_number)
+          sql_statement_results.append(result_handler(
+              lambda result_type: _fetch_dataframe_result(sf_df_statement, result_type, statement_params)
+            , statement_number
+          ))
+        if cache_key is not None :
+          store_statement_result(cache_key, sql_statement_results[-1])
+      continue
+
+    ### Submit every statement in the group before awaiting any of them
+    logging.info(f'Manual log - Submitting {len(statements_to_execute)} concurrent statements for group {group_number}')
+    uncached_statement_numbers = [
+        group_statement_number for group_statement_number, (is_cached, _) in enumerate(cached_results, start=statement_number + 1) if not is_cached
+    ]
+    async_jobs = []
+    submitted_query_ids = {}
+    for sql_statement, group_statement_number in zip(statements_to_execute, uncached_statement_numbers):
+
+      #### Reattach to a query submitted by an earlier attempt,
+      #### rather than executing the statement again
+      query_id = durable_execution.retrieve_query_id(group_statement_number, sql_statement) if durable_execution is not None else None
+      if query_id is not None :
+        logging.info(f'Manual log - Reattaching to query ID {query_id} for statement {group_statement_number}')
+        async_jobs.append(snowpark_session.create_async_job(query_id))
+        continue
+      async_job = snowpark_session.sql(sql_statement).collect_nowait(statement_params=build_statement_params(query_tag_attributes, group_statement_number))
+      async_jobs.append(async_job)
+      submitted_query_ids[group_statement_number] = (sql_statement, async_job.query_id)
+
+    ### Store the submitted query IDs before awaiting any of them
+    if durable_execution is not None :
+      durable_execution.record_query_ids(submitted_query_ids)
+    async_jobs = iter(async_jobs)
+
+    ### Await every job so that none are left running
+    ### unobserved, then raise the first error if any
+    first_error = None
+    failed_statement_numbers = []
+    for cache_key, (is_cached, cached_result) in zip(cache_keys, cached_results):
+      statement_number += 1
+      if is_cached :
+        sql_statement_results.append(cached_result)
+        continue
+      async_job = next(async_jobs)
+      try:
+
+        #### The statement has been running since submission, so
+        #### this times how long the group waited for its result
+        with timed_stage("query_execute", group_number=group_number, statement_number=statement_number, **{"snowflake.query_id": async_job.query_id}):
+          sql_statement_results.append(result_handler(async_job.result, statement_number))
+        if cache_key is not None :
+          store_statement_result(cache_key, sql_statement_results[-1])
+      except Exception as e:
+        logging.error(f'Manual log - Statement with query ID {async_job.query_id} failed in group {group_number}')
+        logging.error(e)
+        failed_statement_numbers.append(statement_number)
+        if first_error is None :
+          first_error = e
+    if first_error is not None :
+
+      #### Forget the failed queries, so that a retry executes them again
+      if durable_execution is not None :
+        durable_execution.forget_query_ids(failed_statement_numbers)
+      raise first_error
+
+  return sql_statement_results
@@ -0,0 +1,151 @@
+
+# Worker-scoped cache of the results of SQL statements
+# from JSON control files which are explicitly marked as
+# cacheable. Results are keyed on a hash of the normalized
+# statement together with the account, role, warehouse,
+# database and schema of the session, so that an identical
+# read-only statement uploaded by several upstream systems
+# within the time-to-live is only executed once. The cache
+# is bounded in size, evicting the least recently used result
+#
+# Only statements marked as cacheable are ever served from
+# the cache, as described in the README, since the cache
+# cannot tell whether a statement has side effects
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+## Import shared packages
+from .app_settings import retrieve_int_app_setting
+from .telemetry import register_metrics_snapshot
+
+## Quoted sections of a statement, which are kept verbatim
+## when normalizing: string literals, quoted identifiers
+## and dollar-quoted strings
+_QUOTED_SQL_PATTERN = re.compile(r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"]|\"\")*\"|\$\$.*?\$\$)", re.DOTALL)
+
+## Module-level state which lives for the lifetime of the worker
+_cached_statement_results = OrderedDict()
+_statement_result_cache_lock = threading.Lock()
+_statement_result_cache_metrics = {
+    "hits": 0
+  , "misses": 0
+  , "expired": 0
+  , "evicted": 0
+}
+
+## Define function to normalize a SQL statement
+def normalize_sql_statement(sql_statement: str):
+  """
+  Normalize a SQL statement so that statements differing only in whitespace, the case of unquoted text or a trailing semicolon are identical
+  Keyword arguments:
+  sql_statement -- the SQL statement
+
+  eg: normalize_sql_statement(sql_statement="select *  from my_table;")
+  """
+  normalized_sections = []
+  for section_number, sql_section in enumerate(_QUOTED_SQL_PATTERN.split(sql_statement)):
+
+    ### Odd sections are quoted and are kept verbatim
+    if section_number % 2 == 1 :
+      normalized_sections.append(sql_section)
+    else :
+      normalized_sections.append(re.sub(r"\s+", " ", sql_section).upper())
+
+  return "".join(normalized_sections).strip().rstrip(";").strip()
+
+## Define function to build the cache key for
+## a statement executed on a Snowpark session
+def build_statement_result_cache_key(snowpark_session, sql_statement: str):
+  """
+  Build the cache key for a SQL statement from a hash of the normalized statement and the context of the session
+  Keyword arguments:
+  snowpark_session -- the Snowpark session on which the statement would execute
+  sql_statement -- the SQL statement
+
+  The session context is tracked by the Snowflake connector, so building the key does not execute a query
+
+  eg: build_statement_result_cache_key(snowpark_session=snowpark_session, sql_statement="SELECT 1")
+  """
+  statement_hash = hashlib.sha256()
+  for key_part in (
+      snowpark_session.get_current_account()
+    , snowpark_session.get_current_role()
+    , snowpark_session.get_current_warehouse()
+    , snowpark_session.get_current_database()
+    , snowpark_session.get_current_schema()
+    , normalize_sql_statement(sql_statement)
+  ):
+    statement_hash.update(str(key_part or "").encode())
+    statement_hash.update(b"\0")
+  return statement_hash.hexdigest()
+
+## Define function to retrieve a cached statement result
+def retrieve_cached_statement_result(cache_key: str):
+  """
+  Retrieve the cached result for a statement, returning a tuple of whether a fresh result was found and the result
+  Keyword arguments:
+  cache_key -- the cache key, as returned by build_statement_result_cache_key
+
+  eg: is_cached, cached_result = retrieve_cached_statement_result(cache_key=cache_key)
+  """
+  ttl_seconds = retrieve_int_app_setting("SNOWFLAKE_STATEMENT_RESULT_CACHE_TTL_SECONDS", 300)
+  with _statement_result_cache_lock:
+    cached_result = _cached_statement_results.get(cache_key)
+    if cached_result is not None and time.monotonic() - cached_result["cached_at"] > ttl_seconds :
+      del _cached_statement_results[cache_key]
+      _statement_result_cache_metrics["expired"] += 1
+      cached_result = None
+    if cached_result is None :
+      _statement_result_cache_metrics["misses"] += 1
+      return False, None
+    _cached_statement_results.move_to_end(cache_key)
+    _statement_result_cache_metrics["hits"] += 1
+  return True, cached_result["result"]
+
+## Define function to store a statement result in the cache
+def store_statement_result(cache_key: str, statement_result):
+  """
+  Store the result of a statement in the cache, evicting the least recently used results beyond the size limit
+  Keyword arguments:
+  cache_key -- the cache key, as returned by build_statement_result_cache_key
+  statement_result -- the value returned by the result handler for the statement
+
+  eg: store_statement_result(cache_key=cache_key, statement_result=statement_result)
+  """
+  max_entries = retrieve_int_app_setting("SNOWFLAKE_STATEMENT_RESULT_CACHE_MAX_ENTRIES", 128)
+  if max_entries <= 0 or retrieve_int_app_setting("SNOWFLAKE_STATEMENT_RESULT_CACHE_TTL_SECONDS", 300) <= 0 :
+    return
+  with _statement_result_cache_lock:
+    _cached_statement_results[cache_key] = {"result": statement_result, "cached_at": time.monotonic()}
+    _cached_statement_results.move_to_end(cache_key)
+    while len(_cached_statement_results) > max_entries :
+      _cached_statement_results.popitem(last=False)
+      _statement_result_cache_metrics["evicted"] += 1
+
+## Define function to invalidate cached statement results
+def invalidate_statement_result_cache():
+  """
+  Remove every cached statement result so that cacheable statements are executed again on next use
+  """
+  with _statement_result_cache_lock:
+    _cached_statement_results.clear()
+  logging.info(f'Manual log - Invalidated cached statement results')
+
+## Define function to retrieve a snapshot of the cache metrics
+def retrieve_statement_result_cache_metrics():
+  """
+  Retrieve a snapshot of the hit, miss, expiry and eviction counts and the number of cached statement results
+  """
+  with _statement_result_cache_lock:
+    return {**_statement_result_cache_metrics, "entries": len(_cached_statement_results)}
+
+## Export the cache counters
+register_metrics_snapshot("statement_result_cache", retrieve_statement_result_cache_metrics, "Statement result cache hit, miss, expiry and eviction counters")
@@ -0,0 +1,213 @@
+
+# Processing shared by the storage queue triggered
+# functions. Each function only differs in how it creates
+# its Snowpark session, so the function supplies its
+# session builder and everything else, from parsing the
+# message to logging the statement results, happens here
+
+## Import Azure packages
+import logging
+import azure.functions as func
+
+## Import shared packages
+from .blob_storage import azure_download_json_file
+from .message_routing import route_queue_message
+from .sql_statement_pipeline import retrieve_sql_statement_groups_to_execute, execute_sql_statement_groups, collect_result
+from .result_handling import build_result_handler, log_statement_results
+from .snowflake_execution import run_snowflake_execution
+from .idempotency_store import build_blob_event_idempotency_key, claim_idempotency_key, complete_idempotency_key, release_idempotency_key
+from .telemetry import timed_stage
+from .bulk_ingestion import retrieve_bulk_ingestion_route, ingest_data_files
+from .dependency_resilience import DependencyCircuitOpenError, raise_if_dependency_circuit_open
+from .queue_deferral import defer_queue_message
+from .durable_execution import retrieve_durable_execution
+from .poison_quarantine import validate_control_file_blob, is_poison_blob_error, quarantine_blob_event
+from .workload_routing import WORKLOAD_HINT_KEY, retrieve_workload_route, retrieve_workload_warehouse, routed_pooled_snowpark_session, resized_warehouse, build_query_tag_attributes
+
+## Define function that executes given SQL in Snowflake
+def execute_sql_in_snowflake(session_builder, sql_statement_groups_to_execute: list, result_handler=collect_result, workload_route: dict = None, query_tag_attributes: dict = None, durable_execution_key: str = None):
+  """
+  Execute ordered groups of SQL statements on a pooled Snowpark session and log the results
+  Keyword arguments:
+  session_builder -- a function without arguments that creates a new Snowpark session, leveraged through the session pool
+  sql_statement_groups_to_execute -- the ordered list of statement groups, as returned by retrieve_sql_statement_groups_to_execute
+  result_handler -- the handler for each statement result, as returned by build_result_handler (default collect_result)
+  workload_route -- the route giving the warehouse and role, as returned by retrieve_workload_route (default None)
+  query_tag_attributes -- the attributes of the QUERY_TAG set on each statement, as returned by build_query_tag_attributes (default None)
+  durable_execution_key -- the key under which the query IDs of the statements are stored, so that a retry reattaches to them rather than executing them again (default None)
+
+  eg: execute_sql_in_snowflake(session_builder=build_snowpark_session, sql_statement_groups_to_execute=[["SELECT 1"]])
+  """
+  try:
+
+    ### Retrieve the query IDs submitted by any earlier attempt
+    durable_execution = retrieve_durable_execution(durable_execution_key)
+
+    ### Retrieve a Snowflake Snowpark session on the warehouse and
+    ### role of the route from the worker-scoped pool, creating one if needed
+    with resized_warehouse(session_builder, workload_route):
+      with routed_pooled_snowpark_session(session_builder, workload_route) as snowpark_session:
+
+        ### Execute the SQL commands in Snowflake, submitting
+        ### independent statements concurrently, and log the results
+        sf_df_statement_results = execute_sql_statement_groups(snowpark_session, sql_statement_groups_to_execute, result_handler, query_tag_attributes, durable_execution)
+
+    if durable_execution is not None :
+      durable_execution.complete()
+    log_statement_results(sf_df_statement_results)
+
+    return
+
+  except Exception as e:
+
+    logging.error(f"Manual log - Error encountered")
+    logging.error(e)
+    raise
+
+## Define function that loads data files into Snowflake
+def ingest_data_files_in_snowflake(session_builder, bulk_ingestion_route: dict, storage_blob_service_uri: str, container: str, relative_file_paths: list, workload_route: dict = None, query_tag_attributes: dict = None):
+  """
+  Stage data files and load them into the target table of their route on a pooled Snowpark session
+  Keyword arguments:
+  session_builder -- a function without arguments that creates a new Snowpark session, leveraged through the session pool
+  bulk_ingestion_route -- the route for the files, as returned by retrieve_bulk_ingestion_route
+  storage_blob_service_uri -- the uri for the blob storage service
+  container -- the container name
+  relative_file_paths -- the paths of the files within the container
+  workload_route -- the route giving the warehouse and role, as returned by retrieve_workload_route (default None)
+  query_tag_attributes -- the attributes of the QUERY_TAG set on each COPY, as returned by build_query_tag_attributes (default None)
+
+  eg: ingest_data_files_in_snowflake(session_builder=build_snowpark_session, bulk_ingestion_route=bulk_ingestion_route, storage_blob_service_uri="https://my-storage-account.blob.core.windows.net", container="landing", relative_file_paths=["sales/2024-01-01.csv"])
+  """
+  try:
+    with resized_warehouse(session_builder, workload_route):
+      with routed_pooled_snowpark_session(session_builder, workload_route) as snowpark_session:
+        copy_results = ingest_data_files(snowpark_session, bulk_ingestion_route, storage_blob_service_uri, container, relative_file_paths, query_tag_attributes)
+    log_statement_results([copy_results])
+    return
+
+  except Exception as e:
+
+    logging.error(f"Manual log - Error encountered")
+    logging.error(e)
+    raise
+
+## Define function which processes a single
+## message from the storage queue
+def process_storage_queue_message(msg: func.QueueMessage, session_builder):
+  """
+  Download the JSON file referenced by a storage queue message and execute its SQL statements in Snowflake
+  Keyword arguments:
+  msg -- the storage queue message containing a blob created event
+  session_builder -- a function without arguments that creates a new Snowpark session, leveraged through the session pool
+
+  eg: process_storage_queue_message(msg=msg, session_builder=build_snowpark_session_using_app_settings_password)
+  """
+
+  ### Time the whole invocation, as the parent of every stage
+  with timed_stage("invocation", message_id=msg.id):
+    _process_storage_queue_message(msg, session_builder)
+
+  return
+
+## Define function which processes a single message
+## within the span for the invocation
+def _process_storage_queue_message(msg: func.QueueMessage, session_builder):
+
+  ### Parse the message once and route each of its events, rejecting
+  ### events for unknown storage accounts and containers
+  with timed_stage("message_parse"):
+    routed_blob_events = route_queue_message(msg)
+
+  ### Process the events in order, so that a failed event
+  ### stops the message and is retried with it, whilst
+  ### the events before it are skipped as duplicates.
+  ### Whilst Snowflake is down, the message is deferred
+  ### rather than consuming one of its dequeue attempts
+  try:
+    for routed_blob_event in routed_blob_events:
+      _process_routed_blob_event(msg, routed_blob_event, session_builder)
+  except DependencyCircuitOpenError:
+    if not defer_queue_message(msg) :
+      raise
+
+  return
+
+## Define function which processes a single routed blob event
+def _process_routed_blob_event(msg: func.QueueMessage, routed_blob_event: dict, session_builder):
+  storage_blob_service_uri = routed_blob_event["storage_blob_service_uri"]
+  container = routed_blob_event["container"]
+  relative_file_path = routed_blob_event["relative_file_path"]
+
+  ### Skip repeated deliveries of the same blob event before any download
+  ### or Snowflake login, failing the message for retry whilst an
+  ### earlier delivery of the event is still in progress
+  idempotency_key = build_blob_event_idempotency_key(routed_blob_event["event_id"], routed_blob_event["etag"])
+  if not claim_idempotency_key(idempotency_key) :
+    logging.info(f'Manual log - Skipping duplicate delivery of event {routed_blob_event["event_id"]} in message {msg.id}')
+    return
+
+  try:
+
+    ### Only blobs routed to the auto handler may be data files
+    bulk_ingestion_route = retrieve_bulk_ingestion_route(container, relative_file_path) if routed_blob_event["handler"] == "auto" else None
+
+    ### Fail before downloading anything whilst Snowflake is
+    ### down, so that the message is deferred
+    raise_if_dependency_circuit_open("snowflake")
+
+    ### Load data files with COPY INTO rather
+    ### than downloading them as control files
+    if bulk_ingestion_route is not None :
+      workload_route = retrieve_workload_route(container, relative_file_path)
+      query_tag_attributes = build_query_tag_attributes(msg.id, container, relative_file_path, workload_route)
+      run_snowflake_execution(
+          ingest_data_files_in_snowflake, session_builder, bulk_ingestion_route, storage_blob_service_uri, container, [relative_file_path], workload_route, query_tag_attributes
+        , warehouse = retrieve_workload_warehouse(workload_route)
+      )
+
+    else :
+
+      ### Check the control file before downloading it, then retrieve
+      ### JSON input from Azure storage and the ordered groups of SQL
+      ### statements, acknowledging a control file which can never
+      ### be processed once it has been quarantined
+      try:
+        poison_stage = "validate"
+        validate_control_file_blob(routed_blob_event)
+        poison_stage = "download"
+        json_input = azure_download_json_file(storage_blob_service_uri=storage_blob_service_uri, container=container, relative_file_path=relative_file_path)
+        poison_stage = "interpret"
+        sql_statement_groups_to_execute = retrieve_sql_statement_groups_to_execute(json_input)
+      except Exception as e:
+        if not is_poison_blob_error(e, poison_stage) :
+          raise
+        quarantine_blob_event(msg.id, routed_blob_event, poison_stage, e)
+        complete_idempotency_key(idempotency_key)
+        return
+
+      ### Build the handler for the statement results, which
+      ### may spill large results to blob storage
+      result_handler = build_result_handler(storage_blob_service_uri=storage_blob_service_uri, result_path_prefix=f"{container}/{relative_file_path}")
+
+      ### Route the statements to the warehouse and role for
+      ### their workload, tagging each with where it came from
+      workload_route = retrieve_workload_route(container, relative_file_path, json_input.get(WORKLOAD_HINT_KEY))
+      query_tag_attributes = build_query_tag_attributes(msg.id, container, relative_file_path, workload_route)
+
+      ### Attempt to execute the SQL in Snowflake on the worker-scoped
+      ### thread pool, within the in-flight limit for the warehouse
+      run_snowflake_execution(
+          execute_sql_in_snowflake, session_builder, sql_statement_groups_to_execute, result_handler, workload_route, query_tag_attributes, idempotency_key
+        , warehouse = retrieve_workload_warehouse(workload_route)
+      )
+
+  except Exception:
+
+    ### Release the key so that a retry of the message is processed
+    release_idempotency_key(idempotency_key)
+    raise
+
+  complete_idempotency_key(idempotency_key)
+
+  return
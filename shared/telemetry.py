@@ -0,0 +1,250 @@
+
+# Per-stage timing of every invocation. Each stage, such
+# as the message parse, secret fetch, download, session
+# creation or query execution, is timed and emitted as an
+# OpenTelemetry span and as a duration in the
+# snowpark_function.stage.duration histogram, which the
+# Azure Monitor exporter sends to Application Insights as a
+# custom metric. Attributes such as the Snowflake query ID
+# are attached to the span for the stage
+#
+# Telemetry is exported to Application Insights when the
+# APPLICATIONINSIGHTS_CONNECTION_STRING app setting is
+# populated, unless the TELEMETRY_EXPORT_ENABLED app setting
+# is false. Stage timings are always logged and kept in
+# worker-scoped counters, whether or not they are exported
+#
+# The counters which the shared modules keep for the
+# lifetime of the worker, such as the session pool hits and
+# misses, are registered with register_metrics_snapshot and
+# observed as an OpenTelemetry gauge for each module whenever
+# the metrics are collected for export
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import os
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+## Import shared packages
+from .lazy_imports import import_module_lazily, import_attribute_lazily
+
+## Import heavy packages, deferred until first use
+opentelemetry_trace = import_module_lazily("opentelemetry.trace")
+opentelemetry_metrics = import_module_lazily("opentelemetry.metrics")
+configure_azure_monitor = import_attribute_lazily("azure.monitor.opentelemetry", "configure_azure_monitor")
+
+## Name of the histogram holding the duration of each stage
+STAGE_DURATION_METRIC_NAME = "snowpark_function.stage.duration"
+
+## Prefix of the name of the gauge for each metrics snapshot
+METRICS_SNAPSHOT_METRIC_NAME_PREFIX = "snowpark_function"
+
+## Module-level state which lives for the lifetime of the worker
+_telemetry_instruments = None
+_telemetry_lock = threading.Lock()
+_stage_timing_metrics = {}
+_metrics_snapshots = {}
+
+## Define function to configure the exporter and
+## create the tracer and histogram on first use
+def _retrieve_telemetry_instruments():
+  global _telemetry_instruments
+  if _telemetry_instruments is None :
+    with _telemetry_lock:
+      if _telemetry_instruments is None :
+        _telemetry_instruments = _create_telemetry_instruments()
+  return _telemetry_instruments
+
+## Define function to create the tracer and histogram,
+## falling back to logging only if OpenTelemetry is unavailable
+def _create_telemetry_instruments():
+  export_enabled = os.getenv("TELEMETRY_EXPORT_ENABLED", "true").lower() != "false"
+  if export_enabled and os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING") :
+    try:
+      configure_azure_monitor()
+      logging.info(f'Manual log - Configured OpenTelemetry export to Application Insights')
+    except Exception as e:
+      logging.warning(f'Manual log - Error configuring OpenTelemetry export to Application Insights: {e}')
+
+  try:
+    tracer = opentelemetry_trace.get_tracer(__name__)
+    stage_duration_histogram = opentelemetry_metrics.get_meter(__name__).create_histogram(
+        STAGE_DURATION_METRIC_NAME
+      , unit = "ms"
+      , description = "Duration of each stage of a function invocation"
+    )
+  except ImportError as e:
+    logging.warning(f'Manual log - OpenTelemetry is not available, stage timings will only be logged: {e}')
+    tracer, stage_duration_histogram = None, None
+  telemetry_instruments = {"tracer": tracer, "stage_duration_histogram": stage_duration_histogram, "metrics_snapshot_gauges": {}}
+
+  ### Observe the snapshots registered before the
+  ### instruments were created, which is usually all of them
+  if stage_duration_histogram is not None :
+    for snapshot_name in list(_metrics_snapshots):
+      _create_metrics_snapshot_gauge(telemetry_instruments, snapshot_name)
+  return telemetry_instruments
+
+## Define function to flatten a metrics snapshot into
+## observations, turning the keys of nested dictionaries
+## into attributes and skipping values which are not numbers
+def _flatten_metrics_snapshot(metrics_snapshot: dict, scope_attribute_names: tuple, scope_attributes: dict):
+  for metric_name, metric_value in metrics_snapshot.items():
+    if isinstance(metric_value, dict) :
+      if len(scope_attribute_names) > 0 :
+        yield from _flatten_metrics_snapshot(metric_value, scope_attribute_names[1:], {**scope_attributes, scope_attribute_names[0]: str(metric_name)})
+    elif isinstance(metric_value, (int, float)) :
+      yield opentelemetry_metrics.Observation(metric_value, {**scope_attributes, "metric": metric_name})
+
+## Define function to create the gauge which observes a
+## metrics snapshot each time the metrics are collected
+def _create_metrics_snapshot_gauge(telemetry_instruments: dict, snapshot_name: str):
+  retrieve_metrics_snapshot, scope_attribute_names, description = _metrics_snapshots[snapshot_name]
+
+  ### An error in one snapshot must not stop the others being exported
+  def observe_metrics_snapshot(callback_options):
+    try:
+      return list(_flatten_metrics_snapshot(retrieve_metrics_snapshot(), scope_attribute_names, {}))
+    except Exception as e:
+      logging.warning(f'Manual log - Error observing the {snapshot_name} metrics: {e}')
+      return []
+
+  telemetry_instruments["metrics_snapshot_gauges"][snapshot_name] = opentelemetry_metrics.get_meter(__name__).create_observable_gauge(
+      f"{METRICS_SNAPSHOT_METRIC_NAME_PREFIX}.{snapshot_name}"
+    , callbacks = [observe_metrics_snapshot]
+    , description = description
+  )
+
+## Define function to register a snapshot of worker-scoped
+## counters to be exported as an OpenTelemetry gauge
+def register_metrics_snapshot(snapshot_name: str, retrieve_metrics_snapshot, description: str, scope_attribute_names: tuple = ()):
+  """
+  Register a function returning a snapshot of worker-scoped counters, which is observed as a gauge with a metric dimension each time the metrics are collected
+  Keyword arguments:
+  snapshot_name -- the name of the snapshot, which is appended to "snowpark_function." to name the gauge
+  retrieve_metrics_snapshot -- a function without arguments that returns a dictionary of the counters
+  description -- the description of the gauge
+  scope_attribute_names -- the dimensions named by the keys of nested dictionaries, outermost first, which are otherwise skipped (default none)
+
+  Registering is cheap, so that shared modules can register their snapshot when
+  they are imported. OpenTelemetry is only imported once the first stage is timed.
+
+  eg: register_metrics_snapshot(snapshot_name="snowflake_execution", retrieve_metrics_snapshot=retrieve_snowflake_execution_metrics, description="Snowflake execution counters for each warehouse", scope_attribute_names=("warehouse",))
+  """
+  with _telemetry_lock:
+    _metrics_snapshots[snapshot_name] = (retrieve_metrics_snapshot, tuple(scope_attribute_names), description)
+    telemetry_instruments = _telemetry_instruments
+  if telemetry_instruments is not None and telemetry_instruments["stage_duration_histogram"] is not None :
+    _create_metrics_snapshot_gauge(telemetry_instruments, snapshot_name)
+
+## Define function to record a stage duration in the
+## worker-scoped counters and the histogram
+def record_stage_duration(stage_name: str, duration_seconds: float, succeeded: bool = True):
+  """
+  Record the duration of a stage which cannot be wrapped in timed_stage, such as a stage interleaved with another
+  Keyword arguments:
+  stage_name -- the name of the stage, such as "download"
+  duration_seconds -- the duration of the stage in seconds
+  succeeded -- whether the stage succeeded (default True)
+
+  eg: record_stage_duration(stage_name="json_parse", duration_seconds=0.012)
+  """
+  with _telemetry_lock:
+    stage_metrics = _stage_timing_metrics.setdefault(stage_name, {
+        "count": 0
+      , "failed": 0
+      , "seconds_total": 0.0
+      , "seconds_max": 0.0
+    })
+    stage_metrics["count"] += 1
+    stage_metrics["failed"] += 0 if succeeded else 1
+    stage_metrics["seconds_total"] += duration_seconds
+    stage_metrics["seconds_max"] = max(stage_metrics["seconds_max"], duration_seconds)
+
+  stage_duration_histogram = _retrieve_telemetry_instruments()["stage_duration_histogram"]
+  if stage_duration_histogram is not None :
+    stage_duration_histogram.record(duration_seconds * 1000, {"stage": stage_name, "succeeded": succeeded})
+
+## Define context manager which times a stage
+## and emits it as a span and a metric
+@contextmanager
+def timed_stage(stage_name: str, **stage_attributes):
+  """
+  Time a stage of an invocation, emitting it as an OpenTelemetry span and as a duration in the stage histogram
+  Keyword arguments:
+  stage_name -- the name of the stage, such as "secret_fetch"
+  stage_attributes -- attributes to attach to the span for the stage
+
+  Yields a dictionary of the span attributes, to which attributes only known
+  during the stage, such as the Snowflake query ID, can be added
+
+  eg:
+  with timed_stage("query_execute", statement_number=1) as stage_attributes:
+    stage_attributes["snowflake.query_id"] = async_job.query_id
+  """
+  tracer = _retrieve_telemetry_instruments()["tracer"]
+  span_context = tracer.start_as_current_span(f"snowpark_function.{stage_name}") if tracer is not None else nullcontext()
+  stage_start = time.perf_counter()
+  succeeded = False
+  with span_context as span:
+    try:
+      yield stage_attributes
+      succeeded = True
+    finally:
+      duration_seconds = time.perf_counter() - stage_start
+      if span is not None :
+        for attribute_name, attribute_value in stage_attributes.items():
+          if attribute_value is not None :
+            span.set_attribute(attribute_name, attribute_value if isinstance(attribute_value, (bool, int, float, str)) else str(attribute_value))
+      record_stage_duration(stage_name, duration_seconds, succeeded)
+      logging.info(f'Manual log - Stage {stage_name} {"completed" if succeeded else "failed"} in {duration_seconds:.3f} seconds')
+
+## Define a wrapper around an Azure credential
+## which times each acquisition of an access token
+class TimedTokenCredential:
+  """
+  Wrapper around an Azure credential which records each call to get_token or get_token_info as the credential_acquisition stage
+  """
+  def __init__(self, credential):
+    self._credential = credential
+
+  ### Only the token methods are timed, which the SDK clients
+  ### call when their cached token is missing or expiring
+  def __getattr__(self, attribute_name: str):
+    credential_attribute = getattr(self._credential, attribute_name)
+    if attribute_name not in ("get_token", "get_token_info") :
+      return credential_attribute
+    def timed_token_acquisition(*args, **kwargs):
+      with timed_stage("credential_acquisition", credential_method=attribute_name):
+        return credential_attribute(*args, **kwargs)
+    return timed_token_acquisition
+
+## Define a wrapper around an Azure aio credential
+## which times each acquisition of an access token
+class AsyncTimedTokenCredential(TimedTokenCredential):
+  """
+  Wrapper around an Azure aio credential which records each call to get_token or get_token_info as the credential_acquisition stage
+  """
+  def __getattr__(self, attribute_name: str):
+    credential_attribute = getattr(self._credential, attribute_name)
+    if attribute_name not in ("get_token", "get_token_info") :
+      return credential_attribute
+    async def timed_token_acquisition(*args, **kwargs):
+      with timed_stage("credential_acquisition", credential_method=attribute_name):
+        return await credential_attribute(*args, **kwargs)
+    return timed_token_acquisition
+
+## Define function to retrieve a snapshot of the stage timings
+def retrieve_stage_timing_metrics():
+  """
+  Retrieve a snapshot of the count, failures and total, maximum and mean duration of each stage recorded by this worker
+  """
+  with _telemetry_lock:
+    stage_timing_metrics = {stage_name: dict(stage_metrics) for stage_name, stage_metrics in _stage_timing_metrics.items()}
+  for stage_metrics in stage_timing_metrics.values():
+    stage_metrics["seconds_mean"] = stage_metrics["seconds_total"] / stage_metrics["count"]
+  return stage_timing_metrics
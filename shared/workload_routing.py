@@ -0,0 +1,310 @@
+
+# Routing of the work from storage triggered functions to
+# a warehouse and role, so that heavy transformations and
+# small metadata statements do not queue behind each other
+# on one warehouse. Each route in the
+# SNOWFLAKE_WORKLOAD_ROUTES app setting matches a "workload"
+# hint in the JSON control file or the container and path
+# prefix of the blob, and gives the warehouse and role on
+# which its statements execute. Sessions for each warehouse
+# and role are pooled separately, so the USE statements are
+# only paid once per pooled session. A route may also resize
+# its warehouse whilst its statements execute
+#
+# Every statement is tagged with a QUERY_TAG, passed as a
+# statement parameter so that it costs no extra round trip
+# and never lingers on the pooled session, identifying the
+# message, file, route and statement that it came from.
+# A tag longer than Snowflake allows is shortened by
+# truncating its longest values rather than cutting the JSON
+#
+# Expected format of the SNOWFLAKE_WORKLOAD_ROUTES app setting:
+#   [
+#     {
+#         "route_name": "nightly_transforms"
+#       , "workload": "heavy"
+#       , "container": "transforms"
+#       , "path_prefix": "nightly/"
+#       , "warehouse": "TRANSFORM_WH"
+#       , "role": "TRANSFORMER"
+#       , "warehouse_size": "LARGE"
+#       , "restore_warehouse_size": "XSMALL"
+#       , "query_tag": {"team": "finance"}
+#     }
+#   ]
+#
+# where a route matches either a control file whose
+# "workload" equals its "workload", or a blob within its
+# "container" and "path_prefix". Routes matching a hint
+# take precedence, and otherwise the first matching route
+# is used. Every key other than "warehouse" is optional
+
+## Import Azure packages
+import logging
+
+## Import other packages
+import os
+import re
+import json
+import threading
+from contextlib import contextmanager
+
+## Import shared packages
+from .snowpark_session_pool import pooled_snowpark_session, build_session_pool_key
+from .telemetry import timed_stage
+
+## Key within the JSON control file which may name the workload
+WORKLOAD_HINT_KEY = "workload"
+
+## Snowflake limits a query tag to 2,000 characters
+MAX_QUERY_TAG_LENGTH = 2000
+
+## Warehouse sizes which may be given for a route
+WAREHOUSE_SIZE_PATTERN = re.compile(r"^(X-?SMALL|SMALL|MEDIUM|LARGE|X-?LARGE|[2-6]X-?LARGE)$", re.IGNORECASE)
+
+## Unquoted identifiers which may be given for a warehouse or role
+SNOWFLAKE_IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_$]*$")
+
+## Module-level state which lives for the lifetime of the worker
+_parsed_routes = {"app_setting_value": None, "routes": []}
+_resized_warehouses = {}
+_workload_routing_lock = threading.Lock()
+
+## Define function to validate a single route
+def _validate_workload_route(route_number: int, workload_route: dict):
+  if not isinstance(workload_route.get("warehouse"), str) or SNOWFLAKE_IDENTIFIER_PATTERN.match(workload_route["warehouse"]) is None :
+    raise ValueError(f"Workload route {route_number} does not contain a valid 'warehouse'")
+  if workload_route.get("role") is not None and SNOWFLAKE_IDENTIFIER_PATTERN.match(str(workload_route["role"])) is None :
+    raise ValueError(f"Workload route {route_number} contains an invalid 'role'")
+  for size_key in ("warehouse_size", "restore_warehouse_size"):
+    if workload_route.get(size_key) is not None and WAREHOUSE_SIZE_PATTERN.match(str(workload_route[size_key])) is None :
+      raise ValueError(f"Workload route {route_number} contains an invalid '{size_key}'")
+  if not isinstance(workload_route.get("query_tag", {}), dict) :
+    raise ValueError(f"Workload route {route_number} contains a 'query_tag' that is not an object")
+  if workload_route.get("workload") is None and workload_route.get("container") is None :
+    raise ValueError(f"Workload route {route_number} must contain a 'workload' or a 'container'")
+  return {
+      "route_name": workload_route.get("route_name", f"route_{route_number}")
+    , "workload": None
+    , "container": None
+    , "path_prefix": ""
+    , "role": None
+    , "warehouse_size": None
+    , "restore_warehouse_size": None
+    , "query_tag": {}
+    , **workload_route
+    , "warehouse": workload_route["warehouse"].upper()
+  }
+
+## Define function to retrieve the routes, parsing
+## the app setting again only if it has changed
+def retrieve_workload_routes():
+  """
+  Retrieve the validated routes from the SNOWFLAKE_WORKLOAD_ROUTES app setting, which is empty if the app setting is not populated
+  """
+  app_setting_value = os.getenv("SNOWFLAKE_WORKLOAD_ROUTES") or ""
+  with _workload_routing_lock:
+    if _parsed_routes["app_setting_value"] != app_setting_value :
+      workload_routes = json.loads(app_setting_value) if len(app_setting_value.strip()) > 0 else []
+      if not isinstance(workload_routes, list) :
+        raise ValueError("The SNOWFLAKE_WORKLOAD_ROUTES app setting must be a JSON array of routes")
+      _parsed_routes["routes"] = [
+          _validate_workload_route(route_number, workload_route)
+          for route_number, workload_route in enumerate(workload_routes, start=1)
+      ]
+      _parsed_routes["app_setting_value"] = app_setting_value
+    return _parsed_routes["routes"]
+
+## Define function to find the route for some work
+def retrieve_workload_route(container: str = None, relative_file_path: str = None, workload_hint: str = None):
+  """
+  Retrieve the route for the work from a blob, preferring a route matching the workload hint, or None to use the default warehouse and role
+  Keyword arguments:
+  container -- the container name (default None)
+  relative_file_path -- the path of the blob within the container (default None)
+  workload_hint -- the "workload" given in the JSON control file (default None)
+
+  eg: retrieve_workload_route(container="transforms", relative_file_path="nightly/orders.json", workload_hint="heavy")
+  """
+  workload_routes = retrieve_workload_routes()
+  if workload_hint is not None :
+    for workload_route in workload_routes:
+      if workload_route["workload"] == workload_hint :
+        return workload_route
+    logging.warning(f'Manual log - No workload route matches the workload hint {workload_hint}')
+  for workload_route in workload_routes:
+    if workload_route["container"] is None or workload_route["container"] != container :
+      continue
+    if relative_file_path is None or not relative_file_path.startswith(workload_route["path_prefix"]) :
+      continue
+    return workload_route
+  return None
+
+## Define function to retrieve the warehouse for a route
+def retrieve_workload_warehouse(workload_route: dict = None):
+  """
+  Retrieve the warehouse for a route, or None for the default warehouse, for use with the in-flight limits of snowflake_execution
+  Keyword arguments:
+  workload_route -- the route, as returned by retrieve_workload_route (default None)
+  """
+  return workload_route["warehouse"] if workload_route is not None else None
+
+## Define context manager which hands out a pooled
+## Snowpark session on the warehouse and role of a route
+@contextmanager
+def routed_pooled_snowpark_session(session_builder, workload_route: dict = None):
+  """
+  Retrieve a pooled Snowpark session using the warehouse and role of a route, pooling sessions for each warehouse and role separately
+  Keyword arguments:
+  session_builder -- a function without arguments that creates a new Snowpark session
+  workload_route -- the route, as returned by retrieve_workload_route, or None for the default warehouse and role (default None)
+
+  eg:
+  with routed_pooled_snowpark_session(build_snowpark_session, workload_route) as snowpark_session:
+    snowpark_session.sql("SELECT 1").collect()
+  """
+  if workload_route is None :
+    with pooled_snowpark_session(session_builder) as snowpark_session:
+      yield snowpark_session
+    return
+
+  ### Switch a new session to the route once, when
+  ### it is created, rather than on every checkout
+  def build_routed_snowpark_session():
+    snowpark_session = session_builder()
+    if workload_route["role"] is not None :
+      snowpark_session.use_role(workload_route["role"])
+    snowpark_session.use_warehouse(workload_route["warehouse"])
+    return snowpark_session
+
+  pool_key = f"{build_session_pool_key(session_builder)}|{workload_route['warehouse']}|{workload_route['role'] or ''}"
+  with pooled_snowpark_session(build_routed_snowpark_session, pool_key=pool_key) as snowpark_session:
+
+    ### Switch the session back to the route if it has drifted, such
+    ### as when a pooled session could not be fully restored at check-in.
+    ### The connection tracks its context, so this costs no round trip
+    ### unless a USE statement is needed
+    if workload_route["role"] is not None and snowpark_session.connection.role != _normalize_identifier(workload_route["role"]) :
+      logging.warning(f'Manual log - Pooled session role {snowpark_session.connection.role} does not match route, switching to {workload_route["role"]}')
+      snowpark_session.use_role(workload_route["role"])
+    if snowpark_session.connection.warehouse != _normalize_identifier(workload_route["warehouse"]) :
+      logging.warning(f'Manual log - Pooled session warehouse {snowpark_session.connection.warehouse} does not match route, switching to {workload_route["warehouse"]}')
+      snowpark_session.use_warehouse(workload_route["warehouse"])
+    yield snowpark_session
+
+## Define function to normalize an identifier into
+## the form in which the connection reports it
+def _normalize_identifier(identifier: str):
+  if len(identifier) >= 2 and identifier.startswith('"') and identifier.endswith('"') :
+    return identifier[1:-1].replace('""', '"')
+  return identifier.upper()
+
+## Define function to resize a warehouse on a pooled session
+def _alter_warehouse_size(session_builder, workload_route: dict, warehouse_size: str):
+  warehouse = workload_route["warehouse"]
+  with timed_stage("warehouse_resize", warehouse=warehouse, warehouse_size=warehouse_size):
+    with routed_pooled_snowpark_session(session_builder, workload_route) as snowpark_session:
+      snowpark_session.sql(f"ALTER WAREHOUSE {warehouse} SET WAREHOUSE_SIZE = '{warehouse_size.upper()}'").collect()
+  logging.info(f'Manual log - Resized warehouse {warehouse} to {warehouse_size}')
+
+## Define context manager which resizes the warehouse of a
+## route whilst a block executes, if the route gives a size
+@contextmanager
+def resized_warehouse(session_builder, workload_route: dict = None):
+  """
+  Resize the warehouse of a route to its "warehouse_size" whilst a block executes, restoring its "restore_warehouse_size" once no block in this worker is using it
+  Keyword arguments:
+  session_builder -- a function without arguments that creates a new Snowpark session, whose role must be able to modify the warehouse, leveraged through the session pool
+  workload_route -- the route, as returned by retrieve_workload_route (default None)
+
+  Resizing is counted within a worker, so overlapping blocks only resize the
+  warehouse once, but blocks in other instances are not taken into account.
+  The warehouse is resized on a session checked out from the pool only for
+  the resize, so that the block is free to check out its own sessions
+
+  eg:
+  with resized_warehouse(build_snowpark_session, workload_route):
+    with routed_pooled_snowpark_session(build_snowpark_session, workload_route) as snowpark_session:
+      execute_sql_statement_groups(snowpark_session, sql_statement_groups)
+  """
+  if workload_route is None or workload_route["warehouse_size"] is None :
+    yield
+    return
+
+  warehouse = workload_route["warehouse"]
+  with _workload_routing_lock:
+    _resized_warehouses[warehouse] = _resized_warehouses.get(warehouse, 0) + 1
+    first_user = _resized_warehouses[warehouse] == 1
+  try:
+    if first_user :
+      _alter_warehouse_size(session_builder, workload_route, workload_route["warehouse_size"])
+    yield
+  finally:
+    with _workload_routing_lock:
+      _resized_warehouses[warehouse] -= 1
+      last_user = _resized_warehouses[warehouse] == 0
+    if last_user and workload_route["restore_warehouse_size"] is not None :
+      try:
+        _alter_warehouse_size(session_builder, workload_route, workload_route["restore_warehouse_size"])
+      except Exception as e:
+        logging.warning(f'Manual log - Error restoring the size of warehouse {warehouse}: {e}')
+
+## Define function to build the query tag for the
+## statements executed for a message
+def build_query_tag_attributes(message_id: str = None, container: str = None, relative_file_path: str = None, workload_route: dict = None):
+  """
+  Build the attributes of the QUERY_TAG for the statements from a message, or None if the SNOWFLAKE_QUERY_TAG_ENABLED app setting is false
+  Keyword arguments:
+  message_id -- the ID of the storage queue message (default None)
+  container -- the container name (default None)
+  relative_file_path -- the path of the blob within the container (default None)
+  workload_route -- the route, as returned by retrieve_workload_route (default None)
+
+  eg: build_query_tag_attributes(message_id=msg.id, container="transforms", relative_file_path="nightly/orders.json", workload_route=workload_route)
+  """
+  if os.getenv("SNOWFLAKE_QUERY_TAG_ENABLED", "true").lower() == "false" :
+    return None
+  return {
+      "source": "snowpark-azure-function"
+    , "message_id": message_id
+    , "file": "/".join(file_part for file_part in (container, relative_file_path) if file_part is not None) or None
+    , "route": workload_route["route_name"] if workload_route is not None else None
+    , **(workload_route["query_tag"] if workload_route is not None else {})
+  }
+
+## Define function to build the statement
+## parameters which tag a single statement
+def build_statement_params(query_tag_attributes: dict = None, statement_number: int = None):
+  """
+  Build the Snowpark statement parameters which set the QUERY_TAG for a single statement, or None if there is no tag
+  Keyword arguments:
+  query_tag_attributes -- the attributes of the tag, as returned by build_query_tag_attributes (default None)
+  statement_number -- the position of the statement within the control file (default None)
+
+  eg: snowpark_session.sql("SELECT 1").collect(statement_params=build_statement_params(query_tag_attributes, 1))
+  """
+  if query_tag_attributes is None :
+    return None
+  query_tag_attributes = {**query_tag_attributes, "statement_number": statement_number}
+  query_tag = json.dumps(query_tag_attributes, separators=(",", ":"), default=str)
+
+  ### Shorten the longest attribute value until the tag fits, by the
+  ### overflow or by half if escaping makes the value longer than it
+  ### appears, dropping attributes which are not strings, so that the
+  ### tag is never cut mid-way and always remains valid JSON
+  while len(query_tag) > MAX_QUERY_TAG_LENGTH :
+    overflow_length = len(query_tag) - MAX_QUERY_TAG_LENGTH
+    longest_attribute_name = max(
+        (attribute_name for attribute_name in query_tag_attributes if attribute_name != "statement_number")
+      , key = lambda attribute_name: len(json.dumps(query_tag_attributes[attribute_name], default=str))
+      , default = None
+    )
+    if longest_attribute_name is None :
+      return None
+    longest_attribute_value = query_tag_attributes[longest_attribute_name]
+    if isinstance(longest_attribute_value, str) and len(longest_attribute_value) > 0 :
+      query_tag_attributes[longest_attribute_name] = longest_attribute_value[:max(len(longest_attribute_value) - overflow_length, len(longest_attribute_value) // 2)]
+    else :
+      query_tag_attributes.pop(longest_attribute_name)
+    query_tag = json.dumps(query_tag_attributes, separators=(",", ":"), default=str)
+  return {"QUERY_TAG": query_tag}
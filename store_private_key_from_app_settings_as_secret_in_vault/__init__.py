@@ -9,23 +9,21 @@
 ## Import Azure packages
 import logging
 import azure.functions as func
-from azure.keyvault.secrets import SecretClient
-from azure.identity import DefaultAzureCredential
 
 ## Import other packages
 import os
 
+## Import shared packages
+from ..shared.azure_credential_cache import retrieve_secret_client, invalidate_key_vault_secret
+from ..shared.invocation_profiling import profile_invocation
+
 ## Define main function for Azure
+@profile_invocation
 def main(req: func.HttpRequest) -> func.HttpResponse:
   logging.info("HTTP trigger received a new request")
   
   try:
 
-    ## Retrieve key vault name from app settings
-    ## and convert it into a URI
-    key_vault_name = os.getenv("AZURE_KEY_VAULT_NAME")
-    key_vault_uri = f"https://{key_vault_name}.vault.azure.net"
-
     ## Retrieve secret name from app settings.
     snowflake_user = os.getenv("SNOWFLAKE_USER")
 
@@ -41,13 +39,17 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     ## private key in multi-line form
     snowflake_private_key_plain_text = os.getenv("SNOWFLAKE_PRIVATE_KEY_PLAIN_TEXT")
 
-    ## Leverage managed identity to retrieve key vault secrets client
-    default_azure_credential = DefaultAzureCredential()
-    secret_client = SecretClient(vault_url=key_vault_uri, credential=default_azure_credential)
+    ## Leverage the worker-scoped managed identity
+    ## to retrieve key vault secrets client
+    secret_client = retrieve_secret_client()
 
-    ## Retrieve the secret password from the key vault
+    ## Store the secret private key in the key vault
     secret_client.set_secret(protected_private_key_secret_name, snowflake_private_key_plain_text, content_type="private key")
 
+    ## Ensure any cached copy of the previous
+    ## secret value is not used again
+    invalidate_key_vault_secret(protected_private_key_secret_name)
+
     return func.HttpResponse("Success")
 
   except Exception as e: